@@ -1,40 +1,32 @@
 # Imports
-from flask import Flask, render_template, request, jsonify, send_from_directory, url_for, Response
+from flask import Flask, render_template, request, jsonify, send_file, url_for, Response
 from flask_cors import CORS
 import os
-from PIL import Image
-import io
-import base64
 import glob
 import shutil
-from main import ExpoProcessor, ImageInfo, VideoInfo, Recodificador
+from urllib.parse import quote
+from werkzeug.security import safe_join
+from main import ExpoProcessor, FileManager, ThumbnailCache, VideoPreviewCache, MetadataCache, MediaInspector, ExpoIndex, TrabajoRecodificacion, TrabajoPlan, ColaRecodificacion, PlanificadorCodificacion, Metricas, configurar_logging
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
-from multiprocessing import Manager, Pool
-import time
+from multiprocessing import Manager
+import logging
+
+configurar_logging()
+log = logging.getLogger(__name__)
 
 # Inicialización de Flask
-print("Iniciando configuración de Flask...")
+log.debug("Iniciando configuración de Flask...")
 app = Flask(__name__, template_folder='templates')
 CORS(app)
+# Detrás de nginx/Apache, delegar el envío de ficheros grandes al servidor web
+app.config['USE_X_SENDFILE'] = os.environ.get('EXPO_X_SENDFILE') == '1'
 
-print("Rutas registradas:")
-print(app.url_map)
+# Un año: las URLs versionadas (?v=<huella>) nunca cambian de contenido
+CACHE_INMUTABLE = 31536000
 
 # Funciones auxiliares
-def get_thumbnail(image_path, size=(200, 200)):
-    try:
-        with Image.open(image_path) as img:
-            img.thumbnail(size)
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format=img.format)
-            img_str = base64.b64encode(img_buffer.getvalue()).decode()
-            return f"data:image/{img.format.lower()};base64,{img_str}"
-    except Exception as e:
-        print(f"Error creando miniatura para {image_path}: {e}")
-        return None
-
 def convert_to_serializable(obj):
     """Convierte objetos no serializables a tipos básicos de Python."""
     if hasattr(obj, 'numerator') and hasattr(obj, 'denominator'):
@@ -46,95 +38,227 @@ def convert_to_serializable(obj):
 def index():
     return render_template('index.html')
 
+MEDIA_EXTENSIONES = ('.png', '.jpg', '.jpeg', '.mp4')
+
+def listar_media(expo_id):
+    """Ficheros de la galería ordenados por nombre (y por tanto por pantalla, _PNNN_), desde el índice en memoria."""
+    return ExpoIndex.for_expo(expo_id).listar(MEDIA_EXTENSIONES)
+
+def construir_item(expo_id, filename, file_info, thumbnail_cache, preview_cache):
+    """Entrada de la galería para un fichero, o None si no se pudo leer."""
+    if file_info is None:
+        return None
+    serializable_info = {k: convert_to_serializable(v) for k, v in file_info.items()}
+    if filename.lower().endswith('.mp4'):
+        # La galería usa póster y proxy; el original solo se pide al abrirlo
+        return {
+            'filename': filename,
+            'is_video': True,
+            'poster': preview_cache.url(filename, VideoPreviewCache.POSTER),
+            'proxy': preview_cache.url(filename, VideoPreviewCache.PROXY),
+            'original': f"/expos/{quote(expo_id)}/ficheros_salida/{quote(filename)}",
+            'info': serializable_info
+        }
+    # La miniatura se sirve desde la caché en disco (/thumbs)
+    return {
+        'filename': filename,
+        'thumbnail': thumbnail_cache.url(filename),
+        'is_video': False,
+        'info': serializable_info
+    }
+
+def iter_items(expo_id, filenames):
+    """
+    Inspecciona los ficheros en paralelo (MediaInspector + MetadataCache) y devuelve las
+    entradas de la galería según van estando listas. Al terminar guarda la caché de metadatos
+    y lanza la generación de las previsualizaciones de vídeo que falten.
+    """
+    output_path = os.path.join(os.getcwd(), 'expos', expo_id, 'ficheros_salida')
+    thumbnail_cache = ThumbnailCache(expo_id)
+    preview_cache = VideoPreviewCache(expo_id)
+    metadata_cache = MetadataCache.for_expo(expo_id)
+    index = ExpoIndex.for_expo(expo_id)
+    previews_pendientes = False
+
+    paths = [os.path.join(output_path, filename) for filename in filenames]
+    try:
+        for file_path, file_info in MediaInspector().iter_files(paths, inspector=index.get_info):
+            filename = os.path.basename(file_path)
+            try:
+                item = construir_item(expo_id, filename, file_info, thumbnail_cache, preview_cache)
+            except Exception as e:
+                log.error("Error processing file %s: %s", filename, e)
+                continue
+            if item is None:
+                continue
+            if item['is_video']:
+                previews_pendientes = previews_pendientes or preview_cache.pending(filename)
+            yield item
+    finally:
+        metadata_cache.save()
+        if previews_pendientes:
+            preview_cache.build_in_background()
+
+def respuesta_sin_listado(expo_id):
+    """
+    Respuesta de /load_images cuando no hay nada que listar: (dict, código HTTP), o None si
+    existe ficheros_salida y se puede listar.
+    """
+    if not expo_id:
+        return {'error': 'No se proporcionó ID de exposición'}, 400
+
+    expo_path = os.path.join(os.getcwd(), 'expos', expo_id)
+    if not os.path.exists(expo_path):
+        return {'error': f'No existe la carpeta para la exposición {expo_id}'}, 404
+    if os.path.exists(os.path.join(expo_path, 'ficheros_salida')):
+        return None
+
+    # Buscar archivos ZIP si no existe ficheros_salida
+    zip_files = [f for f in os.listdir(expo_path) if f.lower().endswith('.zip')]
+    if zip_files:
+        return {'status': 'ask_unzip', 'zip_files': zip_files}, 200
+    return {'error': 'La carpeta no contiene archivos ZIP para descomprimir'}, 404
+
 @app.route('/load_images', methods=['POST'])
 def load_images():
+    """
+    Listado de la galería. Sin `limit` devuelve todos los ficheros; con `limit` (y `cursor`,
+    el último nombre de la página anterior) devuelve una página y `next_cursor`.
+    """
     try:
         expo_id = request.form.get('expo_id')
-        if not expo_id:
-            return jsonify({
-                'error': 'No se proporcionó ID de exposición'
-            }), 400
+        respuesta = respuesta_sin_listado(expo_id)
+        if respuesta is not None:
+            return jsonify(respuesta[0]), respuesta[1]
 
-        expo_path = os.path.join(os.getcwd(), 'expos', expo_id)
-        output_path = os.path.join(expo_path, 'ficheros_salida')
-        
-        if not os.path.exists(expo_path):
-            return jsonify({
-                'error': f'No existe la carpeta para la exposición {expo_id}'
-            }), 404
-        
-        if os.path.exists(output_path):
-            images = []
-            for filename in os.listdir(output_path):
-                try:
-                    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.mp4')):
-                        file_path = os.path.join(output_path, filename)
-                        
-                        # Obtener información del archivo según su tipo
-                        if filename.lower().endswith('.mp4'):
-                            file_info = VideoInfo.get_video_info(file_path)
-                            image_data = {
-                                'filename': filename,
-                                'is_video': True,
-                                'info': {k: convert_to_serializable(v) for k, v in file_info.items()}
-                            }
-                        else:
-                            try:
-                                with Image.open(file_path) as img:
-                                    # Crear miniatura
-                                    img.thumbnail((200, 200))
-                                    # Convertir a base64
-                                    buffered = io.BytesIO()
-                                    img.save(buffered, format=img.format)
-                                    img_str = base64.b64encode(buffered.getvalue()).decode()
-                                    thumbnail = f"data:image/{img.format.lower()};base64,{img_str}"
-                                    
-                                    file_info = ImageInfo.get_image_info(file_path)
-                                    # Convertir valores no serializables
-                                    serializable_info = {k: convert_to_serializable(v) for k, v in file_info.items()}
-                                    
-                                    image_data = {
-                                        'filename': filename,
-                                        'thumbnail': thumbnail,
-                                        'is_video': False,
-                                        'info': serializable_info
-                                    }
-                            except Exception as e:
-                                print(f"Error processing image {filename}: {str(e)}")
-                                continue
-                        
-                        images.append(image_data)
-                except Exception as e:
-                    print(f"Error processing file {filename}: {str(e)}")
-                    continue
-            
-            return jsonify({
-                'status': 'show_images',
-                'images': images
-            })
-        
-        # Buscar archivos ZIP si no existe ficheros_salida
-        zip_files = [f for f in os.listdir(expo_path) if f.lower().endswith('.zip')]
-        if zip_files:
-            return jsonify({
-                'status': 'ask_unzip',
-                'zip_files': zip_files
-            })
-        
+        filenames = listar_media(expo_id)
+        cursor = request.form.get('cursor')
+        if cursor:
+            filenames = [f for f in filenames if f > cursor]
+        limit = request.form.get('limit', type=int)
+        next_cursor = None
+        if limit and len(filenames) > limit:
+            filenames = filenames[:limit]
+            next_cursor = filenames[-1]
+
+        # iter_items devuelve en orden de llegada; la página se devuelve en orden de nombre
+        images = sorted(iter_items(expo_id, filenames), key=lambda item: item['filename'])
         return jsonify({
-            'error': 'La carpeta no contiene archivos ZIP para descomprimir'
-        }), 404
+            'status': 'show_images',
+            'images': images,
+            'next_cursor': next_cursor
+        })
 
     except Exception as e:
-        print(f"Error in load_images: {str(e)}")
+        log.exception("Error in load_images: %s", e)
         return jsonify({
             'error': f'Error interno del servidor: {str(e)}'
         }), 500
 
+@app.route('/load_images/stream', methods=['GET', 'POST'])
+def load_images_stream():
+    """
+    Variante en streaming (NDJSON) de /load_images: una primera línea con el estado y el total,
+    una línea por fichero en cuanto sus metadatos están listos (los que ya están en la caché
+    salen de inmediato) y una línea final {"status": "done"}.
+    """
+    try:
+        expo_id = request.values.get('expo_id')
+        respuesta = respuesta_sin_listado(expo_id)
+        if respuesta is not None:
+            return jsonify(respuesta[0]), respuesta[1]
+        filenames = listar_media(expo_id)
+    except Exception as e:
+        log.exception("Error in load_images_stream: %s", e)
+        return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
+
+    def generar():
+        yield json.dumps({'status': 'show_images', 'total': len(filenames)}) + '\n'
+        try:
+            for item in iter_items(expo_id, filenames):
+                yield json.dumps(item) + '\n'
+        except Exception as e:
+            log.exception("Error in load_images_stream: %s", e)
+            yield json.dumps({'error': f'Error interno del servidor: {str(e)}'}) + '\n'
+            return
+        yield json.dumps({'status': 'done'}) + '\n'
+
+    response = Response(generar(), mimetype='application/x-ndjson')
+    # Que ningún proxy intermedio acumule la respuesta
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.cache_control.no_cache = True
+    return response
+
+def servir_media(directory, filename, max_age=0, inmutable=False):
+    '''
+    Sirve un fichero multimedia con peticiones Range (206), ETag y Last-Modified (304).
+    Con gunicorn el cuerpo se envía con sendfile() a través de wsgi.file_wrapper; detrás de
+    nginx/Apache se puede delegar con X-Sendfile (EXPO_X_SENDFILE=1).
+    '''
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'Fichero no encontrado'}), 404
+    response = send_file(path, conditional=True, etag=True, max_age=max_age)
+    response.cache_control.public = True
+    if inmutable:
+        response.cache_control.immutable = True
+    elif not max_age:
+        # Sin versión: el navegador revalida siempre, pero con 304 si no ha cambiado
+        response.cache_control.no_cache = True
+    return response
+
 @app.route('/expos/<expo_id>/ficheros_salida/<filename>')
 def serve_file(expo_id, filename):
     directory = os.path.join(os.getcwd(), 'expos', expo_id, 'ficheros_salida')
-    return send_from_directory(directory, filename)
+    return servir_media(directory, filename)
+
+@app.route('/expos/<expo_id>/procesados/<filename>')
+def serve_processed_file(expo_id, filename):
+    # Las salidas recodificadas no se modifican: si la URL lleva su huella, se cachean un año
+    directory = os.path.join(os.getcwd(), 'expos', expo_id, 'procesados')
+    path = safe_join(directory, filename)
+    versionada = (path is not None and os.path.isfile(path)
+                  and request.args.get('v') == ColaRecodificacion.huella(path))
+    return servir_media(directory, filename,
+                        max_age=CACHE_INMUTABLE if versionada else 3600,
+                        inmutable=versionada)
+
+@app.route('/thumbs/<expo_id>/<filename>')
+def serve_thumbnail(expo_id, filename):
+    thumb_path, key = ThumbnailCache(expo_id).get(filename)
+    if thumb_path is None:
+        return jsonify({'error': 'Miniatura no disponible'}), 404
+
+    # URL versionada: el contenido para esta clave no cambia nunca
+    versionada = request.args.get('v') == key
+    response = send_file(thumb_path, mimetype='image/jpeg', etag=key, conditional=True,
+                         max_age=CACHE_INMUTABLE if versionada else 0)
+    response.cache_control.public = True
+    if versionada:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/previews/<expo_id>/<tipo>/<filename>')
+def serve_preview(expo_id, tipo, filename):
+    if tipo not in VideoPreviewCache.TIPOS:
+        return jsonify({'error': 'Tipo de previsualización no válido'}), 404
+    # El póster se genera al vuelo si aún no existe; el proxy solo se sirve cuando está listo
+    preview_path, key = VideoPreviewCache(expo_id).get(filename, tipo, generar=(tipo == VideoPreviewCache.POSTER))
+    if preview_path is None:
+        return jsonify({'error': 'Previsualización no disponible'}), 404
+
+    versionada = request.args.get('v') == key
+    mimetype = 'image/jpeg' if tipo == VideoPreviewCache.POSTER else 'video/mp4'
+    response = send_file(preview_path, mimetype=mimetype, etag=key, conditional=True,
+                         max_age=CACHE_INMUTABLE if versionada else 0)
+    response.cache_control.public = True
+    if versionada:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 @app.route('/process_expo', methods=['POST'])
 def process_expo_endpoint():
@@ -157,22 +281,22 @@ def process_expo_endpoint():
             zip_files = glob.glob(os.path.join(processor.full_output_path, "*.zip"))
             
             if zip_files:
+                metricas = Metricas.for_expo(expo_id)
+                metricas.nueva_ejecucion()
                 processor.setup_directories()
                 processor.unzip_files()
                 processor.process_and_move_files()
+                # ficheros_salida acaba de cambiar: no esperar al vigilante del índice
+                ExpoIndex.for_expo(expo_id).rescan()
+
+                # Generar las miniaturas en segundo plano para que /load_images no tenga que esperar
+                ThumbnailCache(expo_id).build_in_background()
+                VideoPreviewCache(expo_id).build_in_background()
                 
-                # Copiar contenido a la carpeta 'originales'
-                if not os.path.exists(originales_path):
-                    os.makedirs(originales_path)
-                
-                # Copiar todos los archivos de ficheros_salida a originales
-                for item in os.listdir(output_path):
-                    s = os.path.join(output_path, item)
-                    d = os.path.join(originales_path, item)
-                    if os.path.isfile(s):
-                        shutil.copy2(s, d)
-                    else:
-                        shutil.copytree(s, d, dirs_exist_ok=True)
+                # Copia de seguridad en 'originales': enlaces duros cuando se puede, así no se
+                # vuelve a escribir cada obra en disco
+                with metricas.etapa('copia_seguridad') as medida:
+                    medida['ficheros'] = sum(FileManager.backup_files(output_path, originales_path).values())
                 
                 # Borrar la carpeta 'varios' si existe
                 varios_path = os.path.join(output_path, 'varios')
@@ -196,12 +320,11 @@ def get_images(expo_id):
             return jsonify({'status': 'error', 'message': 'Output folder not found'}), 404
             
         files = []
-        for file in os.listdir(output_path):
-            if file.lower().endswith(('.mp4', '.jpg', '.jpeg', '.png')):
-                files.append({
-                    'filename': file,
-                    'is_video': file.lower().endswith('.mp4')
-                })
+        for file in listar_media(expo_id):
+            files.append({
+                'filename': file,
+                'is_video': file.lower().endswith('.mp4')
+            })
         
         return jsonify({
             'status': 'show_images',
@@ -211,85 +334,95 @@ def get_images(expo_id):
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def stream_trabajo(trabajo):
+    """Generador SSE que observa un trabajo (recodificación o plan) sin controlarlo."""
+    version = -1
+    while True:
+        version = trabajo.esperar_cambio(version, timeout=15)
+        evento = trabajo.snapshot()
+        if evento['status'] == 'error':
+            yield f"data: {json.dumps({'error': evento['error']})}\n\n"
+            return
+        yield f"data: {json.dumps(evento)}\n\n"
+        if evento['status'] == 'completed':
+            return
+
 @app.route('/recodificar', methods=['POST'])
 def recodificar_endpoint():
     try:
-        print("Recibida petición de recodificación")
+        log.debug("Recibida petición de recodificación")
         data = request.json
         expo_id = data.get('expo_id')
         
         if not expo_id:
             return jsonify({'error': 'No se proporcionó ID de exposición'}), 400
-            
-        recodificador = Recodificador(expo_id)
-        
-        def generate():
-            try:
-                recodificador.crear_carpeta_procesados()
-                files_to_process = []
-                
-                # Obtener lista de archivos
-                for root, _, files in os.walk(recodificador.carpeta_origen):
-                    for file in files:
-                        if file.lower().endswith(('.mp4', '.jpg', '.jpeg', '.png')):
-                            file_path = os.path.join(root, file)
-                            files_to_process.append(file_path)
-
-                total_files = len(files_to_process)
-                print(f"Total archivos a procesar: {total_files}")
-
-                # Iniciar pool de procesos
-                with Pool(processes=recodificador.max_workers) as pool:
-                    # Iniciar todos los procesos
-                    results = [pool.apply_async(recodificador.process_file, (file_path,)) 
-                             for file_path in files_to_process]
-                    
-                    # Monitorear progreso
-                    while any(not r.ready() for r in results):
-                        try:
-                            with open(recodificador.progress_file, 'r') as f:
-                                progress_dict = json.load(f)
-                            
-                            if progress_dict:
-                                total_progress = sum(progress_dict.values()) / total_files
-                                current_files = ', '.join([f for f, p in progress_dict.items() if p < 100])
-                                
-                                progress_data = {
-                                    'status': 'processing',
-                                    'progress': total_progress,
-                                    'current_files': current_files
-                                }
-                                yield f"data: {json.dumps(progress_data)}\n\n"
-                        except Exception as e:
-                            print(f"Error leyendo progreso: {e}")
-                        
-                        time.sleep(1)
-                    
-                    # Verificar resultados
-                    for r in results:
-                        r.get()  # Esto lanzará cualquier excepción que haya ocurrido
-
-                completion_data = {'status': 'completed'}
-                yield f"data: {json.dumps(completion_data)}\n\n"
-                
-            except Exception as e:
-                print(f"Error en generate: {str(e)}")
-                error_data = {'error': str(e)}
-                yield f"data: {json.dumps(error_data)}\n\n"
-            finally:
-                if os.path.exists(recodificador.progress_file):
-                    os.remove(recodificador.progress_file)
-
-        return Response(generate(), mimetype='text/event-stream')
+        if TrabajoPlan.en_curso(expo_id):
+            return jsonify({'status': 'error', 'message': 'Se está calculando el plan de recodificación'}), 409
+
+        # El trabajo vive fuera de la petición: si ya hay uno en marcha, solo nos enganchamos a él
+        trabajo = TrabajoRecodificacion.iniciar(expo_id, data.get('perfil'))
+        return Response(stream_trabajo(trabajo), mimetype='text/event-stream')
         
     except Exception as e:
-        print(f"Error en recodificar_endpoint: {str(e)}")
+        log.exception("Error en recodificar_endpoint: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/recodificar/plan', methods=['POST'])
+def recodificar_plan():
+    # Estimación por muestras de tamaño, tasa y tiempo antes de lanzar /recodificar. Se calcula en
+    # segundo plano (TrabajoPlan) y el progreso y el plan llegan por SSE
+    try:
+        data = request.json or {}
+        expo_id = data.get('expo_id')
+        if not expo_id:
+            return jsonify({'error': 'No se proporcionó ID de exposición'}), 400
+        trabajo = TrabajoRecodificacion.obtener(expo_id)
+        if trabajo is not None and trabajo.activo:
+            return jsonify({'status': 'error', 'message': 'Ya hay una recodificación en curso'}), 409
+        if not os.path.isdir(os.path.join(os.getcwd(), 'expos', expo_id, 'ficheros_salida')):
+            return jsonify({'status': 'error', 'message': 'Output folder not found'}), 404
+        trabajo = TrabajoPlan.iniciar(expo_id, data.get('perfil'), bool(data.get('forzar')))
+        return Response(stream_trabajo(trabajo), mimetype='text/event-stream')
+    except Exception as e:
+        log.exception("Error en recodificar_plan: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/recodificar/<expo_id>/eventos')
+def recodificar_eventos(expo_id):
+    trabajo = TrabajoRecodificacion.obtener(expo_id)
+    if trabajo is None:
+        return jsonify({'status': 'error', 'message': 'No hay ninguna recodificación en curso'}), 404
+    return Response(stream_trabajo(trabajo), mimetype='text/event-stream')
+
+@app.route('/recodificar/<expo_id>/estado')
+def recodificar_estado(expo_id):
+    try:
+        trabajo = TrabajoRecodificacion.obtener(expo_id)
+        if trabajo is not None:
+            return jsonify({'activo': trabajo.activo, **trabajo.snapshot()})
+        return jsonify(TrabajoRecodificacion.estado_guardado(expo_id))
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/recodificar/planificador')
+def recodificar_planificador():
+    # Colas, unidades de CPU en uso y utilización del planificador compartido por todas las expos
+    return jsonify(PlanificadorCodificacion.global_().estadisticas())
+
+@app.route('/metrics')
+def metrics():
+    # Tiempos y contadores por etapa y exposición de este proceso, en formato Prometheus
+    return Response(Metricas.prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/informe/<expo_id>')
+def informe_ejecucion(expo_id):
+    # Informe de la última ejecución de la exposición (también en expos/<id>/informe_ejecucion.json)
+    return jsonify(Metricas.for_expo(expo_id).informe)
+
 # Asegurarse de que todas las rutas estén registradas
-print("Rutas registradas en la aplicación:")
+log.debug("Rutas registradas en la aplicación:")
 for rule in app.url_map.iter_rules():
-    print(f"{rule.endpoint}: {rule.methods} - {rule}")
+    log.debug("%s: %s - %s", rule.endpoint, rule.methods, rule)
 
 # Iniciar la aplicación
 if __name__ == '__main__':
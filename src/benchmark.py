@@ -0,0 +1,590 @@
+'''
+Benchmarks de las partes costosas del pipeline.
+
+Uso:
+    python benchmark.py imagenes --carpeta /tmp/bench_imagenes --n 20
+    python benchmark.py perfiles --carpeta /tmp/bench_perfiles --duracion 10 [--guardar]
+    python benchmark.py copia --carpeta /tmp/bench_copia --gb 5
+    python benchmark.py conformar --carpeta /tmp/bench_conformar --n 100
+    python benchmark.py resumen --carpeta /tmp/bench_resumen --filas 10000
+    python benchmark.py segmentado --carpeta /tmp/bench_segmentado --duracion 120
+    python benchmark.py fusionado --carpeta /tmp/bench_fusionado --duracion 30
+    python benchmark.py prediccion --carpeta /tmp/bench_prediccion --duracion 60
+
+Cada subcomando genera sus propios ficheros sintéticos en la carpeta indicada,
+así que no hace falta tener una exposición real a mano.
+'''
+import os
+import sys
+import time
+import argparse
+import statistics
+import shutil
+import subprocess
+
+import pandas as pd
+
+from PIL import Image
+
+from main import (FileManager, ImageLoader, ImageInfo, VideoInfo, FFmpegRunner, PerfilCodificacion, ConformadorImagen,
+                  ResumenExcel, CodificacionSegmentada, VideoPreviewCache, GrafoFusionado, Recodificador,
+                  PlanRecodificacion)
+
+
+def _medir(funcion, rutas):
+    '''Ejecuta `funcion` sobre cada ruta y devuelve los tiempos en milisegundos.'''
+    tiempos = []
+    for ruta in rutas:
+        inicio = time.perf_counter()
+        funcion(ruta)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return tiempos
+
+
+def _imprimir_fila(nombre, tiempos, memoria_mb=None):
+    media = statistics.mean(tiempos)
+    mediana = statistics.median(tiempos)
+    memoria = f"{memoria_mb:10.1f}" if memoria_mb is not None else f"{'-':>10}"
+    print(f"{nombre:<38}{media:10.2f}{mediana:10.2f}{memoria}")
+
+
+# --- Imágenes ---------------------------------------------------------------
+
+def generar_imagenes(carpeta, n, tamano=(3840, 2160)):
+    '''Genera n imágenes 4K (mitad JPEG, mitad PNG) con ruido para que no compriman trivialmente.'''
+    os.makedirs(carpeta, exist_ok=True)
+    rutas = []
+    for i in range(n):
+        extension = 'jpg' if i % 2 == 0 else 'png'
+        ruta = os.path.join(carpeta, f"BENCH_P{i + 1:03d}_obra.{extension}")
+        if not os.path.exists(ruta):
+            ruido = Image.effect_noise(tamano, 64).convert('RGB')
+            degradado = Image.linear_gradient('L').resize(tamano).convert('RGB')
+            img = Image.blend(ruido, degradado, 0.5)
+            if extension == 'jpg':
+                img.save(ruta, 'JPEG', quality=90)
+            else:
+                img.save(ruta, 'PNG', compress_level=1)
+        rutas.append(ruta)
+    return rutas
+
+
+def _memoria_decodificada_mb(img):
+    '''Tamaño del buffer de píxeles realmente decodificado.'''
+    return img.size[0] * img.size[1] * len(img.getbands()) / (1024 * 1024)
+
+
+def _metadatos_decodificando(ruta):
+    # Comportamiento anterior: se decodificaba la imagen completa
+    with Image.open(ruta) as img:
+        img.load()
+        return img.size
+
+
+def _miniatura_decodificando(ruta):
+    # Comportamiento anterior: decodificación completa y thumbnail sin draft
+    with Image.open(ruta) as img:
+        img.load()
+        img.thumbnail((200, 200), reducing_gap=None)
+        return img
+
+
+def benchmark_imagenes(args):
+    rutas = generar_imagenes(args.carpeta, args.n)
+    jpegs = [r for r in rutas if r.endswith('.jpg')]
+    pngs = [r for r in rutas if r.endswith('.png')]
+
+    print(f"{len(jpegs)} JPEG y {len(pngs)} PNG de 3840x2160 en {args.carpeta}\n")
+    print(f"{'Operación':<38}{'media ms':>10}{'mediana':>10}{'RAM MB':>10}")
+
+    for etiqueta, grupo in (('JPEG', jpegs), ('PNG', pngs)):
+        if not grupo:
+            continue
+        with Image.open(grupo[0]) as img:
+            img.load()
+            memoria_completa = _memoria_decodificada_mb(img)
+        with Image.open(grupo[0]) as img:
+            # Mismo draft que ImageLoader; en PNG no hay decodificación parcial posible
+            if img.format == 'JPEG':
+                escala = 200 / max(img.size)
+                img.draft('RGB', (int(img.size[0] * escala * 2), int(img.size[1] * escala * 2)))
+            img.load()
+            memoria_preview = _memoria_decodificada_mb(img)
+
+        _imprimir_fila(f"{etiqueta} metadatos (decodificando)", _medir(_metadatos_decodificando, grupo), memoria_completa)
+        _imprimir_fila(f"{etiqueta} metadatos (solo cabecera)", _medir(ImageInfo.get_image_info, grupo), 0)
+        _imprimir_fila(f"{etiqueta} miniatura (decodificando)", _medir(_miniatura_decodificando, grupo), memoria_completa)
+        _imprimir_fila(f"{etiqueta} miniatura (ImageLoader)", _medir(ImageLoader.load_preview, grupo), memoria_preview)
+
+
+# --- Perfiles de codificación -----------------------------------------------
+
+# Límites superiores de las pantallas Samsung QB43C/QB75C (instructions/hardware.md e instructions.md)
+CODECS_PERMITIDOS = ('h264', 'hevc')
+FPS_MAXIMO = 30
+BITRATE_MAXIMO_MBPS = 60
+
+
+def generar_clip_prueba(carpeta, duracion, resolucion):
+    '''Clip sintético con testsrc2 y ruido temporal, para que el codificador tenga trabajo real.'''
+    os.makedirs(carpeta, exist_ok=True)
+    ruta = os.path.join(carpeta, f"clip_prueba_{resolucion}_{duracion}s.mp4")
+    if not os.path.exists(ruta):
+        print(f"Generando clip de prueba {resolucion} de {duracion}s...")
+        subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f"testsrc2=size={resolucion}:rate=30",
+            '-t', str(duracion),
+            '-vf', 'noise=alls=12:allf=t',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '12', '-pix_fmt', 'yuv420p',
+            '-y', ruta
+        ], check=True)
+    return ruta
+
+
+def _codec_salida(perfil, ruta):
+    info = VideoInfo.get_video_info(ruta)
+    if info:
+        return info['CÓDEC_VIDEO']
+    # Sin ffprobe: se deduce del codificador usado
+    return 'hevc' if ('265' in perfil.codec or 'hevc' in perfil.codec) else 'h264'
+
+
+def benchmark_perfiles(args):
+    clip = generar_clip_prueba(args.carpeta, args.duracion, args.resolucion)
+    nombres = args.perfiles or PerfilCodificacion.disponibles()
+    hilos = args.hilos or os.cpu_count() or 1
+
+    print(f"Clip: {clip} ({args.duracion}s, {args.resolucion}), {hilos} hilos por codificación\n")
+    print(f"{'Perfil':<20}{'fps':>8}{'tiempo s':>10}{'MB':>9}{'Mbps':>8}  cumple")
+
+    resultados = []
+    for nombre in nombres:
+        perfil = PerfilCodificacion.get(nombre)
+        if not perfil.hardware:
+            perfil.threads = hilos
+        salida = os.path.join(args.carpeta, f"salida_{nombre}.mp4")
+        runner = FFmpegRunner(perfil.comando(clip, salida), duration=args.duracion, label=nombre)
+        inicio = time.perf_counter()
+        return_code = runner.run()
+        tiempo = time.perf_counter() - inicio
+        if return_code != 0:
+            print(f"{nombre:<20} error: {runner.stderr_tail[-1] if runner.stderr_tail else return_code}")
+            continue
+
+        frames = runner.last_progress.get('frame') or args.duracion * FPS_MAXIMO
+        tamano_mb = os.path.getsize(salida) / (1024 * 1024)
+        mbps = os.path.getsize(salida) * 8 / args.duracion / 1_000_000
+        cumple = (_codec_salida(perfil, salida) in CODECS_PERMITIDOS
+                  and perfil.comunes['fps'] <= FPS_MAXIMO
+                  and mbps <= BITRATE_MAXIMO_MBPS)
+        resultados.append((nombre, frames / tiempo, tiempo, tamano_mb, mbps, cumple))
+        print(f"{nombre:<20}{frames / tiempo:8.1f}{tiempo:10.1f}{tamano_mb:9.1f}{mbps:8.1f}  {'sí' if cumple else 'no'}")
+
+    validos = sorted((r for r in resultados if r[5]), key=lambda r: r[2])
+    if not validos:
+        print("\nNingún perfil cumple las especificaciones.")
+        return
+    mejor = validos[0]
+    print(f"\nPerfil más rápido que cumple las especificaciones: {mejor[0]} ({mejor[1]:.1f} fps)")
+    if args.guardar:
+        PerfilCodificacion.guardar_seleccion(mejor[0], {'fps': round(mejor[1], 1), 'hilos': hilos})
+        print(f"Guardado en {PerfilCodificacion.FICHERO_SELECCION}")
+
+
+# --- Copia de seguridad de originales ----------------------------------------
+
+def generar_expo(carpeta, gb, n_ficheros):
+    '''Expo sintética de `gb` GB repartidos en n ficheros (datos aleatorios, no dispersos).'''
+    os.makedirs(carpeta, exist_ok=True)
+    tamano = int(gb * 1024 ** 3) // n_ficheros
+    bloque = os.urandom(8 * 1024 * 1024)
+    rutas = []
+    for i in range(n_ficheros):
+        ruta = os.path.join(carpeta, f"BENCH_P{i + 1:03d}_video.mp4")
+        if not os.path.exists(ruta) or os.path.getsize(ruta) != tamano:
+            with open(ruta, 'wb') as f:
+                escritos = 0
+                while escritos < tamano:
+                    parte = bloque[:tamano - escritos]
+                    f.write(parte)
+                    escritos += len(parte)
+        rutas.append(ruta)
+    return rutas
+
+
+def benchmark_copia(args):
+    origen = os.path.join(args.carpeta, 'ficheros_salida')
+    print(f"Generando expo sintética de {args.gb} GB en {args.ficheros} ficheros...")
+    generar_expo(origen, args.gb, args.ficheros)
+    print(f"Expo: {origen}\n")
+    print(f"{'Modo':<12}{'tiempo s':>10}{'GB usados':>11}  ficheros")
+
+    for modo in FileManager.BACKUP_MODES:
+        destino = os.path.join(args.carpeta, f"originales_{modo}")
+        shutil.rmtree(destino, ignore_errors=True)
+        os.sync()
+        libre_antes = shutil.disk_usage(args.carpeta).free
+        inicio = time.perf_counter()
+        try:
+            resultado = FileManager.backup_files(origen, destino, modo=modo)
+        except OSError as e:
+            print(f"{modo:<12} no disponible en este sistema de ficheros ({e})")
+            shutil.rmtree(destino, ignore_errors=True)
+            continue
+        os.sync()
+        tiempo = time.perf_counter() - inicio
+        usados = (libre_antes - shutil.disk_usage(args.carpeta).free) / 1024 ** 3
+        print(f"{modo:<12}{tiempo:10.2f}{usados:11.2f}  {sum(resultado.values())}")
+        shutil.rmtree(destino, ignore_errors=True)
+
+    # Los enlaces duros dejan los ficheros en solo lectura; se restauran para poder borrarlos o reutilizarlos
+    for nombre in os.listdir(origen):
+        ruta = os.path.join(origen, nombre)
+        os.chmod(ruta, os.stat(ruta).st_mode | 0o200)
+
+
+# --- Conformado de imágenes a las pantallas ----------------------------------
+
+TAMANOS_8K = [(7680, 4320), (4320, 7680), (8192, 5464), (6144, 8192)]
+
+
+def generar_imagenes_8k(carpeta, n):
+    '''n imágenes de ~8K en varias proporciones (1 de cada 5 en PNG), para ejercitar las bandas negras.'''
+    os.makedirs(carpeta, exist_ok=True)
+    rutas = []
+    for i in range(n):
+        tamano = TAMANOS_8K[i % len(TAMANOS_8K)]
+        extension = 'png' if i % 5 == 4 else 'jpg'
+        ruta = os.path.join(carpeta, f"BENCH_P{i + 1:03d}_8k.{extension}")
+        if not os.path.exists(ruta):
+            # Ruido a 1/4 de resolución ampliado: se genera rápido y no comprime trivialmente
+            pequeno = (tamano[0] // 4, tamano[1] // 4)
+            ruido = Image.effect_noise(pequeno, 64).convert('RGB')
+            degradado = Image.linear_gradient('L').resize(pequeno).convert('RGB')
+            img = Image.blend(ruido, degradado, 0.5).resize(tamano, Image.Resampling.BILINEAR)
+            if extension == 'jpg':
+                img.save(ruta, 'JPEG', quality=90)
+            else:
+                img.save(ruta, 'PNG', compress_level=1)
+        rutas.append(ruta)
+    return rutas
+
+
+def _conformar_anterior(ruta, carpeta_destino):
+    # Comportamiento anterior: decodificación completa, estirado a la pantalla y JPEG optimize + progressive
+    with Image.open(ruta) as img:
+        ancho, alto = img.size
+        pantalla = (3840, 2160) if ancho > alto else (2160, 3840)
+        salida = img.convert('RGB').resize(pantalla, Image.Resampling.LANCZOS)
+    nombre = os.path.splitext(os.path.basename(ruta))[0] + ConformadorImagen.SUFIJO
+    salida.save(os.path.join(carpeta_destino, nombre), 'JPEG', quality=85, optimize=True, dpi=(72, 72), progressive=True)
+
+
+def benchmark_conformar(args):
+    rutas = generar_imagenes_8k(os.path.join(args.carpeta, 'origen'), args.n)
+    destino = os.path.join(args.carpeta, 'procesados')
+    procesos = args.procesos or os.cpu_count() or 1
+
+    print(f"{len(rutas)} imágenes de ~8K en {args.carpeta}\n")
+    print(f"{'Método':<38}{'imágenes':>10}{'tiempo s':>10}{'img/s':>10}")
+
+    def fila(nombre, funcion, grupo):
+        shutil.rmtree(destino, ignore_errors=True)
+        os.makedirs(destino)
+        inicio = time.perf_counter()
+        funcion(grupo)
+        tiempo = time.perf_counter() - inicio
+        print(f"{nombre:<38}{len(grupo):10d}{tiempo:10.2f}{len(grupo) / tiempo:10.2f}")
+
+    muestra = rutas[:args.muestra_anterior]
+    if muestra:
+        fila("Anterior (estirado, 1 hilo)", lambda grupo: [_conformar_anterior(r, destino) for r in grupo], muestra)
+    fila("ConformadorImagen (1 proceso)", lambda grupo: [ConformadorImagen.procesar(r, destino) for r in grupo], muestra or rutas)
+    fila(f"ConformadorImagen ({procesos} procesos)",
+         lambda grupo: ConformadorImagen.procesar_lote(grupo, destino, procesos=procesos), rutas)
+
+    # Todas las salidas deben tener exactamente la resolución de una pantalla
+    incorrectas = []
+    for nombre in os.listdir(destino):
+        with Image.open(os.path.join(destino, nombre)) as img:
+            if img.size not in ConformadorImagen.RESOLUCIONES:
+                incorrectas.append(f"{nombre} {img.size[0]}x{img.size[1]}")
+    print(f"\nSalidas con resolución de pantalla: {len(os.listdir(destino)) - len(incorrectas)}/{len(os.listdir(destino))}")
+    for incorrecta in incorrectas:
+        print(f"  {incorrecta}")
+
+
+# --- Resumen Excel -------------------------------------------------------------
+
+def generar_resumen(filas):
+    '''
+    Resumen sintético de `filas` obras (mitad imágenes, mitad vídeos) y los metadatos de su
+    carpeta procesados: la mitad de las imágenes conformadas (<nombre>_procesado.jpg).
+    '''
+    obras, procesados = [], []
+    for i in range(filas):
+        video = i % 2 == 1
+        nombre = f"BENCH_P{i % 1000:03d}_obra_{i:05d}.{'mp4' if video else 'jpg'}"
+        info = {'ANCHO': 3840, 'ALTO': 2160, 'ORIENTACION': 'H', 'FORMATO': 'mp4' if video else 'JPEG',
+                'TAMAÑO_MB': round(1 + i % 97 * 0.37, 2), 'NOMBRE_ARCHIVO': nombre,
+                'NUMERO_PANTALLA': i % 1000, 'TIPO': 'Video' if video else 'Imagen'}
+        if video:
+            info.update({'DURACION_SEG': 30 + i % 60, 'FPS': 30.0, 'TASA_BITS': 45_000_000, 'CÓDEC_VIDEO': 'hevc'})
+        else:
+            info.update({'RESOLUCION_X': 72, 'RESOLUCION_Y': 72})
+        obras.append(info)
+        salida = dict(info, TAMAÑO_MB=round(info['TAMAÑO_MB'] * 0.6, 2))
+        if not video and i % 4 == 0:
+            salida['NOMBRE_ARCHIVO'] = os.path.splitext(nombre)[0] + ConformadorImagen.SUFIJO
+        procesados.append(salida)
+    return pd.DataFrame(obras), pd.DataFrame(procesados)
+
+
+def _escribir_anterior(df, ruta):
+    # Comportamiento anterior: pandas escribe, openpyxl recarga, añade la tabla y recorre cada celda
+    from openpyxl import load_workbook
+    from openpyxl.worksheet.table import Table, TableStyleInfo
+    df.to_excel(ruta, index=False)
+    wb = load_workbook(ruta)
+    ws = wb.active
+    tabla = Table(displayName="TablaObras", ref=f"A1:{chr(64 + len(df.columns))}{len(df.index) + 1}")
+    tabla.tableStyleInfo = TableStyleInfo(name="TableStyleMedium2", showRowStripes=True)
+    ws.add_table(tabla)
+    for column in ws.columns:
+        column = list(column)
+        ws.column_dimensions[column[0].column_letter].width = max(len(str(c.value)) for c in column) + 2
+    wb.save(ruta)
+
+
+def _combinar_anterior(df, procesados):
+    # Comportamiento anterior: iterrows y df.at fila a fila
+    df = df.copy()
+    nuevos_datos = {row['NOMBRE_ARCHIVO']: row for _, row in procesados.iterrows()}
+    columnas = [c + ResumenExcel.SUFIJO_RECODIFICADO for c in ResumenExcel.COLUMNAS_RECODIFICADAS]
+    for columna in columnas:
+        if columna not in df.columns:
+            df[columna] = None
+    for index, row in df.iterrows():
+        nombre = os.path.splitext(row['NOMBRE_ARCHIVO'])[0] + ConformadorImagen.SUFIJO
+        if nombre not in nuevos_datos:
+            nombre = row['NOMBRE_ARCHIVO']
+        if nombre in nuevos_datos:
+            df.at[index, 'PROCESADO'] = 'Sí'
+            for columna in columnas:
+                original = columna.replace(ResumenExcel.SUFIJO_RECODIFICADO, '')
+                if original in nuevos_datos[nombre]:
+                    df.at[index, columna] = nuevos_datos[nombre][original]
+        else:
+            df.at[index, 'PROCESADO'] = 'No'
+    return df
+
+
+def benchmark_resumen(args):
+    os.makedirs(args.carpeta, exist_ok=True)
+    df, procesados = generar_resumen(args.filas)
+    print(f"Resumen sintético de {len(df)} filas y {len(df.columns)} columnas en {args.carpeta}\n")
+    print(f"{'Operación':<38}{'tiempo s':>10}")
+
+    def fila(nombre, funcion):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        print(f"{nombre:<38}{time.perf_counter() - inicio:10.2f}")
+        return resultado
+
+    anterior = fila("Combinar (iterrows + df.at)", lambda: _combinar_anterior(df, procesados))
+    nuevo = fila("Combinar (ResumenExcel.combinar)", lambda: ResumenExcel.combinar(df, procesados, ConformadorImagen.SUFIJO))
+    fila("Escribir (pandas + openpyxl)", lambda: _escribir_anterior(anterior, os.path.join(args.carpeta, 'anterior.xlsx')))
+    fila("Escribir (ResumenExcel, write-only)", lambda: ResumenExcel.escribir(nuevo, os.path.join(args.carpeta, 'nuevo.xlsx')))
+
+    # Las dos combinaciones deben dar lo mismo (salvo el tipo de las columnas, object frente a numérico)
+    iguales = anterior[nuevo.columns].astype(str).replace('None', 'nan').equals(nuevo.astype(str))
+    print(f"\nMismo resultado que el método anterior: {'sí' if iguales else 'NO'}")
+
+
+# --- Codificación por trozos -------------------------------------------------
+
+def benchmark_segmentado(args):
+    clip = generar_clip_prueba(args.carpeta, args.duracion, args.resolucion)
+    nucleos = os.cpu_count() or 1
+    perfil = PerfilCodificacion.get(args.perfil)
+    perfil.threads = nucleos
+    esperados = args.duracion * perfil.comunes['fps']
+    print(f"Clip: {clip} ({args.duracion}s, {args.resolucion}), perfil {perfil.nombre}, {nucleos} núcleos\n")
+    print(f"{'Codificación':<34}{'tiempo s':>10}{'fps':>8}{'aceleración':>13}  fotogramas")
+
+    salida = os.path.join(args.carpeta, 'una_pasada.mp4')
+    inicio = time.perf_counter()
+    FFmpegRunner(perfil.comando(clip, salida), duration=args.duracion, label='una pasada').run()
+    base = time.perf_counter() - inicio
+    print(f"{f'Una pasada ({nucleos} hilos)':<34}{base:10.1f}{esperados / base:8.1f}{1:12.2f}x  {CodificacionSegmentada.medir(salida)[0]}")
+
+    for codificadores in args.codificadores or [nucleos]:
+        salida = os.path.join(args.carpeta, f"trozos_{codificadores}.mp4")
+        segmentada = CodificacionSegmentada(perfil, codificadores, label=os.path.basename(clip))
+        inicio = time.perf_counter()
+        valida = segmentada.codificar(clip, salida, float(args.duracion))
+        tiempo = time.perf_counter() - inicio
+        nombre = f"Por trozos ({codificadores} codificadores)"
+        resultado = segmentada.fotogramas if valida else 'no cuadra con el original'
+        print(f"{nombre:<34}{tiempo:10.1f}{esperados / tiempo:8.1f}{base / tiempo:12.2f}x  {resultado}")
+
+
+# --- Grafo fusionado -----------------------------------------------------------
+
+def _ejecutar(cmd, duracion, etiqueta):
+    inicio = time.perf_counter()
+    runner = FFmpegRunner(cmd, duration=duracion, label=etiqueta)
+    if runner.run() != 0:
+        raise RuntimeError(f"{etiqueta}: {runner.stderr_tail[-1] if runner.stderr_tail else 'ffmpeg falló'}")
+    return time.perf_counter() - inicio, runner
+
+
+def benchmark_fusionado(args):
+    carpeta = os.path.abspath(args.carpeta)
+    clip = generar_clip_prueba(carpeta, args.duracion, args.resolucion)
+    # VideoPreviewCache trabaja sobre expos/<id> del directorio actual
+    os.chdir(carpeta)
+    expo_id = 'bench'
+    previews = VideoPreviewCache(expo_id)
+    FileManager.ensure_directory(previews.carpeta_origen)
+    entrada = os.path.join(previews.carpeta_origen, os.path.basename(clip))
+    if not os.path.exists(entrada):
+        shutil.copy2(clip, entrada)
+    perfil = PerfilCodificacion.get(args.perfil)
+    perfil.threads = os.cpu_count() or 1
+    salida = os.path.join(carpeta, 'salida.mp4')
+    print(f"Clip: {clip} ({args.duracion}s, {args.resolucion}), perfil {perfil.nombre}\n")
+    print(f"{'Método':<40}{'tiempo s':>10}{'decodificaciones':>18}")
+
+    shutil.rmtree(previews.carpeta_cache, ignore_errors=True)
+    FileManager.ensure_directory(previews.carpeta_cache)
+    total, _ = _ejecutar(perfil.comando(entrada, salida), args.duracion, 'recodificación')
+    for tipo in (VideoPreviewCache.PROXY, VideoPreviewCache.POSTER):
+        destino = os.path.join(previews.carpeta_cache, f"separado.{previews.TIPOS[tipo]}")
+        total += _ejecutar(previews.comando(entrada, tipo, destino), args.duracion, tipo)[0]
+    inicio = time.perf_counter()
+    info = VideoInfo.get_video_info(salida)
+    total += time.perf_counter() - inicio
+    print(f"{'Comandos separados + ffprobe':<40}{total:10.1f}{3:>18}")
+    separado = total
+
+    shutil.rmtree(previews.carpeta_cache, ignore_errors=True)
+    grafo = GrafoFusionado(perfil, expo_id)
+    cmd = grafo.comando(entrada, salida, float(args.duracion))
+    total, runner = _ejecutar(cmd, args.duracion, 'fusionado')
+    grafo.terminar(True)
+    info_fusionado = grafo.estadisticas(salida, runner.last_progress)
+    print(f"{'Grafo fusionado (split)':<40}{total:10.1f}{1:>18}")
+    print(f"\nAceleración: {separado / total:.2f}x")
+    print(f"Previsualizaciones generadas: {', '.join(sorted(grafo.derivados))}")
+    print(f"Estadísticas de la salida: {info_fusionado}")
+    if info:
+        distintos = {k: (v, info_fusionado.get(k)) for k, v in info.items() if info_fusionado.get(k) != v}
+        print(f"Diferencias con ffprobe: {distintos or 'ninguna'}")
+
+
+# --- Plan de recodificación ----------------------------------------------------
+
+def benchmark_prediccion(args):
+    carpeta = os.path.abspath(args.carpeta)
+    clip = generar_clip_prueba(carpeta, args.duracion, args.resolucion)
+    # El plan trabaja sobre expos/<id> del directorio actual
+    os.chdir(carpeta)
+    recodificador = Recodificador('bench', args.perfil)
+    FileManager.ensure_directory(recodificador.carpeta_origen)
+    entrada = os.path.join(recodificador.carpeta_origen, os.path.basename(clip))
+    if not os.path.exists(entrada):
+        shutil.copy2(clip, entrada)
+    print(f"Clip: {clip} ({args.duracion}s, {args.resolucion}), perfil {recodificador.perfil.nombre}\n")
+
+    inicio = time.perf_counter()
+    plan = PlanRecodificacion(recodificador).calcular(forzar=True)
+    muestreo = time.perf_counter() - inicio
+    print(PlanRecodificacion.tabla(plan))
+    prevision = plan['ficheros'][os.path.basename(clip)]
+
+    # La codificación completa, con los parámetros del plan y todos los núcleos
+    perfil = recodificador.perfil_para(entrada)
+    perfil.threads = plan['nucleos']
+    salida = os.path.join(carpeta, 'salida.mp4')
+    inicio = time.perf_counter()
+    FFmpegRunner(perfil.comando(entrada, salida, bucle=recodificador.bucle(entrada)),
+                 duration=args.duracion, label='completa').run()
+    tiempo = time.perf_counter() - inicio
+    tamano = os.path.getsize(salida)
+    mbps = tamano * 8 / args.duracion / 1_000_000
+
+    print(f"\n{'':<22}{'previsto':>10}{'real':>10}{'error':>9}")
+    for nombre, previsto, real in (('Mbps', prevision['mbps'], mbps),
+                                   ('MB', prevision['mb'], tamano / (1024 * 1024)),
+                                   ('tiempo s', plan['eta'], tiempo)):
+        print(f"{nombre:<22}{previsto:10.1f}{real:10.1f}{(previsto - real) / real * 100:8.1f}%")
+    print(f"\nMuestreo: {muestreo:.1f} s ({muestreo / tiempo * 100:.0f}% de la codificación completa)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks de Expo Manager')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    p_imagenes = subparsers.add_parser('imagenes', help='Lectura de metadatos y miniaturas de imágenes 4K')
+    p_imagenes.add_argument('--carpeta', default='bench_imagenes')
+    p_imagenes.add_argument('--n', type=int, default=20)
+    p_imagenes.set_defaults(funcion=benchmark_imagenes)
+
+    p_perfiles = subparsers.add_parser('perfiles', help='Velocidad y tamaño de cada perfil de codificación')
+    p_perfiles.add_argument('--carpeta', default='bench_perfiles')
+    p_perfiles.add_argument('--duracion', type=int, default=10, help='Segundos del clip de prueba')
+    p_perfiles.add_argument('--resolucion', default='3840x2160')
+    p_perfiles.add_argument('--perfiles', nargs='*', help='Perfiles a probar (por defecto, todos los disponibles)')
+    p_perfiles.add_argument('--hilos', type=int, help='Hilos por codificación (por defecto, todos los núcleos)')
+    p_perfiles.add_argument('--guardar', action='store_true', help='Guardar el perfil más rápido que cumple como perfil por defecto')
+    p_perfiles.set_defaults(funcion=benchmark_perfiles)
+
+    p_copia = subparsers.add_parser('copia', help='Copia de seguridad de originales: copia, enlace duro y reflink')
+    p_copia.add_argument('--carpeta', default='bench_copia')
+    p_copia.add_argument('--gb', type=float, default=5, help='Tamaño total de la expo sintética')
+    p_copia.add_argument('--ficheros', type=int, default=20)
+    p_copia.set_defaults(funcion=benchmark_copia)
+
+    p_conformar = subparsers.add_parser('conformar', help='Ajuste de imágenes 8K a la resolución de las pantallas')
+    p_conformar.add_argument('--carpeta', default='bench_conformar')
+    p_conformar.add_argument('--n', type=int, default=100)
+    p_conformar.add_argument('--procesos', type=int, help='Procesos del pool (por defecto, todos los núcleos)')
+    p_conformar.add_argument('--muestra-anterior', type=int, default=10,
+                             help='Imágenes con las que medir el método anterior y el de un solo proceso')
+    p_conformar.set_defaults(funcion=benchmark_conformar)
+
+    p_resumen = subparsers.add_parser('resumen', help='Combinación y escritura del resumen Excel')
+    p_resumen.add_argument('--carpeta', default='bench_resumen')
+    p_resumen.add_argument('--filas', type=int, default=10000)
+    p_resumen.set_defaults(funcion=benchmark_resumen)
+
+    p_segmentado = subparsers.add_parser('segmentado', help='Un vídeo largo de una pasada frente a por trozos en paralelo')
+    p_segmentado.add_argument('--carpeta', default='bench_segmentado')
+    p_segmentado.add_argument('--duracion', type=int, default=120, help='Segundos del clip de prueba')
+    p_segmentado.add_argument('--resolucion', default='3840x2160')
+    p_segmentado.add_argument('--perfil', default=PerfilCodificacion.POR_DEFECTO)
+    p_segmentado.add_argument('--codificadores', type=int, nargs='*', help='Codificadores en paralelo a probar (por defecto, los núcleos)')
+    p_segmentado.set_defaults(funcion=benchmark_segmentado)
+
+    p_fusionado = subparsers.add_parser('fusionado', help='Recodificación, proxy y póster por separado frente a una sola decodificación')
+    p_fusionado.add_argument('--carpeta', default='bench_fusionado')
+    p_fusionado.add_argument('--duracion', type=int, default=30, help='Segundos del clip de prueba')
+    p_fusionado.add_argument('--resolucion', default='3840x2160')
+    p_fusionado.add_argument('--perfil', default=PerfilCodificacion.POR_DEFECTO)
+    p_fusionado.set_defaults(funcion=benchmark_fusionado)
+
+    p_prediccion = subparsers.add_parser('prediccion', help='Tamaño y tiempo previstos por el plan frente a la codificación completa')
+    p_prediccion.add_argument('--carpeta', default='bench_prediccion')
+    p_prediccion.add_argument('--duracion', type=int, default=60, help='Segundos del clip de prueba')
+    p_prediccion.add_argument('--resolucion', default='3840x2160')
+    p_prediccion.add_argument('--perfil', default=PerfilCodificacion.POR_DEFECTO)
+    p_prediccion.set_defaults(funcion=benchmark_prediccion)
+
+    args = parser.parse_args(argv)
+    args.funcion(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,813 @@
+'''
+Recodificación distribuida entre las máquinas del estudio.
+
+La máquina de la aplicación levanta un servidor de trabajos HTTP y reparte las codificaciones
+(un vídeo entero o, si es largo, sus trozos) entre los trabajadores de la red local: Macs o
+Linux con ffmpeg y una copia de este repositorio. Cada trabajador descarga la entrada,
+ejecuta ffmpeg y devuelve la salida; las dos transferencias van con su SHA-256. Si un
+trabajador deja de dar señales, su trabajo vuelve a la cola y lo coge otro. Las salidas
+acaban en `procesados`, como con la recodificación local.
+
+Uso (desde src):
+    EXPO_DISTRIBUIDO_TOKEN=... python distribuido.py servidor E995 --puerto 8765
+    EXPO_DISTRIBUIDO_TOKEN=... python distribuido.py trabajador --servidor http://192.168.11.10:8765 [--paralelos 2 --hilos 4]
+    python distribuido.py demo E995 --trabajadores 3 [--matar-uno]
+
+`demo` arranca el servidor y varios trabajadores en esta misma máquina, en lugar de las
+máquinas remotas. El servidor rechaza las peticiones que no traen EXPO_DISTRIBUIDO_TOKEN (igual
+en el servidor y en los trabajadores), y no arranca sin él salvo que escuche solo en la propia
+máquina, como en `demo`: quien pueda pedir trabajos descarga las obras y deja ficheros en
+`procesados`.
+
+Mientras dura, la exposición queda bloqueada como en una recodificación local, y lo que se
+recodifica se anota en su cola de recodificación.
+'''
+import os
+import re
+import sys
+import copy
+import hmac
+import json
+import time
+import hashlib
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import ipaddress
+import itertools
+import threading
+import subprocess
+import collections
+import http.client
+import http.server
+import concurrent.futures
+from urllib.parse import urlsplit
+
+from main import (Recodificador, VideoCompliance, CodificacionSegmentada, ConformadorImagen, FFmpegRunner,
+                  Metricas, VideoInfo, ColaRecodificacion, TrabajoRecodificacion, configurar_logging)
+from exportar import sha256_file
+
+log = logging.getLogger(__name__)
+
+# Marcadores de la entrada y la salida en los comandos: cada trabajador pone sus rutas locales
+ENTRADA = '{entrada}'
+SALIDA = '{salida}'
+BLOQUE = 1024 * 1024
+
+
+class Trabajo:
+    '''Una codificación (un vídeo o un trozo) y su estado en el servidor.'''
+    EN_COLA = 'en_cola'
+    ASIGNADO = 'asignado'
+    TERMINADO = 'terminado'
+    ERROR = 'error'
+    CANCELADO = 'cancelado'
+
+    def __init__(self, id, entrada, salida, comando, duracion=None, etiqueta=None):
+        self.id = id
+        self.entrada = entrada
+        self.salida = salida
+        # comando(hilos) -> argumentos de ffmpeg con ENTRADA y SALIDA como marcadores
+        self.comando = comando
+        self.duracion = duracion
+        self.etiqueta = etiqueta or os.path.basename(entrada)
+        self.bytes = os.path.getsize(entrada)
+        self.sha256 = sha256_file(entrada)
+        self.estado = self.EN_COLA
+        self.intentos = 0
+        self.trabajador = None
+        self.latido = None
+        self.progreso = 0.0
+        self.inicio = None
+        self.future = concurrent.futures.Future()
+
+    def descripcion(self, hilos):
+        '''Lo que recibe el trabajador al pedir trabajo.'''
+        return {
+            'id': self.id,
+            'etiqueta': self.etiqueta,
+            'comando': self.comando(hilos),
+            'duracion': self.duracion,
+            'bytes': self.bytes,
+            'sha256': self.sha256,
+            'extension_entrada': os.path.splitext(self.entrada)[1],
+            'extension_salida': os.path.splitext(self.salida)[1],
+        }
+
+
+class ServidorTrabajos:
+    '''
+    Cola de trabajos de codificación servida por HTTP. Los trabajadores se identifican con la
+    cabecera X-Trabajador:
+
+        POST /trabajos/pedir          {"hilos": N} -> 200 con el trabajo, o 204 si no hay
+        GET  /trabajos/<id>/entrada   la entrada, con su SHA-256 en X-SHA256
+        POST /trabajos/<id>/latido    {"progreso": %}; 409 si el trabajo ya no es suyo
+        PUT  /trabajos/<id>/salida    la salida, con su SHA-256 en X-SHA256
+        POST /trabajos/<id>/error     {"mensaje": ...}
+        GET  /estado                  resumen de la cola y de los trabajadores
+
+    Un trabajo asignado sin latido durante `plazo` segundos vuelve a la cola, delante. Lo mismo
+    ocurre si el trabajador informa de un error o si la salida llega con una huella que no cuadra.
+    Tras `reintentos` reintentos el trabajo falla.
+
+    Sin token solo escucha en una dirección de loopback: en la red local cualquiera podría pedir
+    trabajos, y la huella de la salida la pone quien la sube, así que no protege de nada.
+    '''
+    CARACTERES_NO_VALIDOS = re.compile(r'[^\w.-]')
+
+    def __init__(self, host='0.0.0.0', puerto=8765, token=None, plazo=30, reintentos=3):
+        self.token = token or os.environ.get('EXPO_DISTRIBUIDO_TOKEN')
+        if not self.token and not self._loopback(host):
+            raise ValueError(f"Para escuchar en {host} hace falta EXPO_DISTRIBUIDO_TOKEN (sin él, solo en 127.0.0.1)")
+        self.plazo = plazo
+        self.reintentos = reintentos
+        self._lock = threading.Lock()
+        self._cola = collections.deque()
+        self._trabajos = {}
+        self._ids = itertools.count(1)
+        self._trabajadores = {}
+        self._parar = threading.Event()
+        self.http = _HTTPTrabajos((host, puerto), _ManejadorTrabajos)
+        self.http.trabajos = self
+
+    @staticmethod
+    def _loopback(host):
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    @property
+    def url(self):
+        host, puerto = self.http.server_address[:2]
+        if host in ('0.0.0.0', ''):
+            host = socket.gethostbyname(socket.gethostname())
+        return f"http://{host}:{puerto}"
+
+    def iniciar(self):
+        threading.Thread(target=self.http.serve_forever, name='servidor-trabajos', daemon=True).start()
+        threading.Thread(target=self._vigilar, name='vigilante-trabajos', daemon=True).start()
+        log.info("Servidor de trabajos en %s", self.url)
+        return self
+
+    def parar(self):
+        self._parar.set()
+        self.http.shutdown()
+        self.http.server_close()
+
+    def encolar(self, entrada, salida, comando, duracion=None, etiqueta=None):
+        trabajo = Trabajo(str(next(self._ids)), entrada, salida, comando, duracion, etiqueta)
+        with self._lock:
+            self._trabajos[trabajo.id] = trabajo
+            self._cola.append(trabajo)
+        return trabajo
+
+    def cancelar(self, trabajos):
+        '''
+        Retira de la cola los trabajos que no han terminado. Si alguno está asignado, su
+        trabajador recibe 409 en el siguiente latido y para ffmpeg.
+        '''
+        with self._lock:
+            for trabajo in trabajos:
+                if trabajo.estado not in (Trabajo.EN_COLA, Trabajo.ASIGNADO):
+                    continue
+                if trabajo.estado == Trabajo.EN_COLA:
+                    self._cola.remove(trabajo)
+                trabajo.estado = Trabajo.CANCELADO
+                trabajo.trabajador = None
+                trabajo.future.cancel()
+
+    def pedir(self, trabajador, hilos):
+        with self._lock:
+            self._trabajadores[trabajador] = time.time()
+            if not self._cola:
+                return None
+            trabajo = self._cola.popleft()
+            trabajo.estado = Trabajo.ASIGNADO
+            trabajo.trabajador = trabajador
+            trabajo.intentos += 1
+            trabajo.latido = trabajo.inicio = time.time()
+            trabajo.progreso = 0.0
+        log.debug("Trabajo %s (%s) para %s", trabajo.id, trabajo.etiqueta, trabajador)
+        return trabajo.descripcion(hilos)
+
+    def asignado(self, id, trabajador):
+        '''El trabajo, si sigue asignado a `trabajador`; si no, None.'''
+        with self._lock:
+            self._trabajadores[trabajador] = time.time()
+            trabajo = self._trabajos.get(id)
+            if trabajo and trabajo.estado == Trabajo.ASIGNADO and trabajo.trabajador == trabajador:
+                return trabajo
+            return None
+
+    def latido(self, id, trabajador, progreso=None):
+        with self._lock:
+            trabajo = self._trabajos.get(id)
+            if not trabajo or trabajo.estado != Trabajo.ASIGNADO or trabajo.trabajador != trabajador:
+                return False
+            trabajo.latido = self._trabajadores[trabajador] = time.time()
+            if progreso is not None:
+                trabajo.progreso = progreso
+            return True
+
+    def _es_suyo(self, trabajo, trabajador, intentos):
+        # Con el lock cogido
+        return trabajo.estado == Trabajo.ASIGNADO and trabajo.trabajador == trabajador and trabajo.intentos == intentos
+
+    def recibir_salida(self, trabajo, trabajador, origen, longitud, sha256):
+        '''
+        Guarda la salida que envía el trabajador. Devuelve (estado HTTP, mensaje).
+
+        Un trabajador que perdió el trabajo puede seguir subiendo mientras sube el nuevo dueño:
+        cada intento escribe en su propio temporal y solo se coloca si al terminar el trabajo
+        sigue siendo de ese intento.
+        '''
+        with self._lock:
+            if trabajo.estado != Trabajo.ASIGNADO or trabajo.trabajador != trabajador:
+                return 409, 'el trabajo ya no es de este trabajador'
+            intentos = trabajo.intentos
+        # El nombre del trabajador viene en una cabecera: que no pueda salirse de la carpeta
+        nombre = self.CARACTERES_NO_VALIDOS.sub('_', trabajador)
+        parcial = f"{trabajo.salida}.{trabajo.id}.{intentos}.{nombre}.part"
+        digest = hashlib.sha256()
+        restantes = longitud
+        try:
+            with open(parcial, 'wb') as f:
+                while restantes:
+                    bloque = origen.read(min(restantes, BLOQUE))
+                    if not bloque:
+                        break
+                    f.write(bloque)
+                    digest.update(bloque)
+                    restantes -= len(bloque)
+        except OSError:
+            if os.path.exists(parcial):
+                os.remove(parcial)
+            with self._lock:
+                if not self._es_suyo(trabajo, trabajador, intentos):
+                    # Cancelado mientras subía: su carpeta ya no existe
+                    return 409, 'el trabajo ya no es de este trabajador'
+            raise
+        if restantes or digest.hexdigest() != sha256:
+            os.remove(parcial)
+            self.fallo(trabajo.id, trabajador, 'la salida llegó incompleta o con otra huella')
+            return 422, 'huella distinta'
+        with self._lock:
+            if not self._es_suyo(trabajo, trabajador, intentos):
+                os.remove(parcial)
+                return 409, 'el trabajo ya no es de este trabajador'
+            os.replace(parcial, trabajo.salida)
+            trabajo.estado = Trabajo.TERMINADO
+            trabajo.progreso = 100.0
+        trabajo.future.set_result(trabajo)
+        return 200, 'ok'
+
+    def fallo(self, id, trabajador, mensaje):
+        with self._lock:
+            trabajo = self._trabajos.get(id)
+            if not trabajo or trabajo.estado != Trabajo.ASIGNADO or trabajo.trabajador != trabajador:
+                return
+            self._reintentar(trabajo, f"{trabajador}: {mensaje}")
+
+    def _reintentar(self, trabajo, motivo):
+        # Con el lock cogido
+        if trabajo.intentos > self.reintentos:
+            trabajo.estado = Trabajo.ERROR
+            log.error("Trabajo %s (%s) abandonado tras %s intentos: %s", trabajo.id, trabajo.etiqueta, trabajo.intentos, motivo)
+            trabajo.future.set_exception(RuntimeError(f"{trabajo.etiqueta}: {motivo}"))
+            return
+        log.warning("Trabajo %s (%s) vuelve a la cola: %s", trabajo.id, trabajo.etiqueta, motivo)
+        trabajo.estado = Trabajo.EN_COLA
+        trabajo.trabajador = None
+        self._cola.appendleft(trabajo)
+
+    def _vigilar(self):
+        while not self._parar.wait(min(5, self.plazo / 3)):
+            limite = time.time() - self.plazo
+            with self._lock:
+                for trabajo in self._trabajos.values():
+                    if trabajo.estado == Trabajo.ASIGNADO and trabajo.latido < limite:
+                        self._reintentar(trabajo, f"{trabajo.trabajador} no responde desde hace {self.plazo} s")
+
+    def estado(self):
+        with self._lock:
+            estados = collections.Counter(t.estado for t in self._trabajos.values())
+            return {
+                'trabajos': dict(estados),
+                'en_curso': [{'id': t.id, 'etiqueta': t.etiqueta, 'trabajador': t.trabajador,
+                              'progreso': round(t.progreso, 1), 'intentos': t.intentos}
+                             for t in self._trabajos.values() if t.estado == Trabajo.ASIGNADO],
+                'trabajadores': {nombre: round(time.time() - visto, 1) for nombre, visto in self._trabajadores.items()},
+            }
+
+
+class _HTTPTrabajos(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        error = sys.exc_info()[1]
+        if isinstance(error, ConnectionError):
+            # Un trabajador que se cae o se para a mitad de una petición: de eso ya se ocupa el plazo
+            log.debug("Conexión con %s cortada: %s", client_address[0], error)
+        else:
+            log.exception("Error atendiendo a %s", client_address[0])
+
+
+class _ManejadorTrabajos(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    RUTA_TRABAJO = re.compile(r'^/trabajos/(\w+)/(entrada|latido|salida|error)$')
+
+    @property
+    def trabajos(self):
+        return self.server.trabajos
+
+    def _responder(self, estado, datos=None, cerrar=False):
+        cuerpo = json.dumps(datos).encode() if datos is not None else b''
+        self.send_response(estado)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        if cerrar:
+            # El cuerpo de la petición no se ha leído: la conexión no se puede reutilizar
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _leer_json(self):
+        longitud = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(longitud) or b'{}') if longitud else {}
+
+    def _autorizado(self):
+        token = self.trabajos.token
+        if token and not hmac.compare_digest(self.headers.get('X-Token', ''), token):
+            self._responder(401, {'error': 'token no válido'}, cerrar=True)
+            return False
+        return True
+
+    def _trabajador(self):
+        return self.headers.get('X-Trabajador') or self.client_address[0]
+
+    def do_GET(self):
+        if not self._autorizado():
+            return
+        if self.path == '/estado':
+            return self._responder(200, self.trabajos.estado())
+        ruta = self.RUTA_TRABAJO.match(self.path)
+        if not ruta or ruta.group(2) != 'entrada':
+            return self._responder(404)
+        trabajo = self.trabajos.asignado(ruta.group(1), self._trabajador())
+        if not trabajo:
+            return self._responder(409, {'error': 'el trabajo ya no es de este trabajador'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(trabajo.bytes))
+        self.send_header('X-SHA256', trabajo.sha256)
+        self.end_headers()
+        with open(trabajo.entrada, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, BLOQUE)
+
+    def do_POST(self):
+        if not self._autorizado():
+            return
+        datos = self._leer_json()
+        trabajador = self._trabajador()
+        if self.path == '/trabajos/pedir':
+            trabajo = self.trabajos.pedir(trabajador, datos.get('hilos'))
+            return self._responder(200, trabajo) if trabajo else self._responder(204)
+        ruta = self.RUTA_TRABAJO.match(self.path)
+        if not ruta:
+            return self._responder(404)
+        if ruta.group(2) == 'latido':
+            if self.trabajos.latido(ruta.group(1), trabajador, datos.get('progreso')):
+                return self._responder(200, {})
+            return self._responder(409, {'error': 'el trabajo ya no es de este trabajador'})
+        if ruta.group(2) == 'error':
+            self.trabajos.fallo(ruta.group(1), trabajador, datos.get('mensaje', 'error desconocido'))
+            return self._responder(200, {})
+        self._responder(404)
+
+    def do_PUT(self):
+        if not self._autorizado():
+            return
+        ruta = self.RUTA_TRABAJO.match(self.path)
+        if not ruta or ruta.group(2) != 'salida':
+            return self._responder(404, cerrar=True)
+        trabajador = self._trabajador()
+        trabajo = self.trabajos.asignado(ruta.group(1), trabajador)
+        if not trabajo:
+            return self._responder(409, {'error': 'el trabajo ya no es de este trabajador'}, cerrar=True)
+        estado, mensaje = self.trabajos.recibir_salida(trabajo, trabajador, self.rfile,
+                                                       int(self.headers.get('Content-Length', 0)),
+                                                       self.headers.get('X-SHA256', ''))
+        self._responder(estado, {'mensaje': mensaje})
+
+    def log_message(self, formato, *args):
+        log.debug("servidor de trabajos: " + formato, *args)
+
+
+class TrabajoPerdido(Exception):
+    '''El servidor ha dado el trabajo a otro trabajador (409).'''
+
+
+class Trabajador:
+    '''
+    Agente que pide trabajos al servidor y los ejecuta con el ffmpeg local. Con `paralelos`
+    hace varios trabajos a la vez, cada uno con `hilos` hilos (por defecto, los núcleos
+    repartidos entre los trabajos). Cada hilo reutiliza su conexión con el servidor.
+    '''
+    def __init__(self, url, nombre=None, paralelos=1, hilos=None, token=None, espera=2):
+        partes = urlsplit(url)
+        self.host, self.puerto = partes.hostname, partes.port or 80
+        self.nombre = nombre or f"{socket.gethostname()}-{os.getpid()}"
+        self.paralelos = paralelos
+        self.hilos = hilos or max(1, (os.cpu_count() or 1) // paralelos)
+        self.token = token or os.environ.get('EXPO_DISTRIBUIDO_TOKEN')
+        self.espera = espera
+        self.parar = threading.Event()
+
+    def _conectar(self):
+        return http.client.HTTPConnection(self.host, self.puerto, timeout=120)
+
+    def _cabeceras(self, extra=None):
+        cabeceras = {'X-Trabajador': self.nombre, **(extra or {})}
+        if self.token:
+            cabeceras['X-Token'] = self.token
+        return cabeceras
+
+    def _json(self, conexion, ruta, datos):
+        cuerpo = json.dumps(datos).encode()
+        conexion.request('POST', ruta, body=cuerpo, headers=self._cabeceras({'Content-Type': 'application/json'}))
+        respuesta = conexion.getresponse()
+        contenido = respuesta.read()
+        if respuesta.status == 409:
+            raise TrabajoPerdido(ruta)
+        if respuesta.status >= 400:
+            raise http.client.HTTPException(f"{ruta}: {respuesta.status} {contenido[:200]!r}")
+        return json.loads(contenido) if contenido else None
+
+    def ejecutar(self):
+        '''Trabaja hasta que se activa `parar` (o Ctrl+C).'''
+        log.info("Trabajador %s: %s trabajos a la vez con %s hilos, servidor %s:%s",
+                 self.nombre, self.paralelos, self.hilos, self.host, self.puerto)
+        hilos = [threading.Thread(target=self._bucle, name=f"{self.nombre}-{i}", daemon=True) for i in range(self.paralelos)]
+        for hilo in hilos:
+            hilo.start()
+        try:
+            while any(hilo.is_alive() for hilo in hilos):
+                self.parar.wait(1)
+                if self.parar.is_set():
+                    break
+        except KeyboardInterrupt:
+            self.parar.set()
+
+    def _bucle(self):
+        conexion = self._conectar()
+        while not self.parar.is_set():
+            try:
+                trabajo = self._json(conexion, '/trabajos/pedir', {'hilos': self.hilos})
+                if trabajo is None:
+                    self.parar.wait(self.espera)
+                    continue
+                self._hacer(conexion, trabajo)
+            except (OSError, http.client.HTTPException) as e:
+                # Servidor caído o reiniciado: nueva conexión y a esperar
+                log.warning("Trabajador %s: %s", self.nombre, e)
+                conexion.close()
+                conexion = self._conectar()
+                self.parar.wait(self.espera)
+        conexion.close()
+
+    def _hacer(self, conexion, trabajo):
+        carpeta = tempfile.mkdtemp(prefix='expo_trabajo_')
+        latidos = _Latidos(self, trabajo['id'])
+        try:
+            latidos.start()
+            entrada = os.path.join(carpeta, 'entrada' + trabajo['extension_entrada'])
+            salida = os.path.join(carpeta, 'salida' + trabajo['extension_salida'])
+            self._descargar(conexion, trabajo, entrada)
+
+            cmd = [entrada if arg == ENTRADA else salida if arg == SALIDA else arg for arg in trabajo['comando']]
+            if os.path.basename(cmd[0]) != 'ffmpeg':
+                raise ValueError(f"Comando no permitido: {cmd[0]}")
+            runner = FFmpegRunner(cmd, duration=trabajo['duracion'],
+                                  on_progress=lambda progreso: latidos.progreso(progreso['percent']),
+                                  label=trabajo['etiqueta'])
+            latidos.runner = runner
+            inicio = time.perf_counter()
+            try:
+                codigo = runner.run()
+            except OSError as e:
+                raise RuntimeError(f"No se pudo lanzar ffmpeg: {e}")
+            if codigo != 0:
+                if latidos.perdido:
+                    raise TrabajoPerdido(trabajo['id'])
+                raise RuntimeError(f"ffmpeg terminó con error: {runner.stderr_tail[-1] if runner.stderr_tail else ''}")
+            log.info("%s: %s codificado en %.1f s", self.nombre, trabajo['etiqueta'], time.perf_counter() - inicio)
+            self._subir(conexion, trabajo, salida)
+        except TrabajoPerdido:
+            log.warning("%s: el trabajo %s se ha dado a otro trabajador", self.nombre, trabajo['id'])
+        except (OSError, http.client.HTTPException):
+            raise
+        except Exception as e:
+            log.error("%s: error en %s: %s", self.nombre, trabajo['etiqueta'], e)
+            self._json(conexion, f"/trabajos/{trabajo['id']}/error", {'mensaje': str(e)})
+        finally:
+            latidos.terminar()
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+    def _descargar(self, conexion, trabajo, destino):
+        conexion.request('GET', f"/trabajos/{trabajo['id']}/entrada", headers=self._cabeceras())
+        respuesta = conexion.getresponse()
+        if respuesta.status != 200:
+            respuesta.read()
+            if respuesta.status == 409:
+                raise TrabajoPerdido(trabajo['id'])
+            raise http.client.HTTPException(f"entrada de {trabajo['id']}: {respuesta.status}")
+        digest = hashlib.sha256()
+        with open(destino, 'wb') as f:
+            while True:
+                bloque = respuesta.read(BLOQUE)
+                if not bloque:
+                    break
+                f.write(bloque)
+                digest.update(bloque)
+        if digest.hexdigest() != trabajo['sha256']:
+            raise ValueError(f"La entrada de {trabajo['etiqueta']} llegó con otra huella")
+
+    def _subir(self, conexion, trabajo, salida):
+        cabeceras = self._cabeceras({'Content-Length': str(os.path.getsize(salida)), 'X-SHA256': sha256_file(salida)})
+        with open(salida, 'rb') as f:
+            conexion.request('PUT', f"/trabajos/{trabajo['id']}/salida", body=f, headers=cabeceras)
+            respuesta = conexion.getresponse()
+            respuesta.read()
+        if respuesta.status == 409:
+            raise TrabajoPerdido(trabajo['id'])
+        if respuesta.status != 200:
+            # 422: la salida llegó mal; el servidor ya la ha devuelto a la cola
+            log.warning("%s: el servidor rechazó la salida de %s (%s)", self.nombre, trabajo['etiqueta'], respuesta.status)
+
+
+class _Latidos(threading.Thread):
+    '''Latidos periódicos con el progreso, por su propia conexión. Si el trabajo se pierde, cancela ffmpeg.'''
+    INTERVALO = 5
+
+    def __init__(self, trabajador, id):
+        super().__init__(name=f"latidos-{id}", daemon=True)
+        self.trabajador = trabajador
+        self.id = id
+        self.runner = None
+        self.perdido = False
+        self._progreso = None
+        self._fin = threading.Event()
+
+    def progreso(self, porcentaje):
+        if porcentaje is not None:
+            self._progreso = porcentaje
+
+    def run(self):
+        conexion = self.trabajador._conectar()
+        try:
+            while not self._fin.wait(self.INTERVALO):
+                try:
+                    self.trabajador._json(conexion, f"/trabajos/{self.id}/latido", {'progreso': self._progreso})
+                except TrabajoPerdido:
+                    self.perdido = True
+                    if self.runner:
+                        self.runner.cancel()
+                    return
+                except (OSError, http.client.HTTPException):
+                    conexion.close()
+                    conexion = self.trabajador._conectar()
+        finally:
+            conexion.close()
+
+    def terminar(self):
+        self._fin.set()
+
+
+# --- Reparto de una exposición -----------------------------------------------
+
+def _con_hilos(perfil, hilos):
+    perfil = copy.copy(perfil)
+    perfil.threads, perfil.pools = hilos, None
+    return perfil
+
+
+def recodificar_distribuido(expo_id, servidor, trozos=16):
+    '''
+    Recodifica `expo_id` repartiendo los vídeos que hay que recodificar entre los trabajadores
+    de `servidor`. Los vídeos de más de CodificacionSegmentada.DURACION_MIN se reparten en
+    unos `trozos` trozos, que se unen y verifican aquí; los demás, enteros. Las imágenes y los
+    vídeos que solo se copian o remultiplexan se hacen en esta máquina mientras tanto.
+
+    Como TrabajoRecodificacion, toma el lock de recodificación de la exposición (un
+    /recodificar a la vez escribiría en los mismos ficheros de procesados) y lleva su
+    ColaRecodificacion: solo se procesa lo pendiente, y lo hecho aquí no se repite después.
+    Devuelve {nombre: nombre en procesados o False} de lo que estaba pendiente.
+    '''
+    lock_file = TrabajoRecodificacion.bloquear(expo_id)
+    if lock_file is None:
+        raise RuntimeError(f"No se puede recodificar {expo_id}: no existe o ya se está recodificando")
+    try:
+        return _recodificar(expo_id, servidor, trozos)
+    finally:
+        TrabajoRecodificacion.liberar(lock_file)
+
+
+def _recodificar(expo_id, servidor, trozos):
+    recodificador = Recodificador(expo_id)
+    recodificador.crear_carpeta_procesados()
+    cola = ColaRecodificacion(recodificador)
+    perfil = recodificador.perfil
+    metricas = Metricas.for_expo(expo_id)
+    rutas = cola.sincronizar()
+    log.info("Recodificación de %s: %s pendientes, %s ya procesados", expo_id, len(rutas), len(cola.ficheros) - len(rutas))
+    imagenes = [ruta for ruta in rutas if ruta.lower().endswith(('.png', '.jpg', '.jpeg'))]
+
+    remotos, locales = [], []
+    for ruta in (ruta for ruta in rutas if ruta.lower().endswith('.mp4')):
+        decision, _ = VideoCompliance.decidir(ruta, recodificador.metadata_cache.get_info(ruta), perfil)
+        (remotos if decision == VideoCompliance.RECODIFICAR and not perfil.hardware else locales).append(ruta)
+
+    def video(ruta):
+        nombre = os.path.basename(ruta)
+        salida = os.path.join(recodificador.carpeta_destino, nombre)
+        duracion = VideoInfo.get_duration(ruta)
+        bucle, sonoridad = recodificador.bucle(ruta), recodificador.sonoridad(ruta)
+        # El control de tasa que eligió el plan de recodificación, si hay uno vigente
+        perfil_video = recodificador.perfil_para(ruta)
+        inicio = time.perf_counter()
+        if duracion and duracion >= CodificacionSegmentada.DURACION_MIN and perfil.comunes['segmentar'] != 'no':
+            if _video_por_trozos(servidor, perfil_video, ruta, salida, duracion, bucle, sonoridad, trozos):
+                metricas.registrar('recodificar', time.perf_counter() - inicio, fichero=nombre, ficheros=1,
+                                   bytes=os.path.getsize(ruta), distribuido='trozos')
+                return nombre
+        trabajo = servidor.encolar(ruta, salida,
+                                   lambda hilos: _con_hilos(perfil_video, hilos).comando(ENTRADA, SALIDA, bucle=bucle, sonoridad=sonoridad),
+                                   duracion=duracion)
+        try:
+            trabajo.future.result()
+        except RuntimeError as e:
+            log.error("No se pudo recodificar %s: %s", nombre, e)
+            metricas.registrar('recodificar', time.perf_counter() - inicio, fichero=nombre, error=str(e))
+            return False
+        metricas.registrar('recodificar', time.perf_counter() - inicio, fichero=nombre, ficheros=1,
+                           bytes=os.path.getsize(ruta), distribuido=trabajo.trabajador)
+        return nombre
+
+    resultados = {}
+
+    def anotar(nombre, salida):
+        # Siempre desde este hilo: la cola no admite escrituras concurrentes
+        resultados[nombre] = salida
+        if salida:
+            cola.marcar(nombre, ColaRecodificacion.TERMINADO, salida=salida)
+        else:
+            cola.marcar(nombre, ColaRecodificacion.ERROR, error='Error al procesar el fichero')
+
+    with metricas.etapa('recodificacion', ficheros=len(rutas)):
+        for ruta in rutas:
+            cola.marcar(os.path.basename(ruta), ColaRecodificacion.PROCESANDO)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(remotos))) as executor:
+            futures = {executor.submit(video, ruta): os.path.basename(ruta) for ruta in remotos}
+            log.info("%s vídeos repartidos entre los trabajadores de %s", len(remotos), servidor.url)
+
+            # Mientras tanto, lo que no necesita codificar vídeo se hace aquí
+            for ruta in locales:
+                anotar(os.path.basename(ruta), recodificador.process_file(ruta))
+            procesadas = ConformadorImagen.procesar_lote(imagenes, recodificador.carpeta_destino, procesos=recodificador.max_workers)
+            for ruta, nombre in procesadas.items():
+                anotar(os.path.basename(ruta), nombre or False)
+
+            for future in concurrent.futures.as_completed(futures):
+                anotar(futures[future], future.result())
+    recodificador.actualizar_excel()
+    return resultados
+
+
+def _video_por_trozos(servidor, perfil, ruta, salida, duracion, bucle, sonoridad, trozos):
+    nombre = os.path.basename(ruta)
+    segmentada = CodificacionSegmentada(perfil, max(1, trozos // CodificacionSegmentada.TROZOS_POR_CODIFICADOR),
+                                        bucle=bucle, sonoridad=sonoridad, label=nombre)
+    carpeta = tempfile.mkdtemp(prefix='.trozos_', dir=os.path.dirname(salida))
+    trabajos = []
+    try:
+        partes = segmentada.partir(ruta, carpeta, duracion)
+        if len(partes) < 2:
+            return False
+
+        def comando(inicio):
+            def con_hilos(hilos):
+                copia = copy.copy(segmentada)
+                copia.perfil = _con_hilos(segmentada.perfil, hilos)
+                return copia.comando_trozo(ENTRADA, inicio, SALIDA)
+            return con_hilos
+
+        trabajos = [servidor.encolar(parte, os.path.splitext(parte)[0] + '_cod.mkv', comando(inicio),
+                                     duracion=fin - inicio, etiqueta=f"{nombre}#{i}")
+                    for i, (parte, inicio, fin) in enumerate(partes)]
+        # En cuanto falla un trozo no tiene sentido esperar a los demás
+        hechos, _ = concurrent.futures.wait([t.future for t in trabajos], return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in hechos:
+            future.result()
+        log.info("%s: %s trozos codificados por %s", nombre, len(trabajos), ', '.join(sorted({t.trabajador for t in trabajos})))
+        return segmentada.terminar([t.salida for t in trabajos], ruta, salida, carpeta, duracion)
+    except (OSError, RuntimeError) as e:
+        log.warning("%s: %s. Se reparte entero", nombre, e)
+        return False
+    finally:
+        # Los trozos que sigan en la cola o en un trabajador se quedarían sin entrada al borrar la carpeta
+        servidor.cancelar(trabajos)
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+
+def demo(expo_id, trabajadores=3, puerto=8765, plazo=15, matar_uno=False, trozos=16):
+    '''Servidor y `trabajadores` procesos trabajador en esta máquina, haciendo de máquinas remotas.'''
+    servidor = ServidorTrabajos('127.0.0.1', puerto, plazo=plazo).iniciar()
+    procesos = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'trabajador', '--servidor', servidor.url,
+                                  '--nombre', f"local{i}", '--hilos', '1'])
+                for i in range(trabajadores)]
+
+    def matar_primero():
+        # En cuanto local0 tenga un trabajo, se mata: el trabajo debe volver a la cola tras el plazo
+        while procesos[0].poll() is None:
+            if any(t['trabajador'] == 'local0' for t in servidor.estado()['en_curso']):
+                time.sleep(1)
+                log.warning("demo: se mata el trabajador local0")
+                procesos[0].kill()
+                return
+            time.sleep(0.2)
+
+    if matar_uno:
+        threading.Thread(target=matar_primero, daemon=True).start()
+    try:
+        return recodificar_distribuido(expo_id, servidor, trozos)
+    finally:
+        for proceso in procesos:
+            proceso.terminate()
+        for proceso in procesos:
+            proceso.wait()
+        servidor.parar()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recodificación distribuida entre varias máquinas')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    p_servidor = subparsers.add_parser('servidor', help='Reparte la recodificación de una exposición')
+    p_servidor.add_argument('expo_id')
+    p_servidor.add_argument('--host', default='0.0.0.0')
+    p_servidor.add_argument('--puerto', type=int, default=8765)
+    p_servidor.add_argument('--plazo', type=int, default=30, help='Segundos sin latido para dar un trabajo por perdido')
+    p_servidor.add_argument('--trozos', type=int, default=16, help='Trozos en los que repartir cada vídeo largo')
+
+    p_trabajador = subparsers.add_parser('trabajador', help='Codifica trabajos de un servidor')
+    p_trabajador.add_argument('--servidor', required=True, help='URL del servidor, p. ej. http://192.168.11.10:8765')
+    p_trabajador.add_argument('--nombre')
+    p_trabajador.add_argument('--paralelos', type=int, default=1, help='Trabajos a la vez')
+    p_trabajador.add_argument('--hilos', type=int, help='Hilos de ffmpeg por trabajo (por defecto, núcleos / paralelos)')
+
+    p_demo = subparsers.add_parser('demo', help='Servidor y varios trabajadores en esta máquina')
+    p_demo.add_argument('expo_id')
+    p_demo.add_argument('--trabajadores', type=int, default=3)
+    p_demo.add_argument('--puerto', type=int, default=8765)
+    p_demo.add_argument('--plazo', type=int, default=15)
+    p_demo.add_argument('--trozos', type=int, default=16)
+    p_demo.add_argument('--matar-uno', action='store_true', help='Matar un trabajador a mitad de trabajo para probar los reintentos')
+
+    args = parser.parse_args(argv)
+    configurar_logging()
+
+    if args.comando == 'trabajador':
+        Trabajador(args.servidor, args.nombre, args.paralelos, args.hilos).ejecutar()
+        return 0
+    if args.comando == 'servidor':
+        try:
+            servidor = ServidorTrabajos(args.host, args.puerto, plazo=args.plazo).iniciar()
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            resultados = recodificar_distribuido(args.expo_id, servidor, args.trozos)
+        except RuntimeError as e:
+            log.error("%s", e)
+            return 1
+        finally:
+            servidor.parar()
+    else:
+        try:
+            resultados = demo(args.expo_id, args.trabajadores, args.puerto, args.plazo, args.matar_uno, args.trozos)
+        except RuntimeError as e:
+            log.error("%s", e)
+            return 1
+    for nombre, salida in sorted(resultados.items()):
+        print(f"{nombre}: {salida or 'ERROR'}")
+    return 1 if not all(resultados.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,614 @@
+'''
+Exportación de una exposición a las pantallas.
+
+Agrupa las salidas de `procesados` por número de pantalla (_PNNN_) en un paquete por pantalla
+(expos/<id>/pantallas/PNNN) con su lista de reproducción y un manifiesto con la huella SHA-256
+de cada fichero, y los sube a los reproductores Samsung de instructions/hardware.md (el monitor
+N recibe la pantalla N).
+
+Uso (desde src):
+    python exportar.py paquetes E995
+    python exportar.py subir E995 --protocolo ftp --usuario USUARIO --clave CLAVE
+    python exportar.py servidor --carpeta /tmp/pantallas --protocolo http --puerto 8080
+
+Para probar sin las pantallas se levanta el servidor local y se sube con --host 127.0.0.1:
+todas las pantallas van al mismo servidor, cada una a su carpeta PNNN.
+'''
+import os
+import re
+import sys
+import json
+import time
+import queue
+import shutil
+import ftplib
+import hashlib
+import logging
+import argparse
+import datetime
+import threading
+import collections
+import http.client
+import http.server
+import concurrent.futures
+from urllib.parse import quote, unquote, urlsplit
+
+from main import Metricas, get_screen_number, configurar_logging
+
+log = logging.getLogger(__name__)
+
+HARDWARE_MD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'instructions', 'hardware.md')
+
+Monitor = collections.namedtuple('Monitor', 'numero modelo serie mac ip reproductor firmware red')
+
+# Campo del Monitor y texto que identifica su etiqueta en hardware.md
+CAMPOS_HARDWARE = [
+    ('modelo', 'modelo'),
+    ('serie', 'serie'),
+    ('mac', 'mac'),
+    ('ip', 'dirección ip'),
+    ('reproductor', 'reproductor'),
+    ('firmware', 'firmware'),
+    ('red', 'tipo de red'),
+]
+
+
+def leer_monitores(path=HARDWARE_MD):
+    '''
+    Lee la lista de monitores de hardware.md: bloques "Monitor N:" con pares etiqueta / valor en
+    líneas consecutivas. Devuelve {N: Monitor}; los monitores sin IP se ignoran.
+    '''
+    monitores = {}
+    numero, campos, pendiente = None, {}, None
+
+    def cerrar():
+        if numero is not None and campos.get('ip'):
+            monitores[numero] = Monitor(numero, **{campo: campos.get(campo) for campo, _ in CAMPOS_HARDWARE})
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for linea in f:
+            linea = linea.strip()
+            encabezado = re.match(r'Monitor (\d+):', linea)
+            if encabezado:
+                cerrar()
+                numero, campos, pendiente = int(encabezado.group(1)), {}, None
+            elif linea.startswith('___'):
+                # Después de la lista vienen las características de cada modelo
+                break
+            elif numero is None or not linea:
+                continue
+            elif pendiente:
+                campos[pendiente], pendiente = linea, None
+            else:
+                minusculas = linea.lower()
+                pendiente = next((campo for campo, clave in CAMPOS_HARDWARE if clave in minusculas), None)
+    cerrar()
+    return monitores
+
+
+def sha256_file(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for bloque in iter(lambda: f.read(chunk_size), b''):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+
+class PaquetesPantallas:
+    '''
+    Un paquete por pantalla en expos/<id>/pantallas/PNNN: los ficheros de `procesados` de esa
+    pantalla (enlazados, no copiados, si el sistema de ficheros lo permite), playlist.m3u en
+    orden de nombre y manifest.json con tamaño y SHA-256 de cada fichero. Al reconstruir solo
+    se vuelven a calcular las huellas de los ficheros cuyo tamaño o mtime han cambiado.
+    '''
+    MANIFIESTO = 'manifest.json'
+    LISTA = 'playlist.m3u'
+
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.full_output_path = os.path.join(os.getcwd(), 'expos', expo_id)
+        self.carpeta_procesados = os.path.join(self.full_output_path, 'procesados')
+        self.carpeta_paquetes = os.path.join(self.full_output_path, 'pantallas')
+
+    @staticmethod
+    def nombre(pantalla):
+        return f"P{pantalla:03d}"
+
+    def carpeta(self, pantalla):
+        return os.path.join(self.carpeta_paquetes, self.nombre(pantalla))
+
+    def agrupar(self):
+        '''{pantalla: [ficheros]} de procesados, según el _PNNN_ del nombre.'''
+        grupos = collections.defaultdict(list)
+        for nombre in sorted(os.listdir(self.carpeta_procesados)):
+            if nombre.startswith('.') or nombre.endswith(('.part', '.tmp')):
+                continue
+            pantalla = get_screen_number(nombre)
+            if pantalla is not None and os.path.isfile(os.path.join(self.carpeta_procesados, nombre)):
+                grupos[pantalla].append(nombre)
+        return dict(grupos)
+
+    @classmethod
+    def leer_manifiesto(cls, carpeta):
+        try:
+            with open(os.path.join(carpeta, cls.MANIFIESTO), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _enlazar(origen, destino):
+        if os.path.exists(destino):
+            if os.path.samefile(origen, destino):
+                return
+            os.remove(destino)
+        try:
+            os.link(origen, destino)
+        except OSError:
+            shutil.copy2(origen, destino)
+
+    @staticmethod
+    def _escribir(path, contenido):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(contenido)
+        os.replace(tmp_path, path)
+
+    def construir(self, monitores=None):
+        '''Genera o actualiza los paquetes. Devuelve {pantalla: manifiesto}.'''
+        monitores = monitores or {}
+        manifiestos = {}
+        with Metricas.for_expo(self.expo_id).etapa('empaquetar') as medida:
+            for pantalla, nombres in sorted(self.agrupar().items()):
+                carpeta = self.carpeta(pantalla)
+                os.makedirs(carpeta, exist_ok=True)
+                anteriores = {f['nombre']: f for f in (self.leer_manifiesto(carpeta) or {}).get('ficheros', [])}
+
+                # Lo que ya no está en procesados sale del paquete
+                for sobrante in set(os.listdir(carpeta)) - set(nombres) - {self.MANIFIESTO, self.LISTA}:
+                    os.remove(os.path.join(carpeta, sobrante))
+
+                ficheros = []
+                for nombre in nombres:
+                    origen = os.path.join(self.carpeta_procesados, nombre)
+                    self._enlazar(origen, os.path.join(carpeta, nombre))
+                    stat = os.stat(origen)
+                    anterior = anteriores.get(nombre)
+                    if anterior and anterior['bytes'] == stat.st_size and anterior['mtime_ns'] == stat.st_mtime_ns:
+                        huella = anterior['sha256']
+                    else:
+                        huella = sha256_file(origen)
+                    ficheros.append({'nombre': nombre, 'bytes': stat.st_size,
+                                     'mtime_ns': stat.st_mtime_ns, 'sha256': huella})
+                    medida['ficheros'] += 1
+                    medida['bytes'] += stat.st_size
+
+                monitor = monitores.get(pantalla)
+                manifiesto = {
+                    'expo_id': self.expo_id,
+                    'pantalla': pantalla,
+                    'monitor': monitor._asdict() if monitor else None,
+                    'generado': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'ficheros': ficheros,
+                }
+                self._escribir(os.path.join(carpeta, self.LISTA), '#EXTM3U\n' + ''.join(f"{f['nombre']}\n" for f in ficheros))
+                self._escribir(os.path.join(carpeta, self.MANIFIESTO), json.dumps(manifiesto, indent=2, ensure_ascii=False))
+                manifiestos[pantalla] = manifiesto
+        log.info("Paquetes de %s: %s pantallas en %s", self.expo_id, len(manifiestos), self.carpeta_paquetes)
+        return manifiestos
+
+
+# --- Conexiones -------------------------------------------------------------
+#
+# Cada conexión es un único socket persistente que se reutiliza para todos los ficheros que sube
+# su hilo. Todas ofrecen las mismas operaciones, con rutas relativas ('P001/obra.mp4'):
+# leer, tamano, enviar (desde un desplazamiento, para reanudar), renombrar, borrar, crear_carpeta.
+
+class ConexionHTTP:
+    '''PUT/GET/HEAD/DELETE más MOVE de WebDAV para el renombrado. Reanuda con Content-Range.'''
+    ERRORES = (OSError, http.client.HTTPException)
+
+    def __init__(self, host, puerto=80, timeout=60):
+        self.conexion = http.client.HTTPConnection(host, puerto, timeout=timeout)
+
+    def _peticion(self, metodo, ruta, cuerpo=None, cabeceras=None):
+        self.conexion.request(metodo, '/' + quote(ruta), body=cuerpo, headers=cabeceras or {})
+        respuesta = self.conexion.getresponse()
+        # Leer siempre el cuerpo entero: si no, la conexión no se puede reutilizar
+        datos = respuesta.read()
+        if respuesta.status >= 400 and respuesta.status != 404:
+            raise http.client.HTTPException(f"{metodo} {ruta}: {respuesta.status} {respuesta.reason}")
+        return respuesta, datos
+
+    def leer(self, ruta):
+        respuesta, datos = self._peticion('GET', ruta)
+        return None if respuesta.status == 404 else datos
+
+    def tamano(self, ruta):
+        respuesta, _ = self._peticion('HEAD', ruta)
+        return None if respuesta.status == 404 else int(respuesta.getheader('Content-Length', 0))
+
+    def enviar(self, ruta, local, desde=0):
+        total = os.path.getsize(local)
+        cabeceras = {'Content-Length': str(total - desde)}
+        if desde:
+            cabeceras['Content-Range'] = f"bytes {desde}-{total - 1}/{total}"
+        with open(local, 'rb') as f:
+            f.seek(desde)
+            self._peticion('PUT', ruta, cuerpo=f, cabeceras=cabeceras)
+
+    def renombrar(self, origen, destino):
+        self._peticion('MOVE', origen, cabeceras={'Destination': '/' + quote(destino), 'Overwrite': 'T'})
+
+    def borrar(self, ruta):
+        self._peticion('DELETE', ruta)
+
+    def crear_carpeta(self, ruta):
+        # El PUT crea las carpetas que falten
+        pass
+
+    def cerrar(self):
+        self.conexion.close()
+
+
+class ConexionFTP:
+    '''FTP en modo binario. Reanuda con REST y comprueba tamaños con SIZE.'''
+    ERRORES = (OSError, EOFError) + ftplib.all_errors
+
+    def __init__(self, host, puerto=21, usuario='anonymous', clave='', timeout=60):
+        self.ftp = ftplib.FTP()
+        self.ftp.connect(host, puerto, timeout=timeout)
+        self.ftp.login(usuario, clave)
+        self.ftp.voidcmd('TYPE I')
+
+    def leer(self, ruta):
+        datos = []
+        try:
+            self.ftp.retrbinary(f"RETR {ruta}", datos.append)
+        except ftplib.error_perm:
+            return None
+        return b''.join(datos)
+
+    def tamano(self, ruta):
+        try:
+            return self.ftp.size(ruta)
+        except ftplib.error_perm:
+            return None
+
+    def enviar(self, ruta, local, desde=0):
+        with open(local, 'rb') as f:
+            f.seek(desde)
+            self.ftp.storbinary(f"STOR {ruta}", f, blocksize=1024 * 1024, rest=desde or None)
+
+    def renombrar(self, origen, destino):
+        self.borrar(destino)
+        self.ftp.rename(origen, destino)
+
+    def borrar(self, ruta):
+        try:
+            self.ftp.delete(ruta)
+        except ftplib.error_perm:
+            pass
+
+    def crear_carpeta(self, ruta):
+        try:
+            self.ftp.mkd(ruta)
+        except ftplib.error_perm:
+            pass
+
+    def cerrar(self):
+        try:
+            self.ftp.quit()
+        except self.ERRORES:
+            self.ftp.close()
+
+
+class Transferencia:
+    '''
+    Sube los paquetes a las pantallas.
+
+    - Paralelismo acotado: como mucho `max_pantallas` pantallas a la vez y `conexiones` por
+      pantalla. Cada hilo abre una conexión y la reutiliza para todos sus ficheros.
+    - Reanudación por huella: se lee el manifiesto remoto y solo se suben los ficheros cuya
+      SHA-256 ha cambiado. Cada fichero se sube a <nombre>.<huella>.part, continuando donde se
+      quedó si ya existe, y se renombra al terminar. El manifiesto se sube el último, así que
+      una subida interrumpida nunca deja en la pantalla un manifiesto que no corresponde.
+    - Reintentos: ante un error de red se abre una conexión nueva y se reanuda el fichero.
+    '''
+    def __init__(self, conectar, max_pantallas=4, conexiones=2, reintentos=3):
+        self.conectar = conectar
+        self.max_pantallas = max_pantallas
+        self.conexiones = conexiones
+        self.reintentos = reintentos
+
+    def subir(self, destinos):
+        '''
+        `destinos`: {pantalla: (carpeta del paquete, host)}. Devuelve {pantalla: Counter} con
+        subidos, omitidos, borrados, bytes y errores.
+        '''
+        resultados = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_pantallas, thread_name_prefix='pantalla') as executor:
+            futures = {executor.submit(self.subir_paquete, carpeta, host, PaquetesPantallas.nombre(pantalla)): pantalla
+                       for pantalla, (carpeta, host) in destinos.items()}
+            for future in concurrent.futures.as_completed(futures):
+                pantalla = futures[future]
+                try:
+                    resultados[pantalla] = future.result()
+                except Exception as e:
+                    log.error("No se pudo subir la pantalla %s: %s", pantalla, e)
+                    resultados[pantalla] = collections.Counter(errores=1)
+        return resultados
+
+    def subir_paquete(self, carpeta, host, remoto):
+        manifiesto = PaquetesPantallas.leer_manifiesto(carpeta)
+        if manifiesto is None:
+            raise FileNotFoundError(f"{carpeta} no tiene {PaquetesPantallas.MANIFIESTO}")
+        resultado = collections.Counter()
+        conexion = self.conectar(host)
+        try:
+            remoto_json = conexion.leer(f"{remoto}/{PaquetesPantallas.MANIFIESTO}")
+            en_pantalla = {f['nombre']: f['sha256'] for f in json.loads(remoto_json).get('ficheros', [])} if remoto_json else {}
+            conexion.crear_carpeta(remoto)
+
+            pendientes = queue.Queue()
+            for fichero in manifiesto['ficheros']:
+                if en_pantalla.get(fichero['nombre']) == fichero['sha256']:
+                    resultado['omitidos'] += 1
+                else:
+                    pendientes.put(fichero)
+
+            # La conexión ya abierta la usa el primer hilo; el resto abre la suya. Cada hilo
+            # cuenta en su propio Counter (el += de un Counter compartido pierde sumas)
+            parciales = [collections.Counter() for _ in range(min(self.conexiones, pendientes.qsize()))]
+            hilos = [threading.Thread(target=self._trabajar, args=(conexion if i == 0 else None, host, carpeta, remoto, pendientes, parcial),
+                                      name=f"{remoto}-{i}")
+                     for i, parcial in enumerate(parciales)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+            for parcial in parciales:
+                resultado.update(parcial)
+            if hilos:
+                conexion = self.conectar(host)
+
+            if resultado['errores']:
+                log.warning("%s en %s: %s errores, el manifiesto remoto no se actualiza", remoto, host, resultado['errores'])
+                return resultado
+
+            # Fuera lo que ya no está en el paquete; la lista y el manifiesto, al final
+            actuales = {f['nombre'] for f in manifiesto['ficheros']}
+            for nombre in set(en_pantalla) - actuales:
+                conexion.borrar(f"{remoto}/{nombre}")
+                resultado['borrados'] += 1
+            for nombre in (PaquetesPantallas.LISTA, PaquetesPantallas.MANIFIESTO):
+                conexion.enviar(f"{remoto}/{nombre}", os.path.join(carpeta, nombre))
+            log.info("%s en %s: %s", remoto, host, dict(resultado))
+            return resultado
+        finally:
+            conexion.cerrar()
+
+    def _trabajar(self, conexion, host, carpeta, remoto, pendientes, resultado):
+        try:
+            while True:
+                try:
+                    fichero = pendientes.get_nowait()
+                except queue.Empty:
+                    return
+                for intento in range(self.reintentos + 1):
+                    try:
+                        if conexion is None:
+                            conexion = self.conectar(host)
+                        resultado['bytes'] += self._subir_fichero(conexion, carpeta, remoto, fichero)
+                        resultado['subidos'] += 1
+                        break
+                    except (OSError, EOFError, http.client.HTTPException, ftplib.Error) as e:
+                        log.warning("%s/%s (intento %s): %s", remoto, fichero['nombre'], intento + 1, e)
+                        if conexion is not None:
+                            try:
+                                conexion.cerrar()
+                            except Exception:
+                                pass
+                        conexion = None
+                        time.sleep(min(2 ** intento, 10))
+                else:
+                    resultado['errores'] += 1
+        finally:
+            if conexion is not None:
+                conexion.cerrar()
+
+    @staticmethod
+    def _subir_fichero(conexion, carpeta, remoto, fichero):
+        '''Sube (o termina de subir) un fichero. Devuelve los bytes enviados.'''
+        local = os.path.join(carpeta, fichero['nombre'])
+        destino = f"{remoto}/{fichero['nombre']}"
+        parcial = f"{destino}.{fichero['sha256'][:12]}.part"
+        desde = conexion.tamano(parcial) or 0
+        if desde > fichero['bytes']:
+            conexion.borrar(parcial)
+            desde = 0
+        if desde < fichero['bytes']:
+            conexion.enviar(parcial, local, desde)
+        if conexion.tamano(parcial) != fichero['bytes']:
+            raise OSError(f"tamaño remoto distinto del local en {parcial}")
+        conexion.renombrar(parcial, destino)
+        return fichero['bytes'] - desde
+
+
+def exportar(expo_id, protocolo='ftp', host=None, puerto=None, usuario='anonymous', clave='',
+             pantallas=None, max_pantallas=4, conexiones=2):
+    '''Construye los paquetes y los sube. `host` sustituye a las IPs de hardware.md (pruebas).'''
+    monitores = leer_monitores()
+    paquetes = PaquetesPantallas(expo_id)
+    manifiestos = paquetes.construir(monitores)
+
+    destinos = {}
+    for pantalla in sorted(manifiestos):
+        if pantallas and pantalla not in pantallas:
+            continue
+        ip = host or (monitores[pantalla].ip if pantalla in monitores else None)
+        if not ip:
+            log.warning("La pantalla %s no tiene monitor en hardware.md, no se sube", pantalla)
+            continue
+        destinos[pantalla] = (paquetes.carpeta(pantalla), ip)
+
+    if protocolo == 'http':
+        conectar = lambda ip: ConexionHTTP(ip, puerto or 80)
+    else:
+        conectar = lambda ip: ConexionFTP(ip, puerto or 21, usuario, clave)
+
+    with Metricas.for_expo(expo_id).etapa('subir') as medida:
+        resultados = Transferencia(conectar, max_pantallas, conexiones).subir(destinos)
+        for resultado in resultados.values():
+            medida['ficheros'] += resultado['subidos']
+            medida['bytes'] += resultado['bytes']
+    return resultados
+
+
+# --- Servidor local de pruebas ----------------------------------------------
+
+class _ManejadorPantalla(http.server.BaseHTTPRequestHandler):
+    '''Hace de pantalla: guarda lo que recibe por PUT bajo la carpeta del servidor.'''
+    protocol_version = 'HTTP/1.1'
+
+    def _ruta(self, ruta_url=None):
+        relativa = unquote(urlsplit(ruta_url or self.path).path).lstrip('/')
+        raiz = os.path.realpath(self.server.carpeta)
+        ruta = os.path.realpath(os.path.join(raiz, relativa))
+        if ruta != raiz and not ruta.startswith(raiz + os.sep):
+            return None
+        return ruta
+
+    def _responder(self, estado, cuerpo=b'', longitud=None):
+        self.send_response(estado)
+        self.send_header('Content-Length', str(len(cuerpo) if longitud is None else longitud))
+        self.end_headers()
+        if cuerpo and self.command != 'HEAD':
+            self.wfile.write(cuerpo)
+
+    def do_GET(self):
+        ruta = self._ruta()
+        if not ruta or not os.path.isfile(ruta):
+            return self._responder(404)
+        with open(ruta, 'rb') as f:
+            self._responder(200, f.read())
+
+    def do_HEAD(self):
+        ruta = self._ruta()
+        if not ruta or not os.path.isfile(ruta):
+            return self._responder(404)
+        self._responder(200, longitud=os.path.getsize(ruta))
+
+    def do_PUT(self):
+        ruta = self._ruta()
+        if not ruta:
+            return self._responder(403)
+        restantes = int(self.headers.get('Content-Length', 0))
+        desde = 0
+        rango = re.match(r'bytes (\d+)-', self.headers.get('Content-Range', ''))
+        if rango:
+            desde = int(rango.group(1))
+            if desde != (os.path.getsize(ruta) if os.path.exists(ruta) else 0):
+                return self._responder(416)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'r+b' if desde else 'wb') as f:
+            f.seek(desde)
+            while restantes:
+                bloque = self.rfile.read(min(restantes, 1024 * 1024))
+                if not bloque:
+                    break
+                f.write(bloque)
+                restantes -= len(bloque)
+        self._responder(201)
+
+    def do_MOVE(self):
+        origen, destino = self._ruta(), self._ruta(self.headers.get('Destination', ''))
+        if not origen or not destino or not os.path.isfile(origen):
+            return self._responder(404)
+        os.replace(origen, destino)
+        self._responder(201)
+
+    def do_DELETE(self):
+        ruta = self._ruta()
+        if ruta and os.path.isfile(ruta):
+            os.remove(ruta)
+        self._responder(204)
+
+    def log_message(self, formato, *args):
+        log.debug("servidor: " + formato, *args)
+
+
+def servidor_http(carpeta, puerto=8080, host='127.0.0.1'):
+    '''Servidor HTTP de pruebas (sin arrancar: llamar a serve_forever).'''
+    os.makedirs(carpeta, exist_ok=True)
+    servidor = http.server.ThreadingHTTPServer((host, puerto), _ManejadorPantalla)
+    servidor.carpeta = carpeta
+    return servidor
+
+
+def servidor_ftp(carpeta, puerto=2121, host='127.0.0.1', usuario='pantalla', clave='pantalla'):
+    '''Servidor FTP de pruebas con pyftpdlib (pip install pyftpdlib); sin arrancar.'''
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+    except ImportError:
+        raise RuntimeError("El servidor FTP de pruebas necesita pyftpdlib: pip install pyftpdlib")
+    os.makedirs(carpeta, exist_ok=True)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(usuario, clave, carpeta, perm='elradfmwMT')
+    manejador = type('ManejadorFTP', (FTPHandler,), {'authorizer': authorizer})
+    return ThreadedFTPServer((host, puerto), manejador)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exportación de exposiciones a las pantallas')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    p_paquetes = subparsers.add_parser('paquetes', help='Genera un paquete por pantalla con su manifiesto')
+    p_paquetes.add_argument('expo_id')
+
+    p_subir = subparsers.add_parser('subir', help='Genera los paquetes y los sube a las pantallas')
+    p_subir.add_argument('expo_id')
+    p_subir.add_argument('--protocolo', choices=('ftp', 'http'), default='ftp')
+    p_subir.add_argument('--host', help='Subir todas las pantallas a este host (p. ej. el servidor de pruebas)')
+    p_subir.add_argument('--puerto', type=int)
+    p_subir.add_argument('--usuario', default='anonymous')
+    p_subir.add_argument('--clave', default='')
+    p_subir.add_argument('--pantallas', type=int, nargs='*', help='Solo estas pantallas')
+    p_subir.add_argument('--max-pantallas', type=int, default=4, help='Pantallas en paralelo')
+    p_subir.add_argument('--conexiones', type=int, default=2, help='Conexiones por pantalla')
+
+    p_servidor = subparsers.add_parser('servidor', help='Servidor local que hace de pantalla para pruebas')
+    p_servidor.add_argument('--carpeta', default='pantallas_prueba')
+    p_servidor.add_argument('--protocolo', choices=('ftp', 'http'), default='http')
+    p_servidor.add_argument('--puerto', type=int)
+    p_servidor.add_argument('--usuario', default='pantalla')
+    p_servidor.add_argument('--clave', default='pantalla')
+
+    args = parser.parse_args(argv)
+    configurar_logging()
+
+    if args.comando == 'paquetes':
+        PaquetesPantallas(args.expo_id).construir(leer_monitores())
+    elif args.comando == 'subir':
+        resultados = exportar(args.expo_id, args.protocolo, args.host, args.puerto, args.usuario, args.clave,
+                              args.pantallas, args.max_pantallas, args.conexiones)
+        for pantalla, resultado in sorted(resultados.items()):
+            print(f"{PaquetesPantallas.nombre(pantalla)}: {dict(resultado)}")
+        return 1 if any(r['errores'] for r in resultados.values()) else 0
+    elif args.comando == 'servidor':
+        if args.protocolo == 'ftp':
+            servidor = servidor_ftp(args.carpeta, args.puerto or 2121, usuario=args.usuario, clave=args.clave)
+        else:
+            servidor = servidor_http(args.carpeta, args.puerto or 8080)
+        print(f"Servidor {args.protocolo} de pruebas en {args.carpeta} (Ctrl+C para parar)")
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,25 @@
+# Configuración de gunicorn para servir Expo Manager en la red local.
+#   cd src && gunicorn -c gunicorn.conf.py wsgi:app
+import os
+import multiprocessing
+
+bind = os.environ.get('EXPO_BIND', '0.0.0.0:5000')
+
+# Varios procesos: navegar por una expo grande no bloquea /recodificar ni los streams SSE
+workers = int(os.environ.get('EXPO_WORKERS', min(4, multiprocessing.cpu_count())))
+# Hilos por worker: cada stream SSE y cada descarga de vídeo ocupa un hilo mientras dura
+worker_class = 'gthread'
+threads = int(os.environ.get('EXPO_THREADS', 16))
+
+# sendfile() para enviar los ficheros sin copiarlos al espacio de usuario
+sendfile = True
+
+# Los streams SSE y las descargas largas no deben cortarse por timeout
+timeout = 0
+keepalive = 5
+
+# Sin max_requests: reciclar un worker mataría la recodificación que se esté ejecutando en él
+max_requests = 0
+
+accesslog = '-'
+errorlog = '-'
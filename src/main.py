@@ -1,23 +1,54 @@
 import os
+import io
 import glob
 import shutil
 import re
 import pandas as pd
-from PIL import Image, ExifTags
+from PIL import Image, ImageOps, ExifTags
 import subprocess
 import json
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 from tqdm import tqdm
 import time
 import platform
 import sys
-from openpyxl import load_workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
+import threading
+import logging
+import contextlib
+import warnings
+import datetime
+import collections
+import queue as queue_module
+import hashlib
+import heapq
+import itertools
+import functools
+import copy
+import math
+import tempfile
+from urllib.parse import quote
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.table import Table, TableStyleInfo, TableColumn
 from flask import Flask
+import multiprocessing
 from multiprocessing import Manager
 
 app = Flask(__name__)
 
+log = logging.getLogger(__name__)
+
+
+def configurar_logging():
+    '''
+    Logging de la aplicación: nivel con EXPO_LOG_NIVEL (DEBUG, INFO, WARNING...), INFO por defecto.
+    En DEBUG aparece el detalle por fichero (comandos de ffmpeg, progreso, decisiones).
+    '''
+    nivel = os.environ.get('EXPO_LOG_NIVEL', 'INFO').upper()
+    logging.basicConfig(level=getattr(logging, nivel, logging.INFO),
+                        format='%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s')
+
 #activar el entorno virtual
 #source venv/bin/activate   
 
@@ -30,42 +61,141 @@ class FileManager:
             os.makedirs(path)
 
     @staticmethod
-    def unzip_output(zip_path, output_path):
+    def zip_members(zip_paths):
+        '''
+        Lista (zip_path, ZipInfo) de los ficheros a extraer, saltando directorios,
+        metadatos de macOS y ficheros ocultos.
+        '''
+        import zipfile
+        members = []
+        for zip_path in zip_paths:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                for file_info in zip_ref.infolist():
+                    if file_info.filename.startswith('__MACOSX') or file_info.filename.startswith('.'):
+                        continue  # Saltar archivos específicos de macOS y archivos ocultos
+                    # Saltar directorios vacíos
+                    if file_info.is_dir() or os.path.basename(file_info.filename) == '.DS_Store':
+                        continue
+                    members.append((zip_path, file_info))
+        return members
+
+    @staticmethod
+    def check_free_space(members, destino, margen=1.05):
+        '''Comprueba antes de extraer que hay espacio para el contenido descomprimido (más un margen).'''
+        necesario = sum(file_info.file_size for _, file_info in members) * margen
+        FileManager.ensure_directory(destino)
+        libre = shutil.disk_usage(destino).free
+        if necesario > libre:
+            raise OSError(f"Espacio insuficiente en {destino}: se necesitan {necesario / 1024 ** 3:.2f} GB "
+                          f"y hay {libre / 1024 ** 3:.2f} GB libres")
+        return necesario
+
+    @staticmethod
+    def extract_members(targets, max_workers=None):
+        '''
+        Extrae en paralelo una lista de (zip_path, ZipInfo, ruta_destino). Cada hilo abre su propio
+        ZipFile y escribe a un temporal propio que se renombra al final, así que nunca queda un
+        fichero a medio escribir con el nombre definitivo. Si varios miembros van a la misma ruta
+        (mismo nombre en carpetas o zips distintos), se queda el último, como al copiarlos uno tras
+        otro, y los demás no se extraen. Devuelve el número de ficheros extraídos.
+        '''
         import zipfile
-        import os
+        locales = threading.local()
+
+        ultimos = {}
+        for target in targets:
+            anterior = ultimos.pop(target[2], None)
+            if anterior is not None:
+                log.warning("%s y %s van a %s: se descarta el primero", anterior[1].filename, target[1].filename, target[2])
+            ultimos[target[2]] = target
+        targets = list(ultimos.values())
+
+        def abrir(zip_path):
+            abiertos = getattr(locales, 'zips', None)
+            if abiertos is None:
+                abiertos = locales.zips = {}
+            if zip_path not in abiertos:
+                abiertos[zip_path] = zipfile.ZipFile(zip_path, 'r')
+            return abiertos[zip_path]
+
+        def extraer(indice, zip_path, file_info, target_path):
+            tmp_path = f"{target_path}.{indice}.part"
+            try:
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                with abrir(zip_path).open(file_info) as source, open(tmp_path, "wb") as target:
+                    shutil.copyfileobj(source, target, 1024 * 1024)
+                os.replace(tmp_path, target_path)
+                # Conservar la fecha original del fichero dentro del zip
+                mtime = time.mktime(file_info.date_time + (0, 0, -1))
+                os.utime(target_path, (mtime, mtime))
+                return True
+            except Exception as e:
+                log.error("Error al extraer %s: %s", file_info.filename, e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return False
 
+        max_workers = max_workers or min(8, (os.cpu_count() or 1) + 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='unzip') as executor:
+            futures = [executor.submit(extraer, indice, *target) for indice, target in enumerate(targets)]
+            extraidos = sum(1 for future in concurrent.futures.as_completed(futures) if future.result())
+        return extraidos
+
+    @staticmethod
+    def unzip_output(zip_path, output_path):
         obras_path = os.path.join(output_path, 'Obras')
         os.makedirs(obras_path, exist_ok=True)
 
         # Buscar todos los archivos zip en la carpeta
         zip_files = glob.glob(os.path.join(output_path, "*.zip"))
-        
-        for zip_path in zip_files:
-            print(f"Procesando archivo zip: {zip_path}")
-            
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                for file_info in zip_ref.infolist():
-                    if file_info.filename.startswith('__MACOSX') or file_info.filename.startswith('.'):
-                        continue  # Saltar archivos específicos de macOS y archivos ocultos
-                    
-                    # Mantener la estructura de carpetas interna
-                    target_path = os.path.join(obras_path, file_info.filename)
-                    
-                    # Saltar directorios vacos
-                    if file_info.filename.endswith('/'):
-                        continue
+        members = FileManager.zip_members(zip_files)
+        FileManager.check_free_space(members, obras_path)
 
-                    # Extraer el archivo
-                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-                    
-                    try:
-                        with zip_ref.open(file_info) as source, open(target_path, "wb") as target:
-                            shutil.copyfileobj(source, target)
-                    except Exception as e:
-                        print(f"Error al extraer {file_info.filename}: {str(e)}")
+        targets = []
+        raiz = os.path.realpath(obras_path)
+        for member_zip, file_info in members:
+            # Mantener la estructura de carpetas interna
+            target_path = os.path.realpath(os.path.join(obras_path, file_info.filename))
+            if not target_path.startswith(raiz + os.sep):
+                log.warning("Ruta fuera de la carpeta de destino, se ignora: %s", file_info.filename)
+                continue
+            targets.append((member_zip, file_info, target_path))
+
+        FileManager.extract_members(targets)
+        log.debug("Contenido descomprimido en: %s", obras_path)
+
+    @staticmethod
+    def destination_path(relative_path, carpeta_destino, id_expo):
+        '''
+        Ruta final de un fichero según la carpeta que lo contiene: los que están en una carpeta
+        "PANTALLA N" pasan a llamarse {id_expo}_PNNN_{nombre}; el resto va a la carpeta varios.
+        '''
+        file_name = os.path.basename(relative_path)
+        parent_folder = os.path.basename(os.path.dirname(relative_path.rstrip('/')))
+        partes = parent_folder.split()
+        if parent_folder.startswith('PANTALLA') and len(partes) > 1:
+            pantalla_num = partes[1].zfill(3)
+            return os.path.join(carpeta_destino, f"{id_expo}_P{pantalla_num}_{file_name}")
+        return os.path.join(carpeta_destino, 'varios', file_name)
 
-        print(f"Contenido descomprimido en: {obras_path}")
+    @staticmethod
+    def extract_to_destination(zip_paths, carpeta_destino, id_expo, max_workers=None):
+        '''
+        Descomprime los zips directamente en ficheros_salida con el nombre definitivo
+        ({id_expo}_PNNN_...), sin pasar por la carpeta intermedia Obras: cada byte se escribe una vez.
+        '''
+        with Metricas.for_expo(id_expo).etapa('descomprimir') as medida:
+            members = FileManager.zip_members(zip_paths)
+            FileManager.check_free_space(members, carpeta_destino)
+            FileManager.ensure_directory(os.path.join(carpeta_destino, 'varios'))
 
+            targets = [(zip_path, file_info, FileManager.destination_path(file_info.filename, carpeta_destino, id_expo))
+                       for zip_path, file_info in members]
+            extraidos = FileManager.extract_members(targets, max_workers)
+            medida['ficheros'] = extraidos
+            medida['bytes'] = sum(file_info.file_size for _, file_info in members)
+        log.info("%s ficheros descomprimidos en: %s", extraidos, carpeta_destino)
+        return extraidos
 
     @staticmethod
     #Copia los ficheros de la carpeta origen a la carpeta destino, renombrando los ficheros según el formato de la pantalla
@@ -74,51 +204,206 @@ class FileManager:
         varios_folder = os.path.join(carpeta_destino, 'varios')
         FileManager.ensure_directory(varios_folder)
         
-        for root, _, files in os.walk(carpeta_origen):
+        with Metricas.for_expo(id_expo).etapa('copiar') as medida:
+            for root, _, files in os.walk(carpeta_origen):
+                for file_name in files:
+                    if file_name == '.DS_Store':
+                        continue
+
+                    file_path = os.path.join(root, file_name)
+                    new_file_path = FileManager.destination_path(os.path.relpath(file_path, carpeta_origen),
+                                                                 carpeta_destino, id_expo)
+
+                    try:
+                        # Si ya existe y está enlazado con originales, no se escribe encima de la copia
+                        FileManager.break_link(new_file_path)
+                        shutil.copy2(file_path, new_file_path)
+                        medida['ficheros'] += 1
+                        medida['bytes'] += os.path.getsize(new_file_path)
+                    except Exception as e:
+                        log.error("Error al copiar %s: %s", file_path, e)
+
+    # Modos de copia de seguridad, de más barato a más caro
+    BACKUP_REFLINK = 'reflink'
+    BACKUP_HARDLINK = 'enlace'
+    BACKUP_COPY = 'copia'
+    BACKUP_MODES = (BACKUP_REFLINK, BACKUP_HARDLINK, BACKUP_COPY)
+
+    # ioctl FICLONE de Linux (_IOW(0x94, 9, int)), soportado por Btrfs, XFS, bcachefs...
+    _FICLONE = 0x40049409
+
+    @staticmethod
+    def reflink_file(src, dst):
+        '''
+        Clona `src` en `dst` con copy-on-write: no se escriben datos y los dos ficheros
+        se separan solos al modificar cualquiera de ellos. Lanza OSError si el sistema
+        de ficheros no lo soporta.
+        '''
+        if platform.system() == 'Darwin':
+            # APFS: cp -c usa clonefile(2)
+            resultado = subprocess.run(['cp', '-c', '-p', src, dst], capture_output=True, text=True)
+            if resultado.returncode != 0:
+                if os.path.exists(dst):
+                    os.remove(dst)
+                raise OSError(resultado.stderr.strip() or 'clonefile no soportado')
+            return
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FileManager._FICLONE, fsrc.fileno())
+            except OSError:
+                fdst.close()
+                os.remove(dst)
+                raise
+        shutil.copystat(src, dst)
+
+    @staticmethod
+    def break_link(file_path):
+        '''
+        Separa un fichero de su copia de seguridad enlazada antes de modificarlo en sitio:
+        si el inodo tiene más de un enlace, lo sustituye por una copia propia y escribible.
+        Los reflinks no lo necesitan (el sistema de ficheros ya copia al escribir).
+        '''
+        if not os.path.isfile(file_path) or os.stat(file_path).st_nlink < 2:
+            return False
+        tmp_path = f"{file_path}.part"
+        shutil.copy2(file_path, tmp_path)
+        os.chmod(tmp_path, os.stat(tmp_path).st_mode | 0o200)
+        os.replace(tmp_path, file_path)
+        return True
+
+    @staticmethod
+    def backup_files(origen, destino, modo=None):
+        '''
+        Copia de seguridad de `origen` en `destino` sin duplicar datos cuando el sistema de
+        ficheros lo permite. Por defecto prueba, por este orden, reflink (copy-on-write),
+        enlace duro y copia normal, y se queda con el primero que funciona. Con `modo`
+        se fuerza uno concreto (se usa en el benchmark).
+
+        Garantía de que cambios posteriores en `origen` no alteran la copia:
+        - reflink: el sistema de ficheros separa los datos al escribir.
+        - enlace duro: ambos nombres comparten inodo, así que se marca como solo lectura
+          (una escritura en sitio falla en vez de modificar la copia) y quien necesite
+          modificar un fichero de `origen` debe llamar antes a FileManager.break_link.
+          Renombrar, borrar o sustituir con os.replace (lo que hace el pipeline) es seguro.
+
+        Devuelve un Counter con cuántos ficheros se han hecho con cada modo.
+        '''
+        modos = FileManager.BACKUP_MODES if modo is None else (modo,)
+        # El primer modo que falla con un fichero no se reintenta con los siguientes
+        descartados = set()
+        resultado = collections.Counter()
+
+        for root, _, files in os.walk(origen):
+            destino_root = os.path.join(destino, os.path.relpath(root, origen))
+            FileManager.ensure_directory(destino_root)
             for file_name in files:
-                if file_name == '.DS_Store':
-                    continue
-                
-                file_path = os.path.join(root, file_name)
-                parent_folder = os.path.basename(os.path.dirname(file_path))
-                
-                if parent_folder.startswith('PANTALLA'):
-                    pantalla_num = parent_folder.split()[1].zfill(3)
-                    new_file_name = f"{id_expo}_P{pantalla_num}_{file_name}"
-                    new_file_path = os.path.join(carpeta_destino, new_file_name)
+                s = os.path.join(root, file_name)
+                d = os.path.join(destino_root, file_name)
+                if os.path.lexists(d):
+                    os.remove(d)
+                for actual in modos:
+                    if actual in descartados:
+                        continue
+                    try:
+                        if actual == FileManager.BACKUP_REFLINK:
+                            FileManager.reflink_file(s, d)
+                        elif actual == FileManager.BACKUP_HARDLINK:
+                            os.link(s, d)
+                            # Solo lectura en el inodo compartido: protege la copia de escrituras en sitio
+                            os.chmod(d, os.stat(d).st_mode & ~0o222)
+                        else:
+                            shutil.copy2(s, d)
+                        resultado[actual] += 1
+                        break
+                    except OSError as e:
+                        if actual == FileManager.BACKUP_COPY:
+                            raise
+                        descartados.add(actual)
+                        log.warning("Copia de seguridad: '%s' no disponible (%s), se prueba el siguiente modo", actual, e)
                 else:
-                    new_file_path = os.path.join(varios_folder, file_name)
-                
-                try:
-                    shutil.copy2(file_path, new_file_path)
-                except Exception as e:
-                    print(f"Error al copiar {file_path}: {str(e)}")
+                    raise OSError(f"No se pudo hacer la copia de seguridad de {s} con el modo {modo}")
+
+        resumen = ', '.join(f"{n} {m}" for m, n in resultado.items()) or 'sin ficheros'
+        log.info("Copia de seguridad en %s: %s", destino, resumen)
+        return resultado
 
     @staticmethod
     #Mueve los ficheros que no coinciden con el formato de la pantalla a la carpeta varios
     def move_non_matching_files(carpeta_destino, varios_folder, expo_id):
         patron = re.compile(f"^{expo_id}_P\d{{3}}_")
-        for file in os.listdir(carpeta_destino):
-            file_path = os.path.join(carpeta_destino, file)
-            if os.path.isfile(file_path) and not patron.match(file):
-                destino = os.path.join(varios_folder, file)
-                try:
-                    shutil.move(file_path, destino)
-                except Exception as e:
-                    print(f"Error al mover {file}: {str(e)}")
+        with Metricas.for_expo(expo_id).etapa('renombrar') as medida:
+            for file in os.listdir(carpeta_destino):
+                file_path = os.path.join(carpeta_destino, file)
+                if os.path.isfile(file_path) and not patron.match(file):
+                    destino = os.path.join(varios_folder, file)
+                    try:
+                        shutil.move(file_path, destino)
+                        medida['ficheros'] += 1
+                    except Exception as e:
+                        log.error("Error al mover %s: %s", file, e)
 
     @staticmethod
     def is_video(file_path):
         video_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv']
         return any(file_path.lower().endswith(ext) for ext in video_extensions)
 
+class ImageLoader:
+    '''
+    Capa común de lectura de imágenes.
+
+    - open_header: solo lee la cabecera (tamaño, formato, modo, DPI), sin decodificar píxeles.
+    - load_preview: decodifica a resolución reducida para miniaturas. En JPEG usa draft(),
+      que hace el escalado DCT dentro del propio decodificador (1/2, 1/4 o 1/8); en el resto
+      de formatos reduce primero con reduce() (promedio por bloques) y remata con BILINEAR.
+    '''
+    @staticmethod
+    def open_header(file_path):
+        '''
+        Abre la imagen sin decodificarla. PIL solo lee la cabecera hasta que se accede a los
+        píxeles, así que size, format, mode e info están disponibles sin coste de decodificación.
+        '''
+        return Image.open(file_path)
+
+    @staticmethod
+    def load_preview(file_path, size=(200, 200)):
+        '''Devuelve una imagen RGB que cabe en `size`, decodificando lo mínimo posible.'''
+        with Image.open(file_path) as img:
+            if img.format == 'JPEG':
+                # Pedimos el doble del tamaño final para conservar calidad tras el reescalado
+                escala = min(size[0] / img.size[0], size[1] / img.size[1])
+                img.draft('RGB', (int(img.size[0] * escala * 2), int(img.size[1] * escala * 2)))
+            else:
+                img.load()
+            preview = ImageLoader._reduce(img, size)
+            if preview.mode != 'RGB':
+                preview = preview.convert('RGB')
+            return preview
+
+    @staticmethod
+    def _reduce(img, size):
+        ancho, alto = img.size
+        factor = min(ancho // (size[0] * 2), alto // (size[1] * 2))
+        if factor > 1:
+            # PNG y similares: reduce() es mucho más barato que un LANCZOS sobre la imagen completa
+            if img.mode in ('P', '1'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            elif img.mode in ('I;16', 'I;16B', 'I', 'F'):
+                img = img.convert('RGB')
+            img = img.reduce(factor)
+        else:
+            img = img.copy()
+        img.thumbnail(size, Image.Resampling.BILINEAR, reducing_gap=None)
+        return img
+
 class ImageInfo:
     @staticmethod
     def get_image_info(file_path):
         try:
-            with Image.open(file_path) as img:
+            # Solo se lee la cabecera: no hace falta decodificar los píxeles para obtener los metadatos
+            with ImageLoader.open_header(file_path) as img:
                 width, height = img.size
-                
+
                 # Manejo especial de DPI para PNG
                 if img.format == 'PNG':
                     # Buscar la información de DPI en los metadatos específicos de PNG
@@ -155,7 +440,7 @@ class ImageInfo:
                     'TAMAÑO_MB': round(file_size_mb, 2)
                 }
         except Exception as e:
-            print(f"Error procesando {file_path}: {e}")
+            log.error("Error procesando %s: %s", file_path, e)
             return None
                 
     @staticmethod
@@ -163,39 +448,8 @@ class ImageInfo:
         '''
         Recorre solo el directorio raíz especificado y crea un DataFrame con las características de las imágenes.
         '''
-        images_info = []
-        
-        for file_name in os.listdir(directory_path):
-            file_path = os.path.join(directory_path, file_name)
-            
-            # Ignorar subdirectorios
-            if os.path.isdir(file_path):
-                continue
-            
-            # Intentar abrir el archivo como imagen
-            try:
-                with Image.open(file_path):
-                    pass  # Si no lanza una excepción, es una imagen
-            except IOError:
-                # No es una imagen o está corrupta
-                print(f"Archivo no es una imagen o está corrupto: {file_path}")
-                continue
-            
-            # Obtener información de la imagen
-            info = ImageInfo.get_image_info(file_path)
-            if info:
-                info['NOMBRE_ARCHIVO'] = file_name
-                
-                # Extraer el número de pantalla
-                match = re.search(r'_P(\d{3})_', file_name)
-                if match:
-                    info['NUMERO_PANTALLA'] = int(match.group(1))
-                else:
-                    info['NUMERO_PANTALLA'] = None
-                
-                images_info.append(info)
-    
-        return pd.DataFrame(images_info)
+        # Una sola apertura por fichero: get_image_info devuelve None si no es una imagen o está corrupta
+        return MediaInspector().inspect_directory(directory_path, inspector=ImageInfo.get_image_info)
 
 class VideoInfo:
     @staticmethod
@@ -238,8 +492,442 @@ class VideoInfo:
                     'NOMBRE_ARCHIVO': os.path.basename(file_path)
                 }
         except Exception as e:
-            print(f"Error procesando el video {file_path}: {e}")
+            log.error("Error procesando el video %s: %s", file_path, e)
+            return None
+
+    @staticmethod
+    def get_duration(file_path):
+        '''
+        Duración exacta en segundos (float) según ffprobe, o None si no se puede obtener.
+        '''
+        probe_cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1',
+            file_path
+        ]
+        try:
+            return float(subprocess.check_output(probe_cmd).decode().strip())
+        except Exception as e:
+            log.warning("No se pudo obtener la duración de %s: %s", file_path, e)
+            return None
+
+class FFmpegRunner:
+    '''
+    Ejecuta ffmpeg y calcula el progreso real a partir de la salida de `-progress pipe:1`.
+
+    stdout (progreso en bloques clave=valor) y stderr (log de ffmpeg) se leen cada uno en su
+    propio hilo, así que ninguna de las dos tuberías puede llenarse y bloquear a ffmpeg.
+    `on_progress` recibe un diccionario con percent, eta (segundos), speed (x tiempo real),
+    fps y frame cada vez que ffmpeg emite un bloque de progreso.
+    '''
+    STDERR_LINEAS = 50
+
+    def __init__(self, cmd, duration=None, on_progress=None, label=''):
+        self.cmd = self._with_progress(cmd)
+        self.duration = duration
+        self.on_progress = on_progress
+        self.label = label
+        self.stderr_tail = collections.deque(maxlen=self.STDERR_LINEAS)
+        self.last_progress = {}
+        self.process = None
+
+    @staticmethod
+    def _with_progress(cmd):
+        # Sustituir cualquier -progress previo por la salida estándar y silenciar las estadísticas de stderr
+        cmd = list(cmd)
+        if '-progress' in cmd:
+            i = cmd.index('-progress')
+            del cmd[i:i + 2]
+        return [cmd[0], '-hide_banner', '-nostats', '-progress', 'pipe:1'] + cmd[1:]
+
+    def run(self):
+        '''Lanza ffmpeg, espera a que termine y devuelve el código de retorno.'''
+        self.start_time = time.time()
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1
+        )
+        lector_progreso = threading.Thread(target=self._read_progress, daemon=True)
+        lector_errores = threading.Thread(target=self._read_stderr, daemon=True)
+        lector_progreso.start()
+        lector_errores.start()
+
+        return_code = self.process.wait()
+        lector_progreso.join()
+        lector_errores.join()
+        return return_code
+
+    def cancel(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            line = line.rstrip()
+            if line:
+                self.stderr_tail.append(line)
+
+    def _read_progress(self):
+        bloque = {}
+        for line in self.process.stdout:
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                continue
+            bloque[key] = value
+            # Cada bloque termina con progress=continue o progress=end
+            if key == 'progress':
+                self._report(bloque)
+                bloque = {}
+
+    @staticmethod
+    def _parse_float(value):
+        try:
+            return float(str(value).rstrip('x'))
+        except (TypeError, ValueError):
+            return None
+
+    def _out_time_seconds(self, bloque):
+        # out_time_ms también está en microsegundos (herencia de versiones antiguas de ffmpeg)
+        for key in ('out_time_us', 'out_time_ms'):
+            micros = self._parse_float(bloque.get(key))
+            if micros is not None:
+                return max(0.0, micros / 1_000_000)
+        return None
+
+    def _report(self, bloque):
+        terminado = bloque.get('progress') == 'end'
+        out_time = self._out_time_seconds(bloque)
+        elapsed = time.time() - self.start_time
+        speed = self._parse_float(bloque.get('speed'))
+        if not speed and out_time and elapsed > 0:
+            speed = out_time / elapsed
+
+        percent = None
+        eta = None
+        if terminado:
+            percent, eta = 100.0, 0.0
+        elif self.duration and out_time is not None:
+            percent = min(99.9, out_time / self.duration * 100)
+            if speed:
+                eta = max(0.0, (self.duration - out_time) / speed)
+
+        self.last_progress = {
+            'percent': percent,
+            'eta': eta,
+            'speed': speed,
+            'fps': self._parse_float(bloque.get('fps')),
+            'frame': int(self._parse_float(bloque.get('frame')) or 0),
+            'out_time': out_time,
+            'elapsed': elapsed,
+            'done': terminado,
+        }
+        if self.on_progress:
+            try:
+                self.on_progress(self.last_progress)
+            except Exception as e:
+                log.error("[%s] Error notificando progreso: %s", self.label, e)
+
+class ThumbnailCache:
+    '''
+    Caché en disco de las miniaturas de una exposición.
+
+    Cada miniatura se guarda en `expos/<expo_id>/.miniaturas` con un nombre que incluye
+    el nombre del fichero original, su mtime y su tamaño, de modo que si el original
+    cambia se genera una nueva y la anterior se descarta.
+    '''
+    CARPETA = '.miniaturas'
+    TAMANO = (200, 200)
+    EXTENSIONES = ('.png', '.jpg', '.jpeg')
+
+    # Locks compartidos entre instancias para no generar dos veces la misma miniatura
+    _locks = {}
+    _locks_guard = threading.Lock()
+    # Hilos de generación en segundo plano activos, por exposición
+    _hilos = {}
+
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.full_output_path = os.path.join(os.getcwd(), 'expos', expo_id)
+        self.carpeta_origen = os.path.join(self.full_output_path, 'ficheros_salida')
+        self.carpeta_cache = os.path.join(self.full_output_path, self.CARPETA)
+
+    @staticmethod
+    def cache_key(file_path):
+        '''Clave de caché a partir del mtime y el tamaño del fichero.'''
+        stat = os.stat(file_path)
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def source_path(self, filename):
+        '''Ruta del original o None si no es una imagen válida de ficheros_salida.'''
+        if os.path.basename(filename) != filename or not filename.lower().endswith(self.EXTENSIONES):
+            return None
+        file_path = os.path.join(self.carpeta_origen, filename)
+        if not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    def thumbnail_path(self, filename, key):
+        return os.path.join(self.carpeta_cache, f"{filename}.{key}.jpg")
+
+    def url(self, filename):
+        '''URL versionada de la miniatura, para que el navegador pueda cachearla indefinidamente.'''
+        file_path = self.source_path(filename)
+        if file_path is None:
+            return None
+        return f"/thumbs/{quote(self.expo_id)}/{quote(filename)}?v={self.cache_key(file_path)}"
+
+    def _lock_for(self, thumb_path):
+        with self._locks_guard:
+            return self._locks.setdefault(thumb_path, threading.Lock())
+
+    def get(self, filename):
+        '''
+        Devuelve (ruta_miniatura, clave), generándola si no existe o si el original ha cambiado.
+        Devuelve (None, None) si el fichero no existe o no se puede leer.
+        '''
+        file_path = self.source_path(filename)
+        if file_path is None:
+            return None, None
+
+        key = self.cache_key(file_path)
+        thumb_path = self.thumbnail_path(filename, key)
+        if os.path.exists(thumb_path):
+            return thumb_path, key
+
+        with self._lock_for(thumb_path):
+            # Otro hilo pudo generarla mientras esperábamos el lock
+            if not os.path.exists(thumb_path):
+                if not self._generate(file_path, thumb_path):
+                    return None, None
+                self._remove_stale(filename, thumb_path)
+        return thumb_path, key
+
+    def _generate(self, file_path, thumb_path):
+        FileManager.ensure_directory(self.carpeta_cache)
+        tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            ImageLoader.load_preview(file_path, self.TAMANO).save(tmp_path, 'JPEG', quality=80)
+            # Reemplazo atómico: nunca se sirve una miniatura a medio escribir
+            os.replace(tmp_path, thumb_path)
+            return True
+        except Exception as e:
+            log.error("Error creando miniatura para %s: %s", file_path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def _remove_stale(self, filename, thumb_path):
+        '''Elimina miniaturas de versiones anteriores del mismo fichero.'''
+        for old_path in glob.glob(os.path.join(glob.escape(self.carpeta_cache), glob.escape(filename) + '.*.jpg')):
+            if old_path != thumb_path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def build_all(self):
+        '''Genera las miniaturas que falten para todas las imágenes de ficheros_salida.'''
+        if not os.path.exists(self.carpeta_origen):
+            return 0
+        generadas = 0
+        for filename in os.listdir(self.carpeta_origen):
+            if self.source_path(filename) and self.get(filename)[0]:
+                generadas += 1
+        log.info("Miniaturas disponibles para %s: %s", self.expo_id, generadas)
+        return generadas
+
+    def build_in_background(self):
+        '''Lanza build_all en un hilo daemon, salvo que ya haya uno en marcha para esta expo.'''
+        with self._locks_guard:
+            hilo = self._hilos.get(self.expo_id)
+            if hilo and hilo.is_alive():
+                return hilo
+            hilo = threading.Thread(target=self.build_all, name=f"miniaturas-{self.expo_id}", daemon=True)
+            self._hilos[self.expo_id] = hilo
+        hilo.start()
+        return hilo
+
+class VideoPreviewCache:
+    '''
+    Previsualizaciones de los vídeos de una exposición para la galería.
+
+    Por cada vídeo de ficheros_salida se genera una sola vez, en segundo plano, un proxy
+    ligero (360 píxeles en el lado corto, H.264 a baja tasa de bits) y un póster JPEG de un
+    fotograma cercano al inicio. Se guardan en `expos/<expo_id>/.previsualizaciones` con la
+    misma clave de versión que las miniaturas (mtime y tamaño del original), así que la
+    galería solo descarga el original cuando se abre explícitamente.
+    '''
+    CARPETA = '.previsualizaciones'
+    EXTENSIONES = ('.mp4',)
+    POSTER = 'poster'
+    PROXY = 'proxy'
+    TIPOS = {POSTER: 'jpg', PROXY: 'mp4'}
+
+    LADO_CORTO = 360
+    PROXY_CRF = 28
+    PROXY_MAXRATE = '1M'
+    # Segundo del que se toma el póster (o el 10 % de la duración si el vídeo es más corto)
+    POSTER_SEGUNDO = 1.0
+
+    _locks = {}
+    _locks_guard = threading.Lock()
+    _hilos = {}
+
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.full_output_path = os.path.join(os.getcwd(), 'expos', expo_id)
+        self.carpeta_origen = os.path.join(self.full_output_path, 'ficheros_salida')
+        self.carpeta_cache = os.path.join(self.full_output_path, self.CARPETA)
+
+    def source_path(self, filename):
+        '''Ruta del vídeo original o None si no es un vídeo válido de ficheros_salida.'''
+        if os.path.basename(filename) != filename or not filename.lower().endswith(self.EXTENSIONES):
+            return None
+        file_path = os.path.join(self.carpeta_origen, filename)
+        if not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    def preview_path(self, filename, tipo, key):
+        return os.path.join(self.carpeta_cache, f"{filename}.{key}.{tipo}.{self.TIPOS[tipo]}")
+
+    def url(self, filename, tipo):
+        '''
+        URL versionada del póster o del proxy. El póster se genera bajo demanda si hace falta;
+        el proxy solo se anuncia cuando ya está generado (si no, devuelve None).
+        '''
+        file_path = self.source_path(filename)
+        if file_path is None:
+            return None
+        key = ThumbnailCache.cache_key(file_path)
+        if tipo == self.PROXY and not os.path.exists(self.preview_path(filename, tipo, key)):
             return None
+        return f"/previews/{quote(self.expo_id)}/{tipo}/{quote(filename)}?v={key}"
+
+    def pending(self, filename):
+        '''True si al vídeo le falta alguna previsualización.'''
+        file_path = self.source_path(filename)
+        if file_path is None:
+            return False
+        key = ThumbnailCache.cache_key(file_path)
+        return not all(os.path.exists(self.preview_path(filename, tipo, key)) for tipo in self.TIPOS)
+
+    def _lock_for(self, path):
+        with self._locks_guard:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def get(self, filename, tipo, generar=True):
+        '''
+        Devuelve (ruta, clave) de la previsualización, generándola si falta y `generar` es True.
+        Devuelve (None, None) si el vídeo no existe o no se ha podido generar.
+        '''
+        file_path = self.source_path(filename)
+        if file_path is None or tipo not in self.TIPOS:
+            return None, None
+
+        key = ThumbnailCache.cache_key(file_path)
+        preview_path = self.preview_path(filename, tipo, key)
+        if os.path.exists(preview_path):
+            return preview_path, key
+        if not generar:
+            return None, None
+
+        with self._lock_for(preview_path):
+            if not os.path.exists(preview_path):
+                if not self._generate(file_path, tipo, preview_path):
+                    return None, None
+                self._remove_stale(filename, tipo, preview_path)
+        return preview_path, key
+
+    def escala(self):
+        # 360 píxeles en el lado corto, tanto en vídeos horizontales como verticales
+        lado = self.LADO_CORTO
+        return f"scale='if(gt(iw,ih),-2,{lado})':'if(gt(iw,ih),{lado},-2)'"
+
+    def segundo_poster(self, file_path, duracion=None):
+        if duracion is None:
+            duracion = VideoInfo.get_duration(file_path) or 0
+        return min(self.POSTER_SEGUNDO, duracion * 0.1)
+
+    def argumentos_proxy(self):
+        '''Codificación del proxy (sin entrada, filtros ni salida).'''
+        return [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(self.PROXY_CRF),
+            '-maxrate', self.PROXY_MAXRATE, '-bufsize', '2M', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '64k',
+            '-movflags', '+faststart',
+            '-f', 'mp4'
+        ]
+
+    def comando(self, file_path, tipo, salida):
+        if tipo == self.POSTER:
+            # -ss antes de -i: salto directo al keyframe más cercano sin decodificar lo anterior
+            return [
+                'ffmpeg', '-y', '-ss', f"{self.segundo_poster(file_path):.3f}", '-i', file_path,
+                '-frames:v', '1', '-vf', self.escala(), '-q:v', '4',
+                '-f', 'image2', salida
+            ]
+        return (['ffmpeg', '-y', '-i', file_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', self.escala()]
+                + self.argumentos_proxy() + [salida])
+
+    def guardar(self, filename, tipo, tmp_path, preview_path):
+        '''Coloca una previsualización generada en `tmp_path` y retira las de versiones anteriores.'''
+        os.replace(tmp_path, preview_path)
+        self._remove_stale(filename, tipo, preview_path)
+
+    def _generate(self, file_path, tipo, preview_path):
+        FileManager.ensure_directory(self.carpeta_cache)
+        tmp_path = f"{preview_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        runner = FFmpegRunner(self.comando(file_path, tipo, tmp_path), label=os.path.basename(file_path))
+        try:
+            if runner.run() != 0 or not os.path.exists(tmp_path):
+                log.error("Error creando %s para %s: %s", tipo, file_path, runner.stderr_tail[-1] if runner.stderr_tail else '')
+                return False
+            os.replace(tmp_path, preview_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _remove_stale(self, filename, tipo, preview_path):
+        '''Elimina previsualizaciones de versiones anteriores del mismo vídeo.'''
+        patron = f"{glob.escape(filename)}.*.{tipo}.{self.TIPOS[tipo]}"
+        for old_path in glob.glob(os.path.join(glob.escape(self.carpeta_cache), patron)):
+            if old_path != preview_path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def build_all(self):
+        '''
+        Genera las previsualizaciones que falten: primero todos los pósters (un fotograma
+        cada uno) para que la galería tenga imagen cuanto antes, después los proxies.
+        '''
+        if not os.path.exists(self.carpeta_origen):
+            return 0
+        videos = sorted(f for f in os.listdir(self.carpeta_origen) if self.source_path(f))
+        for tipo in (self.POSTER, self.PROXY):
+            for filename in videos:
+                self.get(filename, tipo)
+        log.info("Previsualizaciones disponibles para %s: %s vídeos", self.expo_id, len(videos))
+        return len(videos)
+
+    def build_in_background(self):
+        '''Lanza build_all en un hilo daemon, salvo que ya haya uno en marcha para esta expo.'''
+        with self._locks_guard:
+            hilo = self._hilos.get(self.expo_id)
+            if hilo and hilo.is_alive():
+                return hilo
+            hilo = threading.Thread(target=self.build_all, name=f"previsualizaciones-{self.expo_id}", daemon=True)
+            self._hilos[self.expo_id] = hilo
+        hilo.start()
+        return hilo
 
 def get_file_info(file_path):
     if FileManager.is_video(file_path):
@@ -253,490 +941,3092 @@ def get_file_info(file_path):
             info['TIPO'] = 'Imagen'
         return info
 
-def get_files_info_from_directory(directory_path):
-    files_info = []
-    
-    for file_name in os.listdir(directory_path):
-        file_path = os.path.join(directory_path, file_name)
-        
-        # Ignorar subdirectorios
-        if os.path.isdir(file_path):
-            continue
-        
-        # Obtener información del archivo
-        info = get_file_info(file_path)
-        if info:
-            info['NOMBRE_ARCHIVO'] = file_name
-            
-            # Extraer el número de pantalla
-            match = re.search(r'_P(\d{3})_', file_name)
-            if match:
-                info['NUMERO_PANTALLA'] = int(match.group(1))
-            else:
-                info['NUMERO_PANTALLA'] = None
-            
-            files_info.append(info)
+def get_screen_number(file_name):
+    '''Extrae el número de pantalla del patrón _PNNN_ del nombre, o None.'''
+    match = re.search(r'_P(\d{3})_', file_name)
+    return int(match.group(1)) if match else None
+
+class MediaInspector:
+    '''
+    Motor de inspección concurrente de ficheros multimedia.
+
+    Las cabeceras de imagen se leen en un pool de hilos (es E/S casi pura) y las llamadas a
+    ffprobe se lanzan en un pool aparte y acotado, de modo que nunca hay más de
+    `ffprobe_workers` subprocesos ffprobe vivos a la vez.
+    '''
+    def __init__(self, image_workers=None, ffprobe_workers=None):
+        cpu_count = os.cpu_count() or 1
+        self.image_workers = image_workers or min(32, cpu_count * 4)
+        self.ffprobe_workers = ffprobe_workers or max(1, min(cpu_count, 8))
+
+    def iter_files(self, file_paths, inspector=get_file_info):
+        '''
+        Inspecciona los ficheros en paralelo y va devolviendo (file_path, info) según terminan.
+        `info` es None si el fichero no se pudo leer.
+        '''
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.image_workers, thread_name_prefix='imagen') as image_pool, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.ffprobe_workers, thread_name_prefix='ffprobe') as video_pool:
+            futures = {}
+            for file_path in file_paths:
+                pool = video_pool if FileManager.is_video(file_path) else image_pool
+                futures[pool.submit(inspector, file_path)] = file_path
+
+            for future in concurrent.futures.as_completed(futures):
+                file_path = futures[future]
+                try:
+                    yield file_path, future.result()
+                except Exception as e:
+                    log.error("Error inspeccionando %s: %s", file_path, e)
+                    yield file_path, None
+
+    def inspect_files(self, file_paths, inspector=get_file_info):
+        '''Como iter_files, pero devuelve la lista de info en el mismo orden que `file_paths`.'''
+        resultados = dict(self.iter_files(file_paths, inspector))
+        return [resultados.get(file_path) for file_path in file_paths]
 
-    df = pd.DataFrame(files_info)
+    def inspect_directory(self, directory_path, inspector=get_file_info, file_names=None):
+        '''
+        Inspecciona los ficheros del directorio raíz (sin subdirectorios) y devuelve un DataFrame
+        con una fila por fichero válido, en el orden de os.listdir (o de `file_names` si se da
+        la lista ya hecha, p. ej. desde un ExpoIndex).
+        '''
+        if file_names is not None:
+            file_paths = [os.path.join(directory_path, file_name) for file_name in file_names]
+        else:
+            file_paths = []
+            for file_name in os.listdir(directory_path):
+                file_path = os.path.join(directory_path, file_name)
+                # Ignorar subdirectorios
+                if not os.path.isdir(file_path):
+                    file_paths.append(file_path)
+
+        files_info = []
+        for file_path, info in zip(file_paths, self.inspect_files(file_paths, inspector)):
+            if info:
+                file_name = os.path.basename(file_path)
+                info['NOMBRE_ARCHIVO'] = file_name
+                info['NUMERO_PANTALLA'] = get_screen_number(file_name)
+                files_info.append(info)
+
+        return pd.DataFrame(files_info)
+
+def get_files_info_from_directory(directory_path, cache=None, index=None):
+    '''
+    Si se pasa una MetadataCache, solo se inspeccionan (ffprobe / PIL) los ficheros que no
+    estén ya en ella o que hayan cambiado desde la última vez. Con un ExpoIndex, la lista de
+    ficheros y los metadatos ya consultados salen del índice en memoria.
+    '''
+    if index is not None:
+        df = MediaInspector().inspect_directory(directory_path, inspector=index.get_info,
+                                                file_names=index.listar())
+    else:
+        inspector = cache.get_info if cache is not None else get_file_info
+        df = MediaInspector().inspect_directory(directory_path, inspector=inspector)
+    if cache is not None:
+        cache.save()
     if df.empty:
-        print("No se pudo procesar ningún archivo correctamente.")
+        log.warning("No se pudo procesar ningún archivo correctamente.")
         return pd.DataFrame(columns=['NOMBRE_ARCHIVO', 'NUMERO_PANTALLA'])
     return df
 
-class ExpoProcessor:
-    def __init__(self, expo_id):
-        self.expo_id = expo_id
-        self.output_folder = expo_id
-        self.full_output_path = os.path.join(os.getcwd(), 'expos', self.output_folder)
-        self.carpeta_origen = os.path.join(self.full_output_path, 'Obras')
-        self.carpeta_destino = os.path.join(self.full_output_path, 'ficheros_salida')
-        self.varios_folder = os.path.join(self.carpeta_destino, 'varios')
+class MetadataCache:
+    '''
+    Índice persistente de metadatos de una exposición, guardado en `expos/<expo_id>/.metadatos.json`.
 
-    def setup_directories(self):
-        FileManager.ensure_directory(os.path.join(self.full_output_path, 'Obras'))
-        FileManager.ensure_directory(os.path.join(self.full_output_path, 'ficheros_salida'))
-        FileManager.ensure_directory(self.varios_folder)
+    Cada entrada se identifica por (inodo, tamaño, mtime) del fichero, así que cualquier cambio
+    en el fichero la invalida automáticamente. Con `content_hash=True` también se indexa por un
+    hash BLAKE2 del contenido, de modo que una copia idéntica (por ejemplo una imagen que pasa
+    sin cambios de ficheros_salida a procesados) reutiliza los metadatos sin volver a leerla.
+    '''
+    FICHERO = '.metadatos.json'
+    VERSION = 1
 
-    def unzip_files(self):
-        zip_files = glob.glob(os.path.join(self.full_output_path, "*.zip"))
-        if zip_files:
-            zip_path = zip_files[0]
-            print(f"Archivo zip encontrado: {zip_path}")
-            FileManager.unzip_output(zip_path, self.full_output_path)
-        else:
-            print("No se encontraron archivos .zip en la carpeta.")
+    # Una instancia por exposición y proceso, para que el índice en memoria sobreviva entre peticiones
+    _instancias = {}
+    _instancias_lock = threading.Lock()
 
-    def process_and_move_files(self):
-        FileManager.process_files(self.carpeta_origen, self.carpeta_destino, self.expo_id)
-        FileManager.move_non_matching_files(self.carpeta_destino, self.varios_folder, self.expo_id)
-        shutil.rmtree(self.carpeta_origen)
-        print("Proceso de movimiento de archivos completado.")
+    def __init__(self, expo_path, content_hash=False):
+        self.expo_path = expo_path
+        self.index_path = os.path.join(expo_path, self.FICHERO)
+        self.content_hash = content_hash
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entradas, self._rutas, self._hashes = self._load()
 
-    def generate_summary(self):
-        # Importar las librerías necesarias
-        from openpyxl import load_workbook
-        from openpyxl.worksheet.table import Table, TableStyleInfo
+    @classmethod
+    def for_expo(cls, expo_id, content_hash=False):
+        expo_path = os.path.join(os.getcwd(), 'expos', expo_id)
+        with cls._instancias_lock:
+            cache = cls._instancias.get(expo_path)
+            if cache is None:
+                cache = cls(expo_path, content_hash=content_hash)
+                cls._instancias[expo_path] = cache
+            elif content_hash:
+                cache.content_hash = True
+            return cache
 
-        df = get_files_info_from_directory(self.carpeta_destino)
-        
-        if not df.empty:
-            if 'NUMERO_PANTALLA' in df.columns:
-                df = df.sort_values('NUMERO_PANTALLA')
-            
-            excel_path = os.path.join(self.full_output_path, 'Resumen obras.xlsx')
-            
-            # Guardar primero con pandas
-            df.to_excel(excel_path, index=False)
-            
-            # Abrir el archivo con openpyxl para añadir el formato de tabla
-            wb = load_workbook(excel_path)
-            ws = wb.active
-            
-            # Obtener el rango de la tabla
-            tabla_ref = f"A1:{chr(64 + len(df.columns))}{len(df.index) + 1}"
-            
-            # Crear la tabla con estilo
-            tabla = Table(displayName="TablaObras", ref=tabla_ref)
-            estilo = TableStyleInfo(
-                name="TableStyleMedium2", 
-                showFirstColumn=False,
-                showLastColumn=False,
-                showRowStripes=True,
-                showColumnStripes=False
-            )
-            tabla.tableStyleInfo = estilo
-            
-            # Añadir la tabla a la hoja
-            ws.add_table(tabla)
-            
-            # Ajustar el ancho de las columnas
-            for column in ws.columns:
-                max_length = 0
-                column = list(column)
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column[0].column_letter].width = adjusted_width
-            
-            # Guardar los cambios
-            wb.save(excel_path)
-            print("Proceso de resumen de archivos completado con formato de tabla.")
+    @staticmethod
+    def file_key(file_path):
+        stat = os.stat(file_path)
+        return f"{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}"
+
+    @staticmethod
+    def hash_file(file_path, chunk_size=1024 * 1024):
+        digest = hashlib.blake2b(digest_size=20)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                return data.get('entradas', {}), data.get('rutas', {}), data.get('hashes', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Índice de metadatos ilegible, se regenerará: %s", e)
+        return {}, {}, {}
+
+    def _relpath(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.expo_path)
+
+    def get_info(self, file_path):
+        '''Equivalente a get_file_info, pero consultando primero el índice.'''
+        key = self.file_key(file_path)
+        ruta = self._relpath(file_path)
+
+        with self._lock:
+            entrada = self._entradas.get(key)
+            if entrada is not None:
+                self.hits += 1
+                if self._rutas.get(ruta) != key:
+                    self._rutas[ruta] = key
+                    self._dirty = True
+                return self._copy_info(entrada['info'], file_path)
+
+        content_hash = None
+        if self.content_hash:
+            content_hash = self.hash_file(file_path)
+            with self._lock:
+                key_por_hash = self._hashes.get(content_hash)
+                entrada = self._entradas.get(key_por_hash) if key_por_hash else None
+                if entrada is not None:
+                    self.hits += 1
+                    self._store(key, ruta, entrada['info'], content_hash)
+                    return self._copy_info(entrada['info'], file_path)
+
+        info = get_file_info(file_path)
+        with self._lock:
+            self.misses += 1
+            if info is not None:
+                self._store(key, ruta, info, content_hash)
+        return self._copy_info(info, file_path) if info is not None else None
+
+    def put_info(self, file_path, info):
+        '''Registra metadatos obtenidos por otra vía (p. ej. las estadísticas de una codificación).'''
+        content_hash = self.hash_file(file_path) if self.content_hash else None
+        with self._lock:
+            self._store(self.file_key(file_path), self._relpath(file_path), info, content_hash)
+
+    @staticmethod
+    def _serializable(info):
+        # Los DPI de PIL pueden venir como IFDRational, que json no sabe serializar
+        resultado = {}
+        for k, v in info.items():
+            if v is None or isinstance(v, (str, bool, int, float)):
+                resultado[k] = v
+            elif hasattr(v, 'numerator') and hasattr(v, 'denominator'):
+                resultado[k] = float(v)
+            else:
+                resultado[k] = str(v)
+        return resultado
+
+    def _store(self, key, ruta, info, content_hash):
+        clave_anterior = self._rutas.get(ruta)
+        self._entradas[key] = {'info': self._serializable(info), 'hash': content_hash}
+        self._rutas[ruta] = key
+        if content_hash:
+            self._hashes[content_hash] = key
+        if clave_anterior and clave_anterior != key and clave_anterior not in self._rutas.values():
+            # El fichero cambió: la entrada antigua ya no la usa nadie
+            antigua = self._entradas.pop(clave_anterior, None)
+            if antigua and antigua.get('hash') and self._hashes.get(antigua['hash']) == clave_anterior:
+                del self._hashes[antigua['hash']]
+        self._dirty = True
+
+    @staticmethod
+    def _copy_info(info, file_path):
+        info = dict(info)
+        if 'NOMBRE_ARCHIVO' in info:
+            info['NOMBRE_ARCHIVO'] = os.path.basename(file_path)
+        return info
+
+    def save(self):
+        '''Escribe el índice de forma atómica si ha cambiado.'''
+        with self._lock:
+            if not self._dirty:
+                return False
+            data = {
+                'version': self.VERSION,
+                'entradas': self._entradas,
+                'rutas': self._rutas,
+                'hashes': self._hashes,
+            }
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.index_path)
+                self._dirty = False
+                return True
+            except Exception as e:
+                log.error("Error guardando el índice de metadatos: %s", e)
+                return False
+
+    def rebuild(self, subcarpetas=('ficheros_salida', 'procesados')):
+        '''Descarta el índice y vuelve a inspeccionar todos los ficheros de la exposición.'''
+        with self._lock:
+            self._entradas, self._rutas, self._hashes = {}, {}, {}
+            self.hits = self.misses = 0
+            self._dirty = True
+        for subcarpeta in subcarpetas:
+            directorio = os.path.join(self.expo_path, subcarpeta)
+            if os.path.isdir(directorio):
+                MediaInspector().inspect_directory(directorio, inspector=self.get_info)
+        self.save()
+        log.info("Índice de metadatos reconstruido: %s ficheros en %s", len(self._entradas), self.index_path)
+        return len(self._entradas)
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # watchdog es opcional: sin él el índice se mantiene por sondeo
+    Observer = None
+    FileSystemEventHandler = object
+
+EntradaIndice = collections.namedtuple('EntradaIndice', 'size mtime_ns pantalla info')
+
+class ExpoIndex:
+    '''
+    Índice en memoria de los ficheros de `ficheros_salida` de una exposición.
+
+    Guarda por fichero su tamaño, mtime, número de pantalla (_PNNN_) y, una vez consultados,
+    sus metadatos. Se mantiene al día en segundo plano: con watchdog (inotify/FSEvents) si
+    está instalado y, si no, sondeando la carpeta cada INTERVALO segundos. Los endpoints
+    de listado leen del índice en vez de recorrer el disco en cada petición.
+
+    Quien modifica ficheros_salida desde la propia aplicación (descompresión, renombrado)
+    debe llamar a rescan() al terminar para no depender del retardo del vigilante.
+    '''
+    INTERVALO = 2.0
+    # Temporales de extracción, miniaturas, etc.: nunca forman parte del índice
+    SUFIJOS_TEMPORALES = ('.part', '.tmp')
+
+    _instancias = {}
+    _instancias_lock = threading.Lock()
+
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.carpeta = os.path.join(os.getcwd(), 'expos', expo_id, 'ficheros_salida')
+        self.metadata_cache = MetadataCache.for_expo(expo_id)
+        self.ficheros = {}
+        self.version = 0
+        self._lock = threading.Lock()
+        self._observer = None
+        self._hilo = None
+        self._parar = threading.Event()
+
+    @classmethod
+    def for_expo(cls, expo_id, vigilar=True):
+        '''Índice de la exposición (uno por proceso). Con `vigilar` arranca el vigilante si no lo está.'''
+        with cls._instancias_lock:
+            index = cls._instancias.get(expo_id)
+            if index is None:
+                index = cls(expo_id)
+                index.rescan()
+                cls._instancias[expo_id] = index
+        if vigilar:
+            index.start()
+        return index
+
+    @classmethod
+    def _valido(cls, nombre):
+        return not nombre.startswith('.') and not nombre.endswith(cls.SUFIJOS_TEMPORALES)
+
+    def _entrada(self, nombre, stat, anterior=None):
+        # Los metadatos ya leídos se conservan mientras el fichero no cambie
+        if anterior is not None and (anterior.size, anterior.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return anterior
+        return EntradaIndice(stat.st_size, stat.st_mtime_ns, get_screen_number(nombre), None)
+
+    def rescan(self):
+        '''Relee la carpeta completa y actualiza el índice. Devuelve True si ha cambiado algo.'''
+        nuevos = {}
+        try:
+            with os.scandir(self.carpeta) as entradas:
+                for entrada in entradas:
+                    if entrada.is_file() and self._valido(entrada.name):
+                        nuevos[entrada.name] = entrada.stat()
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            ficheros = {nombre: self._entrada(nombre, stat, self.ficheros.get(nombre))
+                        for nombre, stat in nuevos.items()}
+            if ficheros == self.ficheros:
+                return False
+            self.ficheros = ficheros
+            self.version += 1
+            return True
+
+    def refresh(self, nombre):
+        '''Actualiza una sola entrada (alta, sustitución o baja) tras un evento del vigilante.'''
+        if not self._valido(nombre):
+            return
+        try:
+            stat = os.stat(os.path.join(self.carpeta, nombre))
+        except FileNotFoundError:
+            stat = None
+        with self._lock:
+            anterior = self.ficheros.get(nombre)
+            if stat is None:
+                if anterior is None:
+                    return
+                # Copia al escribir, como en las altas: listar() recorre el dict fuera del lock
+                self.ficheros = {k: v for k, v in self.ficheros.items() if k != nombre}
+            else:
+                entrada = self._entrada(nombre, stat, anterior)
+                if entrada is anterior:
+                    return
+                self.ficheros = {**self.ficheros, nombre: entrada}
+            self.version += 1
+
+    def listar(self, extensiones=None):
+        '''Nombres de los ficheros indexados, ordenados (y por tanto por pantalla).'''
+        with self._lock:
+            ficheros = self.ficheros
+        return sorted(n for n in ficheros if extensiones is None or n.lower().endswith(extensiones))
+
+    def pantalla(self, nombre):
+        entrada = self.ficheros.get(nombre)
+        return entrada.pantalla if entrada else get_screen_number(nombre)
+
+    def get_info(self, file_path):
+        '''
+        Metadatos de un fichero de la carpeta: del índice si ya se consultaron y el fichero no
+        ha cambiado desde entonces; si no, de la MetadataCache (que solo lanza ffprobe/PIL si
+        tampoco los tiene).
+        '''
+        nombre = os.path.basename(file_path)
+        entrada = self.ficheros.get(nombre)
+        if entrada is not None and entrada.info is not None:
+            return dict(entrada.info)
+        info = self.metadata_cache.get_info(file_path)
+        if info is not None:
+            with self._lock:
+                actual = self.ficheros.get(nombre)
+                # Solo si nadie ha cambiado la entrada mientras se leían los metadatos
+                if actual is entrada and actual is not None:
+                    self.ficheros = {**self.ficheros, nombre: actual._replace(info=dict(info))}
+        return info
+
+    def start(self):
+        '''Arranca el vigilante: watchdog si está disponible y la carpeta existe, si no sondeo.'''
+        with self._lock:
+            if self._observer is not None or (self._hilo is not None and self._hilo.is_alive()):
+                return
+            if Observer is not None and os.path.isdir(self.carpeta):
+                self._observer = Observer()
+                self._observer.schedule(_ExpoIndexHandler(self), self.carpeta, recursive=False)
+                self._observer.daemon = True
+                self._observer.start()
+                return
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._sondear, name=f"indice-{self.expo_id}", daemon=True)
+            self._hilo.start()
+
+    def stop(self):
+        self._parar.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def _sondear(self):
+        while not self._parar.wait(self.INTERVALO):
+            try:
+                self.rescan()
+            except Exception as e:
+                log.error("Error actualizando el índice de %s: %s", self.expo_id, e)
+            # Si aparece la carpeta y hay watchdog, pasar a eventos del sistema de ficheros
+            if Observer is not None and os.path.isdir(self.carpeta):
+                with self._lock:
+                    self._hilo = None
+                self.start()
+                return
+
+class _ExpoIndexHandler(FileSystemEventHandler):
+    '''Traduce los eventos de watchdog a actualizaciones puntuales de ExpoIndex.'''
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        carpetas = (self.index.carpeta, os.path.realpath(self.index.carpeta))
+        for ruta in (getattr(event, 'src_path', None), getattr(event, 'dest_path', None)):
+            # FSEvents (macOS) puede dar la ruta real en lugar de la del enlace simbólico
+            if ruta and os.path.dirname(os.fsdecode(ruta)) in carpetas:
+                self.index.refresh(os.path.basename(os.fsdecode(ruta)))
+
+class ResumenExcel:
+    '''
+    Escritura del resumen Excel de una exposición ('Resumen obras.xlsx').
+
+    Se escribe en una sola pasada con openpyxl en modo write-only: las filas salen en streaming
+    sin cargar la hoja en memoria, y la tabla con estilo y el ancho de las columnas se definen
+    antes de escribir, con las longitudes calculadas sobre el DataFrame (no celda a celda).
+    '''
+    NOMBRE_TABLA = 'TablaObras'
+    ESTILO = 'TableStyleMedium2'
+    # Columnas de la recodificación: se rellenan con los metadatos del fichero en procesados
+    COLUMNAS_RECODIFICADAS = ['ANCHO', 'ALTO', 'RESOLUCION_X', 'RESOLUCION_Y', 'ORIENTACION', 'FORMATO',
+                              'TAMAÑO_MB', 'DURACION_SEG', 'FPS', 'TASA_BITS', 'CÓDEC_VIDEO']
+    SUFIJO_RECODIFICADO = '_RECODIFICADO'
+
+    @staticmethod
+    def anchos(df):
+        '''Ancho de cada columna: el texto más largo (cabecera incluida) más 2.'''
+        anchos = []
+        for columna in df.columns:
+            valores = df[columna]
+            largo = valores.where(valores.notna(), '').astype(str).str.len().max() if len(valores) else 0
+            anchos.append(max(len(str(columna)), int(largo or 0)) + 2)
+        return anchos
+
+    @classmethod
+    def escribir(cls, df, excel_path):
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        columnas = [str(columna) for columna in df.columns]
+        for i, ancho in enumerate(cls.anchos(df), start=1):
+            ws.column_dimensions[get_column_letter(i)].width = ancho
+
+        if len(df.index):
+            tabla = Table(displayName=cls.NOMBRE_TABLA, ref=f"A1:{get_column_letter(len(columnas))}{len(df.index) + 1}")
+            tabla.tableStyleInfo = TableStyleInfo(name=cls.ESTILO, showFirstColumn=False, showLastColumn=False,
+                                                  showRowStripes=True, showColumnStripes=False)
+            # En write-only openpyxl no puede leer la cabecera de la hoja: las columnas se dan a mano
+            tabla.tableColumns = [TableColumn(id=i, name=nombre) for i, nombre in enumerate(columnas, start=1)]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                ws.add_table(tabla)
+
+        ws.append(columnas)
+        # NaN/NA no existen en Excel: se escriben como celdas vacías, igual que hacía pandas
+        valores = df.astype(object).where(df.notna(), None)
+        for fila in valores.itertuples(index=False, name=None):
+            ws.append(fila)
+
+        tmp_path = f"{excel_path}.{os.getpid()}.tmp"
+        wb.save(tmp_path)
+        os.replace(tmp_path, excel_path)
+
+    @classmethod
+    def combinar(cls, df, procesados, sufijo_imagen):
+        '''
+        Añade a `df` (el resumen) las columnas *_RECODIFICADO y PROCESADO a partir de los metadatos
+        de la carpeta procesados, con un merge por nombre de fichero. Las imágenes conformadas se
+        llaman <nombre><sufijo_imagen>; el resto conserva el nombre.
+        '''
+        df = df.copy()
+        nombres = df['NOMBRE_ARCHIVO'].astype(str)
+        disponibles = pd.Index(procesados['NOMBRE_ARCHIVO'] if 'NOMBRE_ARCHIVO' in procesados else [])
+        candidato = nombres.str.replace(r'\.[^.]*$', '', regex=True) + sufijo_imagen
+        nombre_procesado = candidato.where(candidato.isin(disponibles), nombres)
+
+        recodificados = (procesados.reindex(columns=['NOMBRE_ARCHIVO'] + cls.COLUMNAS_RECODIFICADAS)
+                         .drop_duplicates('NOMBRE_ARCHIVO')
+                         .set_index('NOMBRE_ARCHIVO')
+                         .add_suffix(cls.SUFIJO_RECODIFICADO))
+        unidos = recodificados.reindex(nombre_procesado.values)
+        for columna in unidos.columns:
+            # Asignar una columna existente la deja en su sitio; las nuevas van al final
+            df[columna] = unidos[columna].values
+        df['PROCESADO'] = nombre_procesado.isin(disponibles).map({True: 'Sí', False: 'No'}).values
+        return df
+
+class ExpoProcessor:
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.output_folder = expo_id
+        self.full_output_path = os.path.join(os.getcwd(), 'expos', self.output_folder)
+        self.carpeta_origen = os.path.join(self.full_output_path, 'Obras')
+        self.carpeta_destino = os.path.join(self.full_output_path, 'ficheros_salida')
+        self.varios_folder = os.path.join(self.carpeta_destino, 'varios')
+        self.metadata_cache = MetadataCache.for_expo(expo_id)
+
+    def setup_directories(self):
+        FileManager.ensure_directory(os.path.join(self.full_output_path, 'ficheros_salida'))
+        FileManager.ensure_directory(self.varios_folder)
+
+    def unzip_files(self):
+        zip_files = glob.glob(os.path.join(self.full_output_path, "*.zip"))
+        if zip_files:
+            log.debug("Archivos zip encontrados: %s", ', '.join(zip_files))
+            # Se extrae directamente a ficheros_salida con el nombre definitivo
+            FileManager.extract_to_destination(zip_files, self.carpeta_destino, self.expo_id)
         else:
-            print("No se encontraron archivos para procesar.")
+            log.info("No se encontraron archivos .zip en la carpeta.")
+
+    def process_and_move_files(self):
+        # Obras solo existe si se descomprimió con FileManager.unzip_output (flujo anterior)
+        if os.path.isdir(self.carpeta_origen):
+            FileManager.process_files(self.carpeta_origen, self.carpeta_destino, self.expo_id)
+            shutil.rmtree(self.carpeta_origen)
+        FileManager.move_non_matching_files(self.carpeta_destino, self.varios_folder, self.expo_id)
+        log.info("Proceso de movimiento de archivos completado.")
+
+    def generate_summary(self):
+        metricas = Metricas.for_expo(self.expo_id)
+        with metricas.etapa('sondear') as medida:
+            # Índice sin vigilante (también se usa desde la línea de comandos); se relee porque
+            # ficheros_salida acaba de cambiar
+            index = ExpoIndex.for_expo(self.expo_id, vigilar=False)
+            index.rescan()
+            df = get_files_info_from_directory(self.carpeta_destino, cache=self.metadata_cache, index=index)
+            medida['ficheros'] = len(df)
+
+        with metricas.etapa('resumen', ficheros=len(df)):
+            self.escribir_resumen(df)
+
+    def escribir_resumen(self, df):
+        '''Escribe el resumen Excel de la exposición a partir del DataFrame de metadatos.'''
+        if not df.empty:
+            if 'NUMERO_PANTALLA' in df.columns:
+                df = df.sort_values('NUMERO_PANTALLA')
+            ResumenExcel.escribir(df, os.path.join(self.full_output_path, 'Resumen obras.xlsx'))
+            log.info("Proceso de resumen de archivos completado con formato de tabla.")
+        else:
+            log.info("No se encontraron archivos para procesar.")
+
+class PerfilCodificacion:
+    '''
+    Perfil de codificación de vídeo: códec, preset, control de tasa e hilos.
+
+    El perfil por defecto ('x265_medium') reproduce el comando que se usaba hasta ahora.
+    El perfil activo se elige, por este orden: el indicado explícitamente, la variable de
+    entorno EXPO_PERFIL_CODIFICACION, el guardado por `python benchmark.py perfiles --guardar`
+    en perfil_codificacion.json, o el por defecto.
+    '''
+    POR_DEFECTO = 'x265_medium'
+    FICHERO_SELECCION = 'perfil_codificacion.json'
+
+    PERFILES = {
+        'x265_medium':   {'codec': 'libx265', 'preset': 'medium',   'crf': 23},
+        'x265_fast':     {'codec': 'libx265', 'preset': 'fast',     'crf': 23},
+        'x265_veryfast': {'codec': 'libx265', 'preset': 'veryfast', 'crf': 23},
+        'x264_medium':   {'codec': 'libx264', 'preset': 'medium',   'crf': 20},
+        'x264_fast':     {'codec': 'libx264', 'preset': 'fast',     'crf': 20},
+        'x264_veryfast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 20},
+        # Codificadores por hardware: solo se ofrecen si ffmpeg los incluye
+        'hevc_videotoolbox': {'codec': 'hevc_videotoolbox', 'hardware': True},
+        'h264_videotoolbox': {'codec': 'h264_videotoolbox', 'hardware': True},
+        'hevc_nvenc':        {'codec': 'hevc_nvenc', 'preset': 'p5', 'hardware': True},
+        'hevc_qsv':          {'codec': 'hevc_qsv', 'preset': 'medium', 'hardware': True},
+    }
+
+    # Parámetros comunes a todos los perfiles (especificaciones de las pantallas)
+    COMUNES = {
+        'fps': 30,
+        'escala': '1920:1080',
+        'bitrate': '45M',
+        'maxrate': '60M',
+        'bufsize': '60M',
+        # 'auto': GOP cerrado y alineado solo si el vídeo empieza y acaba en el mismo fotograma
+        'bucle': 'auto',
+        # 'aac': se recodifica tal cual; 'quitar': sin pista de audio; 'normalizar': loudnorm a dos pasadas
+        'audio': 'aac',
+        # 'auto': un vídeo largo que recibe varios hilos se codifica en trozos paralelos
+        'segmentar': 'auto',
+        # 'si': la recodificación genera en la misma pasada el proxy y el póster que falten
+        'fusionar': 'si',
+    }
+    BUCLE = ('auto', 'si', 'no')
+    AUDIO = ('aac', 'quitar', 'normalizar')
+    SEGMENTAR = ('auto', 'no')
+    FUSIONAR = ('si', 'no')
+    # Objetivo de loudnorm (EBU R128) para las pantallas con volumen fijo
+    SONORIDAD = {'I': -16, 'TP': -1.5, 'LRA': 11}
+
+    _encoders = None
+
+    def __init__(self, nombre, codec, preset=None, crf=None, threads=None, pools=None, hardware=False, **comunes):
+        self.nombre = nombre
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.pools = pools
+        self.hardware = hardware
+        self.comunes = {**self.COMUNES, **comunes}
+
+    def __repr__(self):
+        return f"PerfilCodificacion({self.nombre!r})"
+
+    @classmethod
+    def get(cls, nombre, **overrides):
+        if nombre not in cls.PERFILES:
+            raise ValueError(f"Perfil de codificación desconocido: {nombre}. Disponibles: {', '.join(cls.PERFILES)}")
+        return cls(nombre, **{**cls.PERFILES[nombre], **overrides})
+
+    @classmethod
+    def encoders_disponibles(cls):
+        '''Conjunto de codificadores de vídeo que incluye el ffmpeg instalado.'''
+        if cls._encoders is None:
+            try:
+                salida = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+                cls._encoders = {linea.split()[1] for linea in salida.splitlines()
+                                 if linea.strip().startswith('V') and len(linea.split()) > 1}
+            except Exception as e:
+                log.warning("No se pudo consultar la lista de codificadores de ffmpeg: %s", e)
+                cls._encoders = set()
+        return cls._encoders
+
+    @classmethod
+    def disponibles(cls):
+        '''Nombres de los perfiles cuyo codificador está disponible en esta máquina.'''
+        encoders = cls.encoders_disponibles()
+        return [nombre for nombre, perfil in cls.PERFILES.items() if perfil['codec'] in encoders]
+
+    @classmethod
+    def seleccionar(cls, nombre=None, workers=1):
+        '''
+        Devuelve el perfil activo con un número de hilos ajustado a la máquina: los núcleos se
+        reparten entre los `workers` que codifican a la vez para no sobresuscribir la CPU.
+        '''
+        nombre = nombre or os.environ.get('EXPO_PERFIL_CODIFICACION')
+        if not nombre and os.path.exists(cls.FICHERO_SELECCION):
+            try:
+                with open(cls.FICHERO_SELECCION, 'r') as f:
+                    nombre = json.load(f).get('perfil')
+            except Exception as e:
+                log.warning("No se pudo leer %s: %s", cls.FICHERO_SELECCION, e)
+        perfil = cls.get(nombre or cls.POR_DEFECTO)
+        # Opciones de bucle y audio para los reproductores Samsung
+        for clave, variable, validos in (('bucle', 'EXPO_BUCLE', cls.BUCLE), ('audio', 'EXPO_AUDIO', cls.AUDIO),
+                                         ('segmentar', 'EXPO_SEGMENTAR', cls.SEGMENTAR),
+                                         ('fusionar', 'EXPO_FUSIONAR', cls.FUSIONAR)):
+            valor = os.environ.get(variable)
+            if valor:
+                if valor not in validos:
+                    raise ValueError(f"{variable}={valor} no válido. Valores: {', '.join(validos)}")
+                perfil.comunes[clave] = valor
+        if perfil.threads is None and not perfil.hardware:
+            perfil.threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+        return perfil
+
+    @classmethod
+    def guardar_seleccion(cls, nombre, datos=None):
+        with open(cls.FICHERO_SELECCION, 'w') as f:
+            json.dump({'perfil': nombre, **(datos or {})}, f, indent=2)
+
+    def x265_params(self, bucle=False):
+        params = {}
+        if self.threads:
+            # pools limita el pool de hilos de x265; frame-threads acompaña para no saturar
+            params['pools'] = str(self.pools or self.threads)
+            params['frame-threads'] = str(min(4, max(1, self.threads // 2)))
+        elif self.pools:
+            params['pools'] = str(self.pools)
+        if bucle:
+            # Un IDR por segundo exacto y GOP cerrado: ningún B-frame referencia el GOP siguiente
+            params['keyint'] = params['min-keyint'] = str(self.comunes['fps'])
+            params['scenecut'] = '0'
+            params['open-gop'] = '0'
+        return params
+
+    def argumentos_video(self, bucle=False, inicio=0.0):
+        '''
+        Argumentos de codificación de vídeo (sin entrada, filtros ni salida). Con `bucle`, los
+        fotogramas clave quedan alineados a cada segundo en GOPs cerrados, para que el reproductor
+        salte del último fotograma al primero sin esperar a un fotograma clave. `inicio` es el
+        instante del vídeo completo en el que empieza la entrada (codificación por trozos), para
+        que la alineación sea la del vídeo completo.
+        '''
+        args = ['-c:v', self.codec]
+        if self.preset:
+            args += ['-preset', self.preset]
+        if self.crf is not None:
+            args += ['-crf', str(self.crf)]
+        args += ['-b:v', self.comunes['bitrate'],
+                 '-maxrate', self.comunes['maxrate'],
+                 '-bufsize', self.comunes['bufsize']]
+        if self.codec == 'libx265':
+            params = self.x265_params(bucle)
+            if params:
+                args += ['-x265-params', ':'.join(f"{k}={v}" for k, v in params.items())]
+        elif self.threads:
+            args += ['-threads', str(self.threads)]
+        if bucle:
+            fps = str(self.comunes['fps'])
+            claves = f"expr:gte(t+{inicio:.6f},n_forced+{math.ceil(inicio)})" if inicio else 'expr:gte(t,n_forced)'
+            args += ['-g', fps, '-keyint_min', fps, '-sc_threshold', '0', '-flags', '+cgop',
+                     # Los codificadores por hardware no siempre respetan -g: se fuerzan también
+                     '-force_key_frames', claves]
+        return args
+
+    def argumentos_audio(self, sonoridad=None):
+        '''
+        Argumentos de audio según comunes['audio']. Para 'normalizar', `sonoridad` son las
+        medidas de la primera pasada (medir_sonoridad); sin ellas se recodifica sin normalizar.
+        '''
+        if self.comunes['audio'] == 'quitar':
+            return ['-an']
+        if self.comunes['audio'] == 'normalizar' and sonoridad:
+            return ['-af', self.filtro_sonoridad(sonoridad), '-ar', '48000', '-c:a', 'aac']
+        return ['-c:a', 'aac']
+
+    @classmethod
+    def medir_sonoridad(cls, entrada):
+        '''
+        Primera pasada de loudnorm: solo el audio (-vn), así que no decodifica el vídeo.
+        Devuelve las medidas o None si no hay pista de audio o no se pueden obtener.
+        '''
+        objetivo = ':'.join(f"{k}={v}" for k, v in cls.SONORIDAD.items())
+        cmd = ['ffmpeg', '-hide_banner', '-nostats', '-i', entrada, '-vn',
+               '-af', f"loudnorm={objetivo}:print_format=json", '-f', 'null', '-']
+        try:
+            stderr = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+            medidas = json.loads(stderr[stderr.rindex('{'):stderr.rindex('}') + 1])
+        except (OSError, ValueError) as e:
+            log.warning("No se pudo medir la sonoridad de %s: %s", os.path.basename(entrada), e)
+            return None
+        if medidas.get('input_i') in (None, '-inf'):
+            return None
+        return medidas
+
+    @classmethod
+    def filtro_sonoridad(cls, medidas):
+        objetivo = ':'.join(f"{k}={v}" for k, v in cls.SONORIDAD.items())
+        return (f"loudnorm={objetivo}:measured_I={medidas['input_i']}:measured_TP={medidas['input_tp']}"
+                f":measured_LRA={medidas['input_lra']}:measured_thresh={medidas['input_thresh']}"
+                f":offset={medidas['target_offset']}:linear=true")
+
+    def codec_salida(self):
+        '''Nombre del códec de la salida tal como lo informa ffprobe.'''
+        return 'hevc' if ('265' in self.codec or 'hevc' in self.codec) else 'h264'
+
+    def filtro_video(self):
+        return f"fps={self.comunes['fps']},scale={self.comunes['escala']}:flags=bicubic"
+
+    def comando(self, entrada, salida, bucle=False, sonoridad=None):
+        '''Comando ffmpeg completo: una sola decodificación del vídeo para todo el procesado.'''
+        return (['ffmpeg', '-i', entrada, '-vf', self.filtro_video()]
+                + self.argumentos_video(bucle)
+                + self.argumentos_audio(sonoridad)
+                + ['-movflags', '+faststart', '-f', 'mp4', '-y', salida])
+
+class VideoCompliance:
+    '''
+    Decide, a partir de los metadatos ya sondeados de un vídeo, si hay que recodificarlo o si
+    basta con copiarlo tal cual o remultiplexarlo (`-c copy` + `+faststart`).
+
+    Un vídeo cumple si es MP4, H.264 o H.265, a 30 fps o menos, con la resolución de las
+    pantallas (o la que produce el perfil de codificación) y entre 30 y 60 Mbps.
+    '''
+    RECODIFICAR = 'recodificar'
+    REMUX = 'remux'
+    COPIAR = 'copiar'
+
+    CODECS = ('h264', 'hevc')
+    FPS_MAXIMO = 30
+    BITRATE_MINIMO = 30_000_000
+    BITRATE_MAXIMO = 60_000_000
+    RESOLUCIONES = [(3840, 2160), (2160, 3840)]
+
+    @staticmethod
+    def moov_at_start(file_path):
+        '''
+        Recorre las cajas de primer nivel del MP4 y devuelve True si 'moov' aparece antes que
+        'mdat' (el fichero ya es faststart), False si no, y None si no se puede determinar.
+        '''
+        try:
+            with open(file_path, 'rb') as f:
+                while True:
+                    cabecera = f.read(8)
+                    if len(cabecera) < 8:
+                        return None
+                    tamano = int.from_bytes(cabecera[:4], 'big')
+                    tipo = cabecera[4:8]
+                    if tipo == b'moov':
+                        return True
+                    if tipo == b'mdat':
+                        return False
+                    if tamano == 1:
+                        tamano = int.from_bytes(f.read(8), 'big')
+                        f.seek(tamano - 16, os.SEEK_CUR)
+                    elif tamano == 0:
+                        return None
+                    else:
+                        f.seek(tamano - 8, os.SEEK_CUR)
+        except OSError:
+            return None
+
+    @classmethod
+    def resoluciones_validas(cls, perfil=None):
+        resoluciones = list(cls.RESOLUCIONES)
+        if perfil is not None:
+            ancho, alto = (int(v) for v in perfil.comunes['escala'].split(':'))
+            resoluciones += [(ancho, alto), (alto, ancho)]
+        return resoluciones
+
+    @classmethod
+    def decidir(cls, file_path, info, perfil=None):
+        '''Devuelve (decisión, motivos) para un vídeo.'''
+        if not info:
+            return cls.RECODIFICAR, ['Sin metadatos']
+
+        motivos = []
+        if os.path.splitext(file_path)[1].lower() != '.mp4':
+            motivos.append(f"Contenedor {os.path.splitext(file_path)[1]}")
+        if str(info.get('CÓDEC_VIDEO', '')).lower() not in cls.CODECS:
+            motivos.append(f"Códec {info.get('CÓDEC_VIDEO')}")
+        if not info.get('FPS') or info['FPS'] > cls.FPS_MAXIMO:
+            motivos.append(f"{info.get('FPS')} fps")
+        if (info.get('ANCHO'), info.get('ALTO')) not in cls.resoluciones_validas(perfil):
+            motivos.append(f"Resolución {info.get('ANCHO')}x{info.get('ALTO')}")
+        bitrate = info.get('TASA_BITS') or 0
+        if not cls.BITRATE_MINIMO <= bitrate <= cls.BITRATE_MAXIMO:
+            motivos.append(f"{bitrate / 1_000_000:.1f} Mbps")
+
+        if motivos:
+            return cls.RECODIFICAR, motivos
+        # Quitar o normalizar el audio no exige tocar el vídeo: basta con remultiplexar
+        audio = perfil.comunes['audio'] if perfil is not None else 'aac'
+        if audio == 'quitar':
+            return cls.REMUX, ['Se quita el audio']
+        if audio == 'normalizar':
+            return cls.REMUX, ['Se normaliza el audio']
+        if cls.moov_at_start(file_path):
+            return cls.COPIAR, []
+        return cls.REMUX, ['moov al final del fichero']
+
+    @staticmethod
+    def comando_remux(entrada, salida, perfil=None, sonoridad=None):
+        '''Copia el vídeo sin recodificar; el audio se copia o, según el perfil, se quita o normaliza.'''
+        if perfil is None or perfil.comunes['audio'] == 'aac':
+            return ['ffmpeg', '-i', entrada, '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-y', salida]
+        return (['ffmpeg', '-i', entrada, '-map', '0:v', '-map', '0:a?', '-c:v', 'copy']
+                + perfil.argumentos_audio(sonoridad)
+                + ['-movflags', '+faststart', '-f', 'mp4', '-y', salida])
+
+class CosturaBucle:
+    '''
+    Detecta si un vídeo está pensado para reproducirse en bucle (empieza y acaba en el mismo
+    fotograma, ver "Parámetros de visualización" en instructions.md).
+
+    Compara el primer y el último fotograma reducidos a 64x36 en gris. Los dos se obtienen con
+    búsquedas rápidas (-ss / -sseof antes de -i), así que solo se decodifica un instante del
+    principio y del final, nunca el vídeo entero.
+    '''
+    ANCHO, ALTO = 64, 36
+    # Diferencia media máxima (0-255) para considerar que ambos fotogramas son el mismo
+    UMBRAL = 3.0
+
+    @classmethod
+    def _fotogramas(cls, entrada, busqueda=(), limite=()):
+        cmd = (['ffmpeg', '-v', 'error', *busqueda, '-i', entrada, '-an', *limite,
+                '-vf', f"scale={cls.ANCHO}:{cls.ALTO},format=gray", '-f', 'rawvideo', '-'])
+        salida = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        tamano = cls.ANCHO * cls.ALTO
+        return [salida[i:i + tamano] for i in range(0, len(salida) - tamano + 1, tamano)]
+
+    @classmethod
+    def diferencia(cls, entrada):
+        '''Diferencia media entre el primer y el último fotograma, o None si no se pueden leer.'''
+        try:
+            primero = cls._fotogramas(entrada, limite=['-frames:v', '1'])
+            # El último fotograma: se decodifica el último medio segundo y nos quedamos con el final
+            ultimo = cls._fotogramas(entrada, busqueda=['-sseof', '-0.5'])
+        except OSError as e:
+            log.warning("No se pudo comprobar el bucle de %s: %s", os.path.basename(entrada), e)
+            return None
+        if not primero or not ultimo:
+            return None
+        return sum(abs(a - b) for a, b in zip(primero[0], ultimo[-1])) / len(primero[0])
+
+    @classmethod
+    def es_bucle(cls, entrada):
+        diferencia = cls.diferencia(entrada)
+        return diferencia is not None and diferencia <= cls.UMBRAL
+
+class CodificacionSegmentada:
+    '''
+    Codificación de un vídeo largo en trozos paralelos, para que una exposición de uno o dos
+    vídeos 4K use todos los núcleos y no un solo ffmpeg.
+
+    1. El vídeo se parte sin recodificar (muxer segment con -c copy), así que los cortes caen
+       en fotogramas clave del original.
+    2. Los trozos se codifican en paralelo, cada uno con un ffmpeg de un hilo y exactamente
+       los mismos parámetros que la codificación de una pasada.
+    3. Se unen sin pérdida con el demuxer concat, y el audio se codifica una sola vez desde el
+       original en ese mismo paso.
+    4. Se comprueba que la salida tiene los fotogramas y la duración del original (medir). Si
+       no, quien llama repite la codificación de una pasada.
+    '''
+    # Por debajo de esta duración (s) partir no compensa
+    DURACION_MIN = 60
+    # Trozos por codificador: con más trozos que codificadores los trozos desiguales se reparten mejor
+    TROZOS_POR_CODIFICADOR = 2
+    TROZO_MIN = 10
+
+    def __init__(self, perfil, codificadores, bucle=False, sonoridad=None, on_progress=None, label=''):
+        self.perfil = copy.copy(perfil)
+        # Cada codificador con un solo hilo: escala casi linealmente con los núcleos
+        self.perfil.threads, self.perfil.pools = 1, None
+        self.codificadores = codificadores
+        self.bucle = bucle
+        self.sonoridad = sonoridad
+        self.on_progress = on_progress
+        self.label = label
+        self.fotogramas = None
+
+    @classmethod
+    def codificadores_para(cls, perfil, duracion):
+        '''Codificadores en paralelo para un vídeo de `duracion` s con este perfil; 0 si no se parte.'''
+        if perfil.comunes['segmentar'] == 'no' or perfil.hardware or not duracion or duracion < cls.DURACION_MIN:
+            return 0
+        codificadores = min(perfil.threads or 1, int(duracion // cls.TROZO_MIN))
+        return codificadores if codificadores > 1 else 0
+
+    def partir(self, entrada, carpeta, duracion):
+        '''Trozos del vídeo sin recodificar: [(ruta, inicio, fin)] en segundos del original.'''
+        trozos = self.codificadores * self.TROZOS_POR_CODIFICADOR
+        lista = os.path.join(carpeta, 'trozos.csv')
+        cmd = ['ffmpeg', '-v', 'error', '-i', entrada, '-map', '0:v:0', '-c', 'copy',
+               '-f', 'segment', '-segment_time', f"{max(self.TROZO_MIN, duracion / trozos):.3f}",
+               '-reset_timestamps', '1', '-segment_list', lista, '-segment_list_type', 'csv',
+               '-y', os.path.join(carpeta, 'trozo_%04d.mkv')]
+        resultado = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if resultado.returncode != 0:
+            raise RuntimeError(f"No se pudo partir {self.label}: {resultado.stderr.strip()[-500:]}")
+        with open(lista, 'r') as f:
+            return [(os.path.join(carpeta, nombre), float(inicio), float(fin))
+                    for nombre, inicio, fin in (linea.strip().split(',') for linea in f if linea.strip())]
+
+    def comando_trozo(self, ruta, inicio, salida):
+        '''Codificación de un trozo que empieza en el segundo `inicio` del original (sin audio).'''
+        return (['ffmpeg', '-i', ruta, '-vf', self.perfil.filtro_video()]
+                + self.perfil.argumentos_video(self.bucle, inicio=inicio)
+                + ['-an', '-y', salida])
+
+    def _codificar_trozo(self, trozo, avance, i):
+        ruta, inicio, fin = trozo
+        salida = os.path.splitext(ruta)[0] + '_cod.mkv'
+        cmd = self.comando_trozo(ruta, inicio, salida)
+
+        def on_progress(progreso):
+            if progreso['out_time'] is not None:
+                avance[i] = min(progreso['out_time'], fin - inicio)
+                self._notificar(avance)
+
+        runner = FFmpegRunner(cmd, duration=fin - inicio, on_progress=on_progress, label=f"{self.label}#{i}")
+        if runner.run() != 0:
+            raise RuntimeError(f"Error codificando el trozo {i} de {self.label}: {chr(10).join(runner.stderr_tail)}")
+        avance[i] = fin - inicio
+        return salida
+
+    def _notificar(self, avance):
+        if not self.on_progress:
+            return
+        hecho = sum(avance)
+        transcurrido = time.time() - self._inicio
+        velocidad = hecho / transcurrido if transcurrido > 0 else None
+        self.on_progress({
+            'percent': min(99.9, hecho / self._duracion * 100),
+            'eta': (self._duracion - hecho) / velocidad if velocidad else None,
+            'speed': velocidad,
+            'done': False,
+        })
+
+    def unir(self, codificados, entrada, salida, carpeta):
+        '''Concatena los trozos sin recodificarlos y añade el audio del original.'''
+        lista = os.path.join(carpeta, 'concat.txt')
+        with open(lista, 'w') as f:
+            for ruta in codificados:
+                f.write(f"file '{os.path.basename(ruta)}'\n")
+        cmd = (['ffmpeg', '-f', 'concat', '-safe', '0', '-i', lista, '-i', entrada,
+                '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy']
+               + self.perfil.argumentos_audio(self.sonoridad)
+               + ['-movflags', '+faststart', '-f', 'mp4', '-y', salida])
+        runner = FFmpegRunner(cmd, label=self.label)
+        if runner.run() != 0:
+            raise RuntimeError(f"Error uniendo los trozos de {self.label}: {chr(10).join(runner.stderr_tail)}")
+
+    @staticmethod
+    def medir(ruta):
+        '''
+        (fotogramas, segundos) de la pista de vídeo, leyéndola con -c copy: cuenta los paquetes
+        sin decodificar nada, así que tarda muy poco incluso en 4K.
+        '''
+        cmd = ['ffmpeg', '-hide_banner', '-nostats', '-v', 'verbose', '-progress', 'pipe:1',
+               '-i', ruta, '-map', '0:v:0', '-c', 'copy', '-f', 'null', '-']
+        resultado = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        paquetes = re.search(r'\(video\): (\d+) packets muxed', resultado.stderr)
+        tiempos = re.findall(r'^out_time_us=(\d+)', resultado.stdout, re.MULTILINE)
+        return (int(paquetes.group(1)) if paquetes else None,
+                int(tiempos[-1]) / 1_000_000 if tiempos else None)
+
+    def verificar(self, fotogramas, segundos, duracion, trozos):
+        '''
+        Problemas de la salida frente al original. Cada corte puede redondear un fotograma al
+        pasar a comunes['fps'], de ahí el margen de un fotograma por trozo.
+        '''
+        fps = self.perfil.comunes['fps']
+        margen = trozos + 1
+        problemas = []
+        esperados = round(duracion * fps)
+        if fotogramas is None or abs(fotogramas - esperados) > margen:
+            problemas.append(f"{fotogramas} fotogramas (esperados {esperados})")
+        if segundos is None or abs(segundos - duracion) > margen / fps:
+            problemas.append(f"duración {segundos} s (original {duracion:.3f} s)")
+        return problemas
+
+    def terminar(self, codificados, entrada, salida, carpeta, duracion):
+        '''
+        Une los trozos codificados y, si la unión cuadra con el original, la coloca en `salida`.
+        Devuelve True si es válida. Hasta entonces se escribe en <salida>.<pid>.part, que nadie
+        toma por una salida terminada.
+        '''
+        parcial = f"{salida}.{os.getpid()}.part"
+        try:
+            self.unir(codificados, entrada, parcial, carpeta)
+            fotogramas, segundos = self.medir(parcial)
+            problemas = self.verificar(fotogramas, segundos, duracion, len(codificados))
+            if problemas:
+                log.warning("%s: la codificación por trozos no cuadra con el original (%s)", self.label, ', '.join(problemas))
+                return False
+            os.replace(parcial, salida)
+        finally:
+            if os.path.exists(parcial):
+                os.remove(parcial)
+        self.fotogramas = fotogramas
+        return True
+
+    def codificar(self, entrada, salida, duracion):
+        '''Codifica `entrada` en `salida` por trozos. Devuelve True si la salida es válida.'''
+        self._inicio, self._duracion = time.time(), duracion
+        carpeta = tempfile.mkdtemp(prefix='.trozos_', dir=os.path.dirname(salida))
+        try:
+            trozos = self.partir(entrada, carpeta, duracion)
+            if len(trozos) < 2:
+                log.debug("%s: sin fotogramas clave suficientes para partirlo", self.label)
+                return False
+            log.debug("%s: %s trozos en %s codificadores", self.label, len(trozos), self.codificadores)
+            avance = [0.0] * len(trozos)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.codificadores) as executor:
+                codificados = list(executor.map(self._codificar_trozo, trozos, [avance] * len(trozos), range(len(trozos))))
+
+            return self.terminar(codificados, entrada, salida, carpeta, duracion)
+        finally:
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+class GrafoFusionado:
+    '''
+    Una sola decodificación por vídeo para todo lo que se deriva de él.
+
+    Al recodificar, la salida para las pantallas, el proxy y el póster de la galería
+    (VideoPreviewCache) salen del mismo ffmpeg: un `split` en el filter_complex reparte los
+    fotogramas decodificados entre las ramas, y solo se añaden las de las previsualizaciones que
+    faltan. Con el progreso de ese mismo ffmpeg se rellenan los metadatos de la salida (con el
+    formato de VideoInfo.get_video_info), de modo que el resumen no tiene que volver a sondearla;
+    ver en estadisticas() cuáles son medidas y cuáles salen del perfil.
+    '''
+    def __init__(self, perfil, expo_id, bucle=False, sonoridad=None):
+        self.perfil = perfil
+        self.previews = VideoPreviewCache(expo_id)
+        self.bucle = bucle
+        self.sonoridad = sonoridad
+        self.nombre = None
+        # {tipo: (temporal, destino)} de las previsualizaciones que salen de esta pasada
+        self.derivados = {}
+
+    def _pendientes(self, entrada):
+        # Solo los originales de ficheros_salida tienen previsualizaciones
+        origen = self.previews.source_path(self.nombre)
+        if origen is None or os.path.abspath(origen) != os.path.abspath(entrada):
+            return {}
+        clave = ThumbnailCache.cache_key(origen)
+        pendientes = {}
+        for tipo in (VideoPreviewCache.PROXY, VideoPreviewCache.POSTER):
+            destino = self.previews.preview_path(self.nombre, tipo, clave)
+            if not os.path.exists(destino):
+                pendientes[tipo] = (f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp", destino)
+        return pendientes
+
+    def comando(self, entrada, salida, duracion=None):
+        '''Comando ffmpeg con una salida por rama del grafo; la de las pantallas va primero.'''
+        self.nombre = os.path.basename(entrada)
+        self.derivados = self._pendientes(entrada)
+        ramas = ['salida', *self.derivados]
+        if len(ramas) > 1:
+            grafo = [f"[0:v]split={len(ramas)}" + ''.join(f"[{rama}]" for rama in ramas)]
+        else:
+            grafo = ['[0:v]null[salida]']
+        grafo.append(f"[salida]{self.perfil.filtro_video()}[v_salida]")
+        argumentos = (['-map', '[v_salida]', '-map', '0:a:0?']
+                      + self.perfil.argumentos_video(self.bucle)
+                      + self.perfil.argumentos_audio(self.sonoridad)
+                      + ['-movflags', '+faststart', '-f', 'mp4', '-y', salida])
+
+        if VideoPreviewCache.PROXY in self.derivados:
+            grafo.append(f"[proxy]{self.previews.escala()}[v_proxy]")
+            argumentos += (['-map', '[v_proxy]', '-map', '0:a:0?'] + self.previews.argumentos_proxy()
+                           + ['-y', self.derivados[VideoPreviewCache.PROXY][0]])
+        if VideoPreviewCache.POSTER in self.derivados:
+            # trim en lugar de -ss: el fotograma sale de la misma decodificación
+            segundo = self.previews.segundo_poster(entrada, duracion)
+            grafo.append(f"[poster]trim=start={segundo:.3f},{self.previews.escala()}[v_poster]")
+            argumentos += ['-map', '[v_poster]', '-frames:v', '1', '-q:v', '4', '-f', 'image2',
+                           '-y', self.derivados[VideoPreviewCache.POSTER][0]]
+
+        if self.derivados:
+            FileManager.ensure_directory(self.previews.carpeta_cache)
+        return ['ffmpeg', '-i', entrada, '-filter_complex', ';'.join(grafo)] + argumentos
+
+    def terminar(self, correcto):
+        '''Coloca las previsualizaciones generadas, o descarta los temporales si ffmpeg falló.'''
+        for tipo, (temporal, destino) in self.derivados.items():
+            if not os.path.exists(temporal):
+                continue
+            if correcto:
+                self.previews.guardar(self.nombre, tipo, temporal, destino)
+                log.debug("%s de %s generado en la misma pasada", tipo, self.nombre)
+            else:
+                os.remove(temporal)
+
+    def estadisticas(self, salida, progreso):
+        '''
+        Metadatos de `salida` a partir del último bloque de progreso de ffmpeg, o None si no
+        trae lo necesario. Solo la duración (con los fotogramas, como la daría ffprobe), el
+        tamaño y la tasa de bits salen de esta ejecución. ANCHO, ALTO, FPS y CÓDEC_VIDEO no se
+        miden: son los que el perfil impone a la salida (filtro fps/scale y códec), que ffmpeg
+        respeta o falla.
+        '''
+        fotogramas, out_time = progreso.get('frame'), progreso.get('out_time')
+        if not fotogramas or not out_time:
+            return None
+        fps = float(self.perfil.comunes['fps'])
+        duracion = max(fotogramas / fps, out_time)
+        ancho, alto = (int(lado) for lado in self.perfil.comunes['escala'].split(':'))
+        tamano = os.path.getsize(salida)
+        return {
+            'ANCHO': ancho,
+            'ALTO': alto,
+            'ORIENTACION': 'H' if ancho > alto else 'V',
+            'DURACION_SEG': int(duracion),
+            'FPS': round(fps, 1),
+            'FORMATO': os.path.splitext(salida)[1][1:].lower(),
+            'TAMAÑO_MB': round(tamano / (1024 * 1024), 2),
+            'TASA_BITS': int(tamano * 8 / duracion),
+            'CÓDEC_VIDEO': self.perfil.codec_salida(),
+            'NOMBRE_ARCHIVO': os.path.basename(salida)
+        }
+
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow compilado sin LittleCMS: las imágenes se convierten sin gestión de color
+    ImageCms = None
+
+
+class ConformadorImagen:
+    '''
+    Ajusta las imágenes a las pantallas (ver "Parámetros de visualización" en instructions.md):
+    3840x2160 o 2160x3840, RGB de 8 bits en sRGB, JPEG o PNG de menos de 10 MB.
+
+    La imagen se encaja sin deformarla en la pantalla que corresponde a su orientación y el
+    resto se rellena de negro. Las fuentes grandes no se decodifican a tamaño completo: en
+    JPEG draft() escala en el propio decodificador y en el resto reduce() promedia por
+    bloques, de modo que el LANCZOS final y la conversión de color trabajan sobre poco más
+    que el tamaño de salida. Con Pillow-SIMD instalado en lugar de Pillow (mismo API) el
+    redimensionado usa sus rutinas vectorizadas sin cambiar nada aquí.
+    '''
+    RESOLUCIONES = [(3840, 2160), (2160, 3840)]
+    FORMATOS = ('JPEG', 'PNG')
+    TAMANO_MAXIMO = 10 * 1024 * 1024
+    CALIDAD = 85
+    FONDO = (0, 0, 0)
+    SUFIJO = '_procesado.jpg'
+
+    _srgb = None
+
+    @classmethod
+    def pantalla(cls, ancho, alto):
+        '''Resolución de la pantalla en la que se muestra una imagen de ancho x alto.'''
+        return cls.RESOLUCIONES[0] if ancho >= alto else cls.RESOLUCIONES[1]
+
+    @staticmethod
+    def orientacion(img):
+        try:
+            return img.getexif().get(ExifTags.Base.Orientation, 1)
+        except Exception:
+            return 1
+
+    @staticmethod
+    def es_srgb(icc):
+        '''True si el perfil ICC es sRGB, no hay perfil o no se puede interpretar.'''
+        if not icc or ImageCms is None:
+            return True
+        try:
+            descripcion = ImageCms.getProfileDescription(ImageCms.ImageCmsProfile(io.BytesIO(icc)))
+        except (OSError, ImageCms.PyCMSError):
+            return True
+        return 'srgb' in descripcion.lower()
+
+    @classmethod
+    def motivos(cls, img, tamano):
+        '''Motivos por los que una imagen (abierta, sin decodificar) no cumple; [] si cumple.'''
+        motivos = []
+        ancho, alto = img.size
+        if (ancho, alto) not in cls.RESOLUCIONES:
+            motivos.append(f"Resolución incorrecta: {ancho}x{alto}")
+        if img.format not in cls.FORMATOS:
+            motivos.append(f"Formato incorrecto: {img.format}")
+        if img.mode != 'RGB':
+            motivos.append(f"Modo de color incorrecto: {img.mode}")
+        if not cls.es_srgb(img.info.get('icc_profile')):
+            motivos.append("Perfil de color distinto de sRGB")
+        orientacion = cls.orientacion(img)
+        if orientacion != 1:
+            motivos.append(f"Orientación EXIF {orientacion}")
+        if tamano > cls.TAMANO_MAXIMO:
+            motivos.append(f"Tamaño excesivo: {tamano / 1024:.2f}KB")
+        return motivos
+
+    @classmethod
+    def ajustar(cls, img):
+        '''Devuelve la imagen encajada en su pantalla, en RGB sRGB, con bandas negras si hace falta.'''
+        icc = img.info.get('icc_profile')
+        girada = cls.orientacion(img) in (5, 6, 7, 8)
+        ancho, alto = img.size[::-1] if girada else img.size
+        pantalla = cls.pantalla(ancho, alto)
+        escala = min(pantalla[0] / ancho, pantalla[1] / alto)
+        encaje = (max(1, round(ancho * escala)), max(1, round(alto * escala)))
+
+        if img.format == 'JPEG' and escala < 1:
+            # Escalado DCT (1/2, 1/4, 1/8) sin bajar del tamaño de encaje
+            img.draft('RGB', encaje[::-1] if girada else encaje)
+        img.load()
+        img = ImageOps.exif_transpose(img)
+
+        if 'A' in img.getbands() or 'transparency' in img.info:
+            # Las zonas transparentes se ven negras en pantalla, igual que las bandas
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, cls.FONDO)
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+
+        factor = min(img.size[0] // (encaje[0] * 2), img.size[1] // (encaje[1] * 2))
+        if factor > 1:
+            img = img.reduce(factor)
+        if img.size != encaje:
+            img = img.resize(encaje, Image.Resampling.LANCZOS, reducing_gap=None)
+
+        # La conversión de color, ya sobre el tamaño final
+        img = cls._a_srgb(img, icc)
+        if encaje == pantalla:
+            return img
+        lienzo = Image.new('RGB', pantalla, cls.FONDO)
+        lienzo.paste(img, ((pantalla[0] - encaje[0]) // 2, (pantalla[1] - encaje[1]) // 2))
+        return lienzo
+
+    @classmethod
+    def _a_srgb(cls, img, icc):
+        if icc and ImageCms is not None and (img.mode != 'RGB' or not cls.es_srgb(icc)):
+            try:
+                if cls._srgb is None:
+                    cls._srgb = ImageCms.createProfile('sRGB')
+                origen = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+                return ImageCms.profileToProfile(img, origen, cls._srgb, outputMode='RGB')
+            except (OSError, ImageCms.PyCMSError) as e:
+                log.warning("No se pudo aplicar el perfil de color (%s); se convierte sin gestión de color", e)
+        return img if img.mode == 'RGB' else img.convert('RGB')
+
+    @classmethod
+    def procesar(cls, ruta_origen, carpeta_destino):
+        '''
+        Conforma una imagen y devuelve (nombre del fichero generado en carpeta_destino, motivos).
+        Si ya cumple se copia tal cual; si no, se guarda como <nombre>_procesado.jpg.
+        '''
+        nombre = os.path.basename(ruta_origen)
+        with Image.open(ruta_origen) as img:
+            motivos = cls.motivos(img, os.path.getsize(ruta_origen))
+            if not motivos:
+                shutil.copy2(ruta_origen, os.path.join(carpeta_destino, nombre))
+                return nombre, motivos
+            salida = cls.ajustar(img)
+
+        nuevo_nombre = os.path.splitext(nombre)[0] + cls.SUFIJO
+        ruta_destino = os.path.join(carpeta_destino, nuevo_nombre)
+        temporal = ruta_destino + '.part'
+        # Sin optimize ni progressive: encarecen mucho la codificación y la pantalla no los aprovecha
+        salida.save(temporal, 'JPEG', quality=cls.CALIDAD, dpi=(72, 72))
+        os.replace(temporal, ruta_destino)
+        return nuevo_nombre, motivos
+
+    @classmethod
+    def procesar_lote(cls, rutas, carpeta_destino, procesos=None):
+        '''
+        Conforma un lote de imágenes en un pool de procesos (es trabajo de CPU en Python/C que
+        con hilos quedaría limitado por el GIL). Devuelve {ruta: nombre generado, o None si falla}.
+        '''
+        resultados = {}
+        if not rutas:
+            return resultados
+        procesos = min(len(rutas), procesos or os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=procesos, initializer=configurar_logging,
+                                                    mp_context=PlanificadorCodificacion.contexto()) as executor:
+            futures = {executor.submit(cls.procesar, ruta, carpeta_destino): ruta for ruta in rutas}
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Imágenes"):
+                ruta = futures[future]
+                try:
+                    resultados[ruta] = future.result()[0]
+                except Exception as e:
+                    log.error("Error al procesar la imagen %s: %s", os.path.basename(ruta), e)
+                    resultados[ruta] = None
+        return resultados
+
+EstadoFichero = collections.namedtuple('EstadoFichero', 'estado progress speed eta')
+
+class ProgressBus:
+    '''
+    Canal de progreso entre los workers de recodificación y quien los monitoriza (el SSE de /recodificar).
+
+    Los workers publican eventos en una cola (una `Manager().Queue()` si son procesos de un Pool,
+    o una `queue.Queue` si son hilos) y el consumidor los drena en cuanto llegan, manteniendo
+    un EstadoFichero por fichero: en_cola, procesando, terminado o error.
+    '''
+    EN_COLA = 'en_cola'
+    PROCESANDO = 'procesando'
+    TERMINADO = 'terminado'
+    ERROR = 'error'
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.estados = {}
+
+    def __getstate__(self):
+        # A los workers solo les hace falta la cola
+        return {'queue': self.queue, 'estados': {}}
+
+    def publish(self, filename, estado, progress=0.0, speed=None, eta=None):
+        self.queue.put((filename, estado, progress, speed, eta))
+
+    def mark_queued(self, filenames):
+        for filename in filenames:
+            self.estados[filename] = EstadoFichero(self.EN_COLA, 0.0, None, None)
+
+    def drain(self, timeout=1.0):
+        '''
+        Espera como mucho `timeout` segundos al primer evento y aplica todos los que haya pendientes.
+        Devuelve el número de eventos aplicados.
+        '''
+        aplicados = 0
+        bloquear = timeout > 0
+        while True:
+            try:
+                filename, estado, progress, speed, eta = self.queue.get(block=bloquear, timeout=timeout if bloquear else None)
+            except (queue_module.Empty, EOFError, OSError):
+                return aplicados
+            self.estados[filename] = EstadoFichero(estado, progress, speed, eta)
+            aplicados += 1
+            bloquear = False
+
+    def total_progress(self):
+        if not self.estados:
+            return 0.0
+        return sum(e.progress if e.estado != self.ERROR else 100.0 for e in self.estados.values()) / len(self.estados)
+
+    def in_progress(self):
+        return {f: e for f, e in self.estados.items() if e.estado == self.PROCESANDO}
+
+    def counts(self):
+        return dict(collections.Counter(e.estado for e in self.estados.values()))
+
+class Metricas:
+    '''
+    Tiempos por etapa del pipeline: descomprimir, copiar, copia_seguridad, renombrar, sondear,
+    resumen, recodificacion (el trabajo entero) y recodificar (un registro por fichero).
+
+    Cada exposición tiene un informe de su última ejecución en expos/<id>/informe_ejecucion.json,
+    con la duración y los contadores (ficheros, bytes, fotogramas) de cada etapa. Además se
+    acumulan totales en el proceso, que /metrics publica en el formato de texto de Prometheus
+    (con varios workers de gunicorn, cada uno publica los suyos).
+    '''
+    FICHERO = 'informe_ejecucion.json'
+    CONTADORES = ('ficheros', 'bytes', 'fotogramas')
+
+    _instancias = {}
+    _instancias_lock = threading.Lock()
+    # (etapa, expo_id) -> Counter con ejecuciones, segundos, errores y CONTADORES
+    _totales = collections.defaultdict(collections.Counter)
+    _totales_lock = threading.Lock()
 
-class Recodificador:
     def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.path = os.path.join(os.getcwd(), 'expos', expo_id, self.FICHERO)
+        self._lock = threading.Lock()
+        self.informe = self._cargar() or self._vacio()
+
+    @classmethod
+    def for_expo(cls, expo_id):
+        with cls._instancias_lock:
+            if expo_id not in cls._instancias:
+                cls._instancias[expo_id] = cls(expo_id)
+            return cls._instancias[expo_id]
+
+    def _vacio(self):
+        return {'expo_id': self.expo_id, 'inicio': self._ahora(), 'etapas': [], 'ficheros': []}
+
+    @staticmethod
+    def _ahora():
+        return datetime.datetime.now().isoformat(timespec='seconds')
+
+    def _cargar(self):
+        # La recodificación continúa el informe del procesado aunque el servidor se haya reiniciado
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def nueva_ejecucion(self):
+        '''Empieza un informe nuevo (al procesar la exposición desde el principio).'''
+        with self._lock:
+            self.informe = self._vacio()
+        self.guardar()
+
+    @contextlib.contextmanager
+    def etapa(self, nombre, **contadores):
+        '''
+        Mide el bloque como la etapa `nombre`. Devuelve un Counter en el que el bloque suma
+        ficheros, bytes y fotogramas; si el bloque lanza una excepción, la etapa queda con error.
+        '''
+        medida = collections.Counter(contadores)
+        inicio = time.perf_counter()
+        error = None
+        try:
+            yield medida
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.registrar(nombre, time.perf_counter() - inicio, error=error, **medida)
+
+    def registrar(self, etapa, segundos, fichero=None, error=None, **contadores):
+        entrada = {'etapa': etapa, 'fin': self._ahora(), 'segundos': round(segundos, 3)}
+        if fichero:
+            entrada['fichero'] = fichero
+        entrada.update({k: v for k, v in contadores.items() if v is not None})
+        if error:
+            entrada['error'] = error
+        with self._lock:
+            self.informe['ficheros' if fichero else 'etapas'].append(entrada)
+
+        with self._totales_lock:
+            total = self._totales[(etapa, self.expo_id)]
+            total['ejecuciones'] += 1
+            total['segundos'] += segundos
+            total['errores'] += 1 if error else 0
+            for clave in self.CONTADORES:
+                total[clave] += contadores.get(clave) or 0
+
+        if fichero:
+            log.debug("%s %s: %.2f s %s", etapa, fichero, segundos, contadores)
+        else:
+            log.info("Etapa %s de %s: %.2f s %s", etapa, self.expo_id, segundos,
+                     {k: v for k, v in contadores.items() if v})
+            # Los registros por fichero se vuelcan con la etapa que los engloba, no uno a uno
+            self.guardar()
+
+    def guardar(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return False
+        with self._lock:
+            datos = json.dumps(self.informe, indent=2, ensure_ascii=False)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(datos)
+            os.replace(tmp_path, self.path)
+            return True
+        except OSError as e:
+            log.error("Error guardando el informe de ejecución de %s: %s", self.expo_id, e)
+            return False
+
+    @staticmethod
+    def _etiqueta(valor):
+        return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def prometheus(cls):
+        '''Totales del proceso en el formato de texto de Prometheus (text/plain; version=0.0.4).'''
+        series = [
+            ('expo_etapa_ejecuciones_total', 'ejecuciones', 'Veces que se ha ejecutado la etapa'),
+            ('expo_etapa_segundos_total', 'segundos', 'Segundos acumulados en la etapa'),
+            ('expo_etapa_errores_total', 'errores', 'Ejecuciones de la etapa terminadas con error'),
+            ('expo_etapa_ficheros_total', 'ficheros', 'Ficheros tratados en la etapa'),
+            ('expo_etapa_bytes_total', 'bytes', 'Bytes tratados en la etapa'),
+            ('expo_etapa_fotogramas_total', 'fotogramas', 'Fotogramas codificados en la etapa'),
+        ]
+        with cls._totales_lock:
+            totales = {clave: dict(total) for clave, total in cls._totales.items()}
+        lineas = []
+        for nombre, campo, ayuda in series:
+            lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} counter"]
+            for (etapa, expo_id), total in sorted(totales.items()):
+                lineas.append(f'{nombre}{{etapa="{cls._etiqueta(etapa)}",expo="{cls._etiqueta(expo_id)}"}} '
+                              f'{total.get(campo, 0)}')
+        return '\n'.join(lineas) + '\n'
+
+class Recodificador:
+    def __init__(self, expo_id, perfil=None):
         self.expo_id = expo_id
         self.full_output_path = os.path.join(os.getcwd(), 'expos', self.expo_id)
         self.carpeta_origen = os.path.join(self.full_output_path, 'ficheros_salida')
         self.carpeta_destino = os.path.join(self.full_output_path, 'procesados')
+        self.excel_path = os.path.join(self.full_output_path, 'Resumen obras.xlsx')
         self.max_workers = max(1, min(os.cpu_count() - 1, 4))
-        
-        # Crear un archivo de progreso con lock
-        self.progress_file = os.path.join(self.full_output_path, 'progress.json')
-        if os.path.exists(self.progress_file):
-            os.remove(self.progress_file)
-        with open(self.progress_file, 'w') as f:
-            json.dump({}, f)
+        self.perfil = PerfilCodificacion.seleccionar(perfil, workers=self.max_workers)
+        # Canal de progreso (ProgressBus); lo asigna quien monitoriza la recodificación
+        self.progress_bus = None
+        # Fotogramas que codificó ffmpeg en el último process_file (para Metricas)
+        self.fotogramas = None
+        # Metadatos de la salida del último process_file sacados de la propia codificación
+        self.info_salida = None
+
+    @property
+    def metadata_cache(self):
+        # Propiedad y no atributo: la instancia se serializa para los workers del pool
+        return MetadataCache.for_expo(self.expo_id)
 
     def process_file(self, file_path):
+        '''
+        Procesa un fichero de ficheros_salida y devuelve el nombre del fichero generado en
+        procesados, o False si falla. Los vídeos se escriben en <nombre>.<pid>.part y solo pasan
+        a su nombre al terminar bien: una salida a medias no la recogen /previews, el resumen ni
+        los paquetes de las pantallas, y ffmpeg no trunca el inodo que comparten sus enlaces duros.
+        '''
+        parcial = None
         try:
             file_name = os.path.basename(file_path)
-            print(f"Iniciando procesamiento de {file_name}")
+            log.debug("Iniciando procesamiento de %s", file_name)
+            self.save_progress(file_name, 0)
             
             if file_name.lower().endswith('.mp4'):
-                print(f"Procesando video: {file_name}")
+                log.debug("Procesando video: %s", file_name)
                 archivo_salida = os.path.join(self.carpeta_destino, file_name)
-                
-                cmd = [
-                    'ffmpeg',
-                    '-i', file_path,
-                    '-vf', 'fps=30,scale=1920:1080:flags=bicubic',
-                    '-c:v', 'libx265',
-                    '-preset', 'medium',
-                    '-crf', '23',
-                    '-c:a', 'aac',
-                    '-b:v', '45M',
-                    '-maxrate', '60M',
-                    '-bufsize', '60M',
-                    '-movflags', '+faststart',
-                    '-progress', '-',  # Enviar progreso a stdout
-                    '-y',
-                    archivo_salida
-                ]
-                
-                print(f"Ejecutando comando: {' '.join(cmd)}")
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True,
-                    bufsize=1  # Line buffered
-                )
-                
-                start_time = time.time()
-                last_progress_update = 0
-                
-                while True:
-                    # Leer la salida de ffmpeg
-                    output = process.stdout.readline()
-                    if output == '' and process.poll() is not None:
-                        break
-                    
-                    # Imprimir la salida para debug
-                    if output:
-                        print(f"[{file_name}] {output.strip()}")
-                        
-                        # Calcular progreso basado en el tiempo transcurrido
-                        current_time = time.time()
-                        elapsed_time = current_time - start_time
-                        
-                        # Actualizar progreso cada segundo
-                        if elapsed_time - last_progress_update >= 1:
-                            progress = min(95, (elapsed_time / 300) * 100)  # 300 segundos estimados
-                            self.save_progress(file_name, progress)
-                            last_progress_update = elapsed_time
-                            print(f"Progreso de {file_name}: {progress:.2f}%")
-                    
-                    # Leer también stderr para evitar bloqueos
-                    error = process.stderr.readline()
-                    if error:
-                        print(f"[{file_name}] Error: {error.strip()}")
-                
-                # Obtener el código de retorno
-                return_code = process.poll()
-                
+                parcial = f"{archivo_salida}.{os.getpid()}.part"
+
+                # Los vídeos que ya cumplen las especificaciones no se recodifican
+                info = self.metadata_cache.get_info(file_path)
+                decision, motivos = VideoCompliance.decidir(file_path, info, self.perfil)
+                if decision == VideoCompliance.COPIAR:
+                    log.debug("%s cumple las especificaciones: se copia sin recodificar", file_name)
+                    shutil.copy2(file_path, parcial)
+                    os.replace(parcial, archivo_salida)
+                    self.save_progress(file_name, 100, estado=ProgressBus.TERMINADO)
+                    return file_name
+                ultimo_envio = [0.0]
+
+                def on_progress(progreso):
+                    # Como mucho una actualización por segundo, salvo el bloque final
+                    ahora = time.time()
+                    if progreso['percent'] is None or (ahora - ultimo_envio[0] < 1 and not progreso['done']):
+                        return
+                    ultimo_envio[0] = ahora
+                    self.save_progress(file_name, progreso['percent'], eta=progreso['eta'], speed=progreso['speed'])
+
+                duration = info['DURACION_SEG'] if decision == VideoCompliance.REMUX and info else VideoInfo.get_duration(file_path)
+                grafo = None
+                if decision == VideoCompliance.REMUX:
+                    log.debug("%s cumple las especificaciones: se remultiplexa con +faststart", file_name)
+                    cmd = VideoCompliance.comando_remux(file_path, parcial, self.perfil, self.sonoridad(file_path))
+                else:
+                    log.debug("%s se recodifica por: %s", file_name, ', '.join(motivos))
+                    # Una sola vez: si la codificación por trozos falla, la de una pasada los reutiliza
+                    bucle, sonoridad = self.bucle(file_path), self.sonoridad(file_path)
+                    if self.codificar_segmentado(file_path, archivo_salida, duration, bucle, sonoridad, on_progress):
+                        self.save_progress(file_name, 100, estado=ProgressBus.TERMINADO)
+                        return file_name
+                    cmd, grafo = self.comando_video(file_path, parcial, duration, bucle, sonoridad)
+                log.debug("Ejecutando comando: %s", ' '.join(cmd))
+
+                runner = FFmpegRunner(cmd, duration=duration, on_progress=on_progress, label=file_name)
+                return_code = None
+                try:
+                    return_code = runner.run()
+                finally:
+                    if grafo is not None:
+                        grafo.terminar(return_code == 0)
+                self.fotogramas = runner.last_progress.get('frame')
                 if return_code == 0:
-                    print(f"Video {file_name} procesado exitosamente")
-                    self.save_progress(file_name, 100)
-                    return True
+                    os.replace(parcial, archivo_salida)
+                if grafo is not None and return_code == 0:
+                    self.info_salida = grafo.estadisticas(archivo_salida, runner.last_progress)
+
+                if return_code == 0:
+                    log.debug("Video %s procesado exitosamente", file_name)
+                    self.save_progress(file_name, 100, estado=ProgressBus.TERMINADO)
+                    return file_name
                 else:
-                    print(f"Error procesando video {file_name}. Código de retorno: {return_code}")
-                    error_output = process.stderr.read()
-                    print(f"Error detallado: {error_output}")
-                    self.save_progress(file_name, 0)
+                    log.error("Error procesando video %s. Código de retorno: %s", file_name, return_code)
+                    log.error("Error detallado: %s", chr(10).join(runner.stderr_tail))
+                    self.save_progress(file_name, 0, estado=ProgressBus.ERROR)
                     return False
-                    
+
             else:
-                print(f"Procesando imagen: {file_name}")
-                self.procesar_imagen(file_path)
-                self.save_progress(file_name, 100)
-                return True
+                log.debug("Procesando imagen: %s", file_name)
+                nombre_salida = self.procesar_imagen(file_path)
+                if not os.path.exists(os.path.join(self.carpeta_destino, nombre_salida)):
+                    self.save_progress(file_name, 0, estado=ProgressBus.ERROR)
+                    return False
+                self.save_progress(file_name, 100, estado=ProgressBus.TERMINADO)
+                return nombre_salida
                 
         except Exception as e:
-            print(f"Error procesando {file_path}: {str(e)}")
-            self.save_progress(file_name, 0)
+            log.error("Error procesando %s: %s", file_path, e)
+            self.save_progress(os.path.basename(file_path), 0, estado=ProgressBus.ERROR)
             return False
+        finally:
+            if parcial and os.path.exists(parcial):
+                os.remove(parcial)
 
-    def save_progress(self, filename, progress):
-        """Guarda el progreso de forma segura"""
-        max_retries = 3
-        for _ in range(max_retries):
-            try:
-                with open(self.progress_file, 'r') as f:
-                    progress_dict = json.load(f)
-                progress_dict[filename] = progress
-                with open(self.progress_file, 'w') as f:
-                    json.dump(progress_dict, f)
-                return True
-            except Exception as e:
-                print(f"Error guardando progreso: {e}")
-                time.sleep(0.1)
-        return False
+    def process_file_medido(self, file_path):
+        '''
+        process_file con sus medidas para Metricas. Se ejecuta en el worker, donde se conocen
+        los fotogramas: devuelve (salida, {segundos, ficheros, bytes, bytes_salida, fotogramas,
+        info_salida}). `info_salida` (los metadatos que dejó un GrafoFusionado) no es una medida:
+        quien recibe el resultado lo guarda en el MetadataCache del proceso principal, que es el
+        que lo escribe a disco.
+        '''
+        inicio = time.perf_counter()
+        self.fotogramas = None
+        self.info_salida = None
+        salida = self.process_file(file_path)
+        medidas = {'segundos': time.perf_counter() - inicio, 'ficheros': 1, 'fotogramas': self.fotogramas,
+                   'info_salida': self.info_salida}
+        try:
+            medidas['bytes'] = os.path.getsize(file_path)
+            if salida:
+                medidas['bytes_salida'] = os.path.getsize(os.path.join(self.carpeta_destino, salida))
+        except OSError:
+            pass
+        return salida, medidas
 
-    def procesar_video(self, file_path):
+    def codificar_segmentado(self, file_path, archivo_salida, duracion, bucle, sonoridad, on_progress=None):
+        '''
+        Codifica un vídeo largo en trozos paralelos (CodificacionSegmentada) si le corresponde
+        más de un hilo. Devuelve False si no se aplica o si falla: entonces se codifica de una
+        pasada. `bucle` y `sonoridad` son los de self.bucle() y self.sonoridad(), calculados
+        por quien llama para no repetirlos en esa pasada.
+        '''
+        perfil = self.perfil_para(file_path)
+        codificadores = CodificacionSegmentada.codificadores_para(perfil, duracion)
+        if not codificadores:
+            return False
+        file_name = os.path.basename(file_path)
+        segmentada = CodificacionSegmentada(perfil, codificadores, bucle=bucle, sonoridad=sonoridad,
+                                            on_progress=on_progress, label=file_name)
         try:
-            nombre_archivo = os.path.basename(file_path)
-            archivo_salida = os.path.join(self.carpeta_destino, nombre_archivo)
-            print(f"Procesando video {nombre_archivo} -> {archivo_salida}")
-            
-            # Primero obtener la duración del video
-            probe_cmd = [
-                'ffprobe', 
-                '-v', 'error',
-                '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1',
-                file_path
-            ]
-            
-            duration = float(subprocess.check_output(probe_cmd).decode().strip())
-            print(f"Duración del video: {duration} segundos")
-            
-            # Configurar el comando ffmpeg
-            cmd = [
-                'ffmpeg',
-                '-i', file_path,
-                '-vf', 'fps=30,scale=1920:1080:flags=bicubic',
-                '-c:v', 'libx265',
-                '-preset', 'medium',
-                '-crf', '23',
-                '-c:a', 'aac',
-                '-b:v', '45M',
-                '-maxrate', '60M',
-                '-bufsize', '60M',
-                '-movflags', '+faststart',
-                '-progress', 'pipe:1',  # Enviar progreso a stdout
-                '-y',
-                archivo_salida
-            ]
+            hecho = segmentada.codificar(file_path, archivo_salida, duracion)
+        except (OSError, RuntimeError) as e:
+            log.warning("%s: %s. Se codifica de una pasada", file_name, e)
+            return False
+        self.fotogramas = segmentada.fotogramas
+        return hecho
 
-            print(f"Ejecutando comando: {' '.join(cmd)}")
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-            
-            # Leer la salida línea por línea para monitorear el progreso
-            while True:
-                line = process.stdout.readline()
-                if not line:
-                    break
-                
-                # Buscar la línea que contiene el tiempo actual
-                if 'out_time_ms=' in line:
-                    current_time = float(line.split('=')[1]) / 1000000  # Convertir microsegundos a segundos
-                    progress = min(100, (current_time / duration) * 100)
-                    print(f"Progreso de {nombre_archivo}: {progress:.2f}%")
-            
-            # Esperar a que termine el proceso
-            process.wait()
+    def comando_video(self, file_path, archivo_salida, duracion, bucle, sonoridad):
+        '''
+        Comando de recodificación y el GrafoFusionado que lo construyó, o None si
+        comunes['fusionar'] es 'no' (entonces solo se produce la salida para las pantallas).
+        '''
+        perfil = self.perfil_para(file_path)
+        if perfil.comunes['fusionar'] != 'si':
+            return perfil.comando(file_path, archivo_salida, bucle=bucle, sonoridad=sonoridad), None
+        grafo = GrafoFusionado(perfil, self.expo_id, bucle=bucle, sonoridad=sonoridad)
+        return grafo.comando(file_path, archivo_salida, duracion), grafo
+
+    def perfil_para(self, file_path):
+        '''
+        Perfil con el control de tasa que eligió PlanRecodificacion para este vídeo (CRF
+        corregido o tasa media), o el perfil tal cual si no hay plan vigente para él.
+        '''
+        entrada = PlanRecodificacion.parametros(self.expo_id, self.perfil, file_path)
+        if entrada is None or entrada['crf'] == self.perfil.crf:
+            return self.perfil
+        perfil = copy.copy(self.perfil)
+        perfil.crf = entrada['crf']
+        parametros = f"CRF {entrada['crf']}" if entrada['modo'] == PlanRecodificacion.CRF else 'tasa media'
+        log.debug("%s: %s según el plan de recodificación", os.path.basename(file_path), parametros)
+        return perfil
+
+    def guardar_info_salida(self, salida, info):
+        '''Registra en el índice de metadatos las estadísticas de una salida ya codificada.'''
+        try:
+            self.metadata_cache.put_info(os.path.join(self.carpeta_destino, salida), info)
+        except OSError as e:
+            log.warning("No se han podido guardar los metadatos de %s: %s", salida, e)
+
+    def bucle(self, file_path):
+        '''Si la salida debe prepararse para reproducirse en bucle (comunes['bucle']).'''
+        modo = self.perfil.comunes['bucle']
+        if modo != 'auto':
+            return modo == 'si'
+        bucle = CosturaBucle.es_bucle(file_path)
+        if bucle:
+            log.debug("%s empieza y acaba en el mismo fotograma: GOP cerrado y alineado para el bucle", os.path.basename(file_path))
+        return bucle
+
+    def sonoridad(self, file_path):
+        '''Medidas de la primera pasada de loudnorm, si el perfil normaliza el audio.'''
+        if self.perfil.comunes['audio'] != 'normalizar':
+            return None
+        return PerfilCodificacion.medir_sonoridad(file_path)
+
+    def save_progress(self, filename, progress, eta=None, speed=None, estado=ProgressBus.PROCESANDO):
+        """Publica el progreso de un fichero en el bus, si alguien está monitorizando"""
+        if self.progress_bus is None:
+            return False
+        try:
+            self.progress_bus.publish(filename, estado, progress, speed=speed, eta=eta)
+            return True
+        except Exception as e:
+            log.error("Error publicando progreso: %s", e)
+            return False
+
+    def procesar_video(self, file_path):
+        try:
+            nombre_archivo = os.path.basename(file_path)
+            archivo_salida = os.path.join(self.carpeta_destino, nombre_archivo)
+            log.debug("Procesando video %s -> %s", nombre_archivo, archivo_salida)
             
-            if process.returncode != 0:
-                stderr = process.stderr.read()
-                print(f"Error en ffmpeg: {stderr}")
-                raise subprocess.CalledProcessError(process.returncode, cmd, stderr)
+            # Primero obtener la duración del video
+            duration = VideoInfo.get_duration(file_path)
+            log.debug("Duración del video: %s segundos", duration)
+
+            def on_progress(progreso):
+                # Un bloque de progreso por segundo y fichero: no formatear si no se va a escribir
+                if progreso['percent'] is not None and log.isEnabledFor(logging.DEBUG):
+                    eta = f", ETA {progreso['eta']:.0f}s" if progreso['eta'] is not None else ''
+                    velocidad = f", {progreso['speed']:.2f}x" if progreso['speed'] else ''
+                    log.debug("Progreso de %s: %.2f%%%s%s", nombre_archivo, progreso['percent'], velocidad, eta)
+
+            bucle, sonoridad = self.bucle(file_path), self.sonoridad(file_path)
+            if self.codificar_segmentado(file_path, archivo_salida, duration, bucle, sonoridad, on_progress):
+                log.debug("Video procesado por trozos: %s", nombre_archivo)
+                return True
+
+            parcial = f"{archivo_salida}.{os.getpid()}.part"
+            cmd, grafo = self.comando_video(file_path, parcial, duration, bucle, sonoridad)
+            log.debug("Ejecutando comando: %s", ' '.join(cmd))
+
+            runner = FFmpegRunner(cmd, duration=duration, on_progress=on_progress, label=nombre_archivo)
+            return_code = None
+            try:
+                return_code = runner.run()
+                if return_code == 0:
+                    os.replace(parcial, archivo_salida)
+            finally:
+                if grafo is not None:
+                    grafo.terminar(return_code == 0)
+                if os.path.exists(parcial):
+                    os.remove(parcial)
+
+            if return_code != 0:
+                stderr = '\n'.join(runner.stderr_tail)
+                log.error("Error en ffmpeg: %s", stderr)
+                raise subprocess.CalledProcessError(return_code, cmd, stderr)
             
-            print(f"Video procesado exitosamente: {nombre_archivo}")
+            if grafo is not None:
+                info = grafo.estadisticas(archivo_salida, runner.last_progress)
+                if info:
+                    self.guardar_info_salida(nombre_archivo, info)
+            log.debug("Video procesado exitosamente: %s", nombre_archivo)
             return True
             
         except Exception as e:
-            print(f"Error procesando video {file_path}: {str(e)}")
+            log.error("Error procesando video %s: %s", file_path, e)
             raise
 
-    def crear_carpeta_procesados(self):
+    def crear_carpeta_procesados(self, limpiar=False):
+        '''
+        Crea la carpeta procesados. Solo la vacía si se pide explícitamente (`limpiar=True`):
+        la cola de recodificación reutiliza las salidas que siguen siendo válidas.
+        '''
         if not os.path.exists(self.carpeta_destino):
             os.makedirs(self.carpeta_destino)
-            print(f"Carpeta '{self.carpeta_destino}' creada.")
-        else:
+            log.info("Carpeta '%s' creada.", self.carpeta_destino)
+        elif limpiar:
             # Si la carpeta existe, limpiarla
             for archivo in os.listdir(self.carpeta_destino):
                 ruta_archivo = os.path.join(self.carpeta_destino, archivo)
                 if os.path.isfile(ruta_archivo):
                     os.remove(ruta_archivo)
-            print(f"Carpeta '{self.carpeta_destino}' limpiada para nuevo procesamiento.")
+            log.info("Carpeta '%s' limpiada para nuevo procesamiento.", self.carpeta_destino)
         return True
 
     def procesar_archivos(self):
         archivos = os.listdir(self.carpeta_origen)
-        total_archivos = len(archivos)
+        imagenes = [os.path.join(self.carpeta_origen, a) for a in archivos if a.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        videos = [os.path.join(self.carpeta_origen, a) for a in archivos if a.lower().endswith('.mp4')]
+        # Con menos vídeos que workers a cada vídeo le tocan más hilos (y un vídeo largo se parte en más trozos)
+        if videos and not self.perfil.hardware and len(videos) < self.max_workers:
+            self.perfil.threads = max(1, (os.cpu_count() or 1) // len(videos))
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = []
-            for archivo in archivos:
-                ruta_archivo = os.path.join(self.carpeta_origen, archivo)
-                if archivo.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    futures.append(executor.submit(self.procesar_imagen, ruta_archivo))
-                elif archivo.lower().endswith('.mp4'):
-                    futures.append(executor.submit(self.procesar_video, ruta_archivo))
-
-            with tqdm(total=total_archivos, desc="Progreso global") as pbar:
+            futures = [executor.submit(self.procesar_video, ruta_archivo) for ruta_archivo in videos]
+
+            # Las imágenes, en lote en un pool de procesos mientras ffmpeg trabaja con los vídeos
+            ConformadorImagen.procesar_lote(imagenes, self.carpeta_destino, procesos=self.max_workers)
+
+            with tqdm(total=len(videos), desc="Progreso global") as pbar:
                 for future in concurrent.futures.as_completed(futures):
                     pbar.update(1)
 
     def procesar_imagen(self, ruta_archivo):
         nombre_archivo = os.path.basename(ruta_archivo)
-        with tqdm(total=1, desc=f"Procesando imagen: {nombre_archivo}", leave=False) as pbar:
-            try:
-                with Image.open(ruta_archivo) as img:
-                    ancho, alto = img.size
-                    formato = img.format
-                    modo = img.mode
-                    tamano = os.path.getsize(ruta_archivo)
-                    tamano_kb = tamano / 1024
-
-                    necesita_procesamiento = False
-                    razones = []
-
-                    # Verificar resolución (debe ser exactamente 2160x3840 o 3840x2160)
-                    if (ancho, alto) not in [(2160, 3840), (3840, 2160)]:
-                        necesita_procesamiento = True
-                        razones.append(f"Resolución incorrecta: {ancho}x{alto}")
-
-                    # Verificar formato y modo
-                    if formato not in ['JPEG', 'JPG', 'PNG']:
-                        necesita_procesamiento = True
-                        razones.append(f"Formato incorrecto: {formato}")
-                    if modo != 'RGB':
-                        necesita_procesamiento = True
-                        razones.append(f"Modo de color incorrecto: {modo}")
-
-                    # Verificar tamaño (más de 10MB sería excesivo para estas resoluciones)
-                    if tamano_kb > 10 * 1024:  # más de 10MB
-                        necesita_procesamiento = True
-                        razones.append(f"Tamaño excesivo: {tamano_kb:.2f}KB")
-
-                    if necesita_procesamiento:
-                        print(f"Procesando {nombre_archivo} por: {', '.join(razones)}")
-                        img_procesada = img.convert('RGB')
-                        
-                        # Ajustar resolución si es necesario
-                        if (ancho, alto) not in [(2160, 3840), (3840, 2160)]:
-                            if ancho > alto:
-                                nuevo_ancho, nuevo_alto = 3840, 2160
-                            else:
-                                nuevo_ancho, nuevo_alto = 2160, 3840
-                            img_procesada = img_procesada.resize((nuevo_ancho, nuevo_alto), Image.Resampling.LANCZOS)
-
-                        nuevo_nombre = os.path.splitext(nombre_archivo)[0] + '_procesado.jpg'
-                        ruta_destino = os.path.join(self.carpeta_destino, nuevo_nombre)
-                        img_procesada.save(ruta_destino, 'JPEG', 
-                                         quality=85,  # Alta calidad pero no máxima
-                                         optimize=True,  # Optimizar el encoding
-                                         dpi=(72, 72),  # Establecer DPI a 72
-                                         progressive=True)  # Hacer la imagen progresiva
-                    else:
-                        print(f"No se procesa {nombre_archivo}: cumple todos los criterios")
-                        print(f"- Formato: {formato}")
-                        print(f"- Modo: {modo}")
-                        print(f"- Resolución: {ancho}x{alto}")
-                        print(f"- Tamaño: {tamano_kb:.2f}KB")
-                        nuevo_nombre = nombre_archivo
-                        ruta_destino = os.path.join(self.carpeta_destino, nuevo_nombre)
-                        shutil.copy2(ruta_archivo, ruta_destino)
-
-                time.sleep(0.1)
-                pbar.update(1)
-                return nuevo_nombre
+        try:
+            nuevo_nombre, motivos = ConformadorImagen.procesar(ruta_archivo, self.carpeta_destino)
+            if motivos:
+                log.debug("Procesada %s por: %s", nombre_archivo, ', '.join(motivos))
+            else:
+                log.debug("No se procesa %s: cumple todos los criterios", nombre_archivo)
+            return nuevo_nombre
+        except Exception as e:
+            log.error("Error al procesar la imagen %s: %s", nombre_archivo, e)
+            return nombre_archivo
+
+    def decision_recodificacion(self, nombre_archivo):
+        '''(decisión, motivos) tomada para un fichero de ficheros_salida.'''
+        file_path = os.path.join(self.carpeta_origen, nombre_archivo)
+        if not os.path.exists(file_path):
+            return None, []
+        if FileManager.is_video(file_path):
+            return VideoCompliance.decidir(file_path, self.metadata_cache.get_info(file_path), self.perfil)
+        # Imágenes: procesar_imagen genera <nombre>_procesado.jpg solo si no cumplen
+        procesada = os.path.join(self.carpeta_destino, os.path.splitext(nombre_archivo)[0] + ConformadorImagen.SUFIJO)
+        if os.path.exists(procesada):
+            return VideoCompliance.RECODIFICAR, []
+        return VideoCompliance.COPIAR, []
 
-            except Exception as e:
-                print(f"Error al procesar la imagen {nombre_archivo}: {str(e)}")
-                return nombre_archivo
-            
     def actualizar_excel(self):
         try:
             # Leer el Excel existente
             df = pd.read_excel(self.excel_path)
             
-            # Obtener información actualizada de los archivos procesados
-            archivos_procesados = get_files_info_from_directory(self.carpeta_destino)
-            
-            # Crear un diccionario para mapear nombres de archivo a sus nuevos datos
-            nuevos_datos = {row['NOMBRE_ARCHIVO']: row for _, row in archivos_procesados.iterrows()}
-            
-            # Columnas para los datos recodificados
-            columnas_recodificadas = ['ANCHO_RECODIFICADO', 'ALTO_RECODIFICADO', 'RESOLUCION_X_RECODIFICADO', 
-                                      'RESOLUCION_Y_RECODIFICADO', 'ORIENTACION_RECODIFICADO', 'FORMATO_RECODIFICADO', 
-                                      'TAMAÑO_MB_RECODIFICADO', 'DURACION_SEG_RECODIFICADO', 'FPS_RECODIFICADO', 
-                                      'TASA_BITS_RECODIFICADO', 'CÓDEC_VIDEO_RECODIFICADO']
-            
-            # Añadir columnas para los datos recodificados
-            for columna in columnas_recodificadas:
-                if columna not in df.columns:
-                    df[columna] = None
-            
-            # Actualizar el DataFrame con los nuevos datos
-            for index, row in df.iterrows():
-                nombre_archivo = row['NOMBRE_ARCHIVO']
-                nombre_procesado = nombre_archivo.replace('.', '_procesado.')
-                
-                if nombre_procesado in nuevos_datos:
-                    df.at[index, 'PROCESADO'] = 'Sí'
-                    for columna in columnas_recodificadas:
-                        columna_original = columna.replace('_RECODIFICADO', '')
-                        if columna_original in nuevos_datos[nombre_procesado]:
-                            df.at[index, columna] = nuevos_datos[nombre_procesado][columna_original]
-                else:
-                    df.at[index, 'PROCESADO'] = 'No'
-            
-            # Guardar primero con pandas
-            df.to_excel(self.excel_path, index=False)
-            
-            # Abrir el archivo con openpyxl para añadir el formato de tabla
-            wb = load_workbook(self.excel_path)
-            ws = wb.active
-            
-            # Obtener el rango de la tabla
-            tabla_ref = f"A1:{chr(64 + len(df.columns))}{len(df.index) + 1}"
-            
-            # Crear la tabla con estilo
-            tabla = Table(displayName="TablaObras", ref=tabla_ref)
-            estilo = TableStyleInfo(
-                name="TableStyleMedium2", 
-                showFirstColumn=False,
-                showLastColumn=False,
-                showRowStripes=True,
-                showColumnStripes=False
-            )
-            tabla.tableStyleInfo = estilo
-            
-            # Añadir la tabla a la hoja
-            ws.add_table(tabla)
-            
-            # Ajustar el ancho de las columnas
-            for column in ws.columns:
-                max_length = 0
-                column = list(column)
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column[0].column_letter].width = adjusted_width
-            
-            # Guardar los cambios
-            wb.save(self.excel_path)
-            print(f"Excel actualizado con formato de tabla: {self.excel_path}")
+            # Obtener información actualizada de los archivos procesados y unirla por nombre
+            archivos_procesados = get_files_info_from_directory(self.carpeta_destino, cache=self.metadata_cache)
+            df = ResumenExcel.combinar(df, archivos_procesados, ConformadorImagen.SUFIJO)
+
+            decisiones = [self.decision_recodificacion(nombre) for nombre in df['NOMBRE_ARCHIVO']]
+            df['DECISION_RECODIFICACION'] = [decision for decision, _ in decisiones]
+            df['MOTIVO_RECODIFICACION'] = [', '.join(motivos) for _, motivos in decisiones]
+
+            ResumenExcel.escribir(df, self.excel_path)
+            log.info("Excel actualizado con formato de tabla: %s", self.excel_path)
         
         except Exception as e:
-            print(f"Error al actualizar el Excel: {str(e)}")
+            log.error("Error al actualizar el Excel: %s", e)
+
+class ColaRecodificacion:
+    '''
+    Cola persistente de recodificación de una exposición (`expos/<expo_id>/cola_recodificacion.json`).
+
+    Para cada fichero de ficheros_salida guarda la huella de la entrada (tamaño, mtime, perfil
+    de codificación y parámetros del plan de recodificación, si hay), su estado y la huella de las salidas generadas. Así una recodificación
+    interrumpida se reanuda sin repetir lo que ya está hecho, y un fichero que no ha cambiado
+    no se vuelve a procesar.
+    '''
+    FICHERO = 'cola_recodificacion.json'
+    VERSION = 1
+    EXTENSIONES = ('.mp4', '.jpg', '.jpeg', '.png')
+
+    PENDIENTE = 'pendiente'
+    PROCESANDO = 'procesando'
+    TERMINADO = 'terminado'
+    ERROR = 'error'
+
+    def __init__(self, recodificador):
+        self.recodificador = recodificador
+        self.path = os.path.join(recodificador.full_output_path, self.FICHERO)
+        self._lock = threading.Lock()
+        self.ficheros = self._load()
+
+    @classmethod
+    def ruta(cls, expo_id):
+        return os.path.join(os.getcwd(), 'expos', expo_id, cls.FICHERO)
+
+    @classmethod
+    def leer(cls, expo_id):
+        '''Estado de los ficheros según el disco, sin construir un Recodificador (para observar desde otro proceso).'''
+        try:
+            with open(cls.ruta(expo_id), 'r') as f:
+                data = json.load(f)
+            if data.get('version') == cls.VERSION:
+                return data.get('ficheros', {})
+        except (FileNotFoundError, ValueError):
+            pass
+        return {}
+
+    @staticmethod
+    def huella(file_path):
+        stat = os.stat(file_path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                return data.get('ficheros', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Cola de recodificación ilegible, se reconstruirá: %s", e)
+        return {}
+
+    def save(self):
+        with self._lock:
+            data = {'version': self.VERSION, 'ficheros': self.ficheros}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def _huella_entrada(self, file_path):
+        # Cambiar de perfil de codificación invalida los vídeos, no las imágenes; y también que
+        # un plan de recodificación cambie el control de tasa (CRF o tasa media) de un vídeo
+        if not FileManager.is_video(file_path):
+            return self.huella(file_path)
+        huella = f"{self.huella(file_path)}-{self.recodificador.perfil.nombre}"
+        plan = PlanRecodificacion.parametros(self.recodificador.expo_id, self.recodificador.perfil, file_path)
+        if plan is not None:
+            huella += f"-{plan['modo']}-{plan['crf']}"
+        return huella
+
+    def _salidas_validas(self, entrada):
+        if not entrada.get('salidas'):
+            return False
+        for nombre, huella in entrada['salidas'].items():
+            ruta = os.path.join(self.recodificador.carpeta_destino, nombre)
+            if not os.path.exists(ruta) or self.huella(ruta) != huella:
+                return False
+        return True
+
+    def _borrar_salidas(self, entrada):
+        for nombre in entrada.get('salidas', {}):
+            ruta = os.path.join(self.recodificador.carpeta_destino, nombre)
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+    def sincronizar(self):
+        '''
+        Compara la cola con ficheros_salida y devuelve las rutas que hay que (re)procesar.
+        Las entradas de ficheros que ya no existen se eliminan junto con sus salidas. Se llama
+        con la recodificación de la exposición bloqueada, así que ningún .part está en uso.
+        '''
+        origen = self.recodificador.carpeta_origen
+        actuales = sorted(f for f in os.listdir(origen)
+                          if f.lower().endswith(self.EXTENSIONES) and os.path.isfile(os.path.join(origen, f)))
+
+        for nombre in list(self.ficheros):
+            if nombre not in actuales:
+                self._borrar_salidas(self.ficheros.pop(nombre))
+
+        # Salidas a medias de una recodificación que se interrumpió sin poder limpiarlas
+        destino = self.recodificador.carpeta_destino
+        for nombre in os.listdir(destino) if os.path.isdir(destino) else ():
+            if nombre.endswith('.part'):
+                os.remove(os.path.join(destino, nombre))
+
+        pendientes = []
+        for nombre in actuales:
+            file_path = os.path.join(origen, nombre)
+            huella = self._huella_entrada(file_path)
+            entrada = self.ficheros.get(nombre)
+            if entrada and entrada['huella'] == huella and entrada['estado'] == self.TERMINADO \
+                    and self._salidas_validas(entrada):
+                continue
+            if entrada and entrada['huella'] != huella:
+                # La entrada cambió: sus salidas anteriores ya no valen
+                self._borrar_salidas(entrada)
+            self.ficheros[nombre] = {
+                'huella': huella,
+                'estado': self.PENDIENTE,
+                'salidas': {},
+                'intentos': entrada.get('intentos', 0) if entrada and entrada['huella'] == huella else 0,
+            }
+            pendientes.append(file_path)
+
+        self.save()
+        return pendientes
+
+    def marcar(self, nombre, estado, salida=None, error=None):
+        entrada = self.ficheros.setdefault(nombre, {'huella': None, 'salidas': {}, 'intentos': 0})
+        entrada['estado'] = estado
+        if estado == self.PROCESANDO:
+            entrada['intentos'] = entrada.get('intentos', 0) + 1
+        if salida:
+            ruta = os.path.join(self.recodificador.carpeta_destino, salida)
+            entrada['salidas'] = {salida: self.huella(ruta)}
+        if error:
+            entrada['error'] = error
+        else:
+            entrada.pop('error', None)
+        self.save()
+
+    def counts(self):
+        return dict(collections.Counter(e['estado'] for e in self.ficheros.values()))
+
+class PlanRecodificacion:
+    '''
+    Estimación de una recodificación antes de lanzarla, a partir de unas pocas muestras.
+
+    De cada vídeo que hay que recodificar se codifican MUESTRAS tramos cortos repartidos por todo
+    el vídeo, con los mismos filtros y parámetros que la codificación completa y en paralelo (un
+    ffmpeg de un hilo por unidad que concede el presupuesto de PlanificadorCodificacion). De ahí se extrapolan la tasa de bits, el tamaño y los segundos
+    de CPU del vídeo entero. Si la tasa prevista con el CRF del perfil se sale del rango de
+    VideoCompliance, se corrige el CRF (la tasa se duplica, más o menos, por cada 6 puntos menos)
+    y se vuelve a muestrear; si ni así entra, el vídeo se codifica a tasa media (-b:v sin CRF).
+
+    El plan se guarda en `expos/<expo_id>/plan_recodificacion.json` con la huella de cada vídeo;
+    Recodificador.perfil_para() aplica los parámetros elegidos mientras la huella y el perfil
+    sigan siendo los mismos.
+    '''
+    FICHERO = 'plan_recodificacion.json'
+    VERSION = 1
+
+    MUESTRAS = 3
+    SEGUNDOS_MUESTRA = 2.0
+    # Correcciones del CRF antes de pasar a tasa media
+    AJUSTES = 2
+    # Por debajo de 12 solo se gastan bits (y CRF 0 en x264 es sin pérdidas, con un perfil
+    # High 4:4:4 que las pantallas no decodifican): si no basta, se pasa a tasa media
+    CRF_MIN, CRF_MAX = 12, 51
+
+    # Modos de control de tasa del plan
+    CRF = 'crf'
+    TASA = 'tasa'
+    PERFIL = 'perfil'   # codificadores por hardware: se usan sus parámetros tal cual
+
+    def __init__(self, recodificador):
+        self.recodificador = recodificador
+        self.perfil = recodificador.perfil
+        self.path = self.ruta(recodificador.expo_id)
+        self.nucleos = PlanificadorCodificacion.global_().presupuesto
+        self.ficheros = self._load()
+
+    @classmethod
+    def ruta(cls, expo_id):
+        return os.path.join(os.getcwd(), 'expos', expo_id, cls.FICHERO)
+
+    @classmethod
+    def leer(cls, expo_id):
+        try:
+            with open(cls.ruta(expo_id), 'r') as f:
+                data = json.load(f)
+            if data.get('version') == cls.VERSION:
+                return data
+        except (FileNotFoundError, ValueError):
+            pass
+        return {}
+
+    @classmethod
+    def parametros(cls, expo_id, perfil, file_path):
+        '''Entrada del plan para `file_path`, o None si no hay plan vigente para él con este perfil.'''
+        plan = cls.leer(expo_id)
+        if plan.get('perfil') != perfil.nombre:
+            return None
+        entrada = plan.get('ficheros', {}).get(os.path.basename(file_path))
+        try:
+            if entrada is None or entrada.get('huella') != ColaRecodificacion.huella(file_path):
+                return None
+        except OSError:
+            return None
+        if 'error' in entrada or entrada.get('modo') not in (cls.CRF, cls.TASA):
+            return None
+        return entrada
+
+    def _load(self):
+        plan = self.leer(self.recodificador.expo_id)
+        return plan.get('ficheros', {}) if plan.get('perfil') == self.perfil.nombre else {}
+
+    def save(self, plan):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(plan, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _bits(valor):
+        '''Tasa de ffmpeg ('45M', '800k') en bits por segundo.'''
+        valor = str(valor)
+        multiplicador = {'k': 1_000, 'K': 1_000, 'M': 1_000_000}.get(valor[-1], 1)
+        return int(float(valor.rstrip('kKM')) * multiplicador)
+
+    def inicios(self, duracion):
+        '''Instantes de inicio de las muestras, centradas en MUESTRAS partes iguales del vídeo.'''
+        if duracion <= self.MUESTRAS * self.SEGUNDOS_MUESTRA:
+            return [0.0]
+        return [max(0.0, duracion * (i + 0.5) / self.MUESTRAS - self.SEGUNDOS_MUESTRA / 2)
+                for i in range(self.MUESTRAS)]
+
+    def _perfil_muestra(self, crf):
+        perfil = copy.copy(self.perfil)
+        perfil.threads, perfil.pools = 1, None
+        perfil.crf = crf
+        return perfil
+
+    def _muestra(self, file_path, crf, bucle, inicio):
+        '''Codifica un tramo. Devuelve (bytes, segundos de vídeo, segundos de CPU).'''
+        perfil = self._perfil_muestra(crf)
+        fd, salida = tempfile.mkstemp(suffix='.mp4', prefix='.muestra_', dir=self.recodificador.full_output_path)
+        os.close(fd)
+        cmd = (['ffmpeg', '-ss', f"{inicio:.3f}", '-t', f"{self.SEGUNDOS_MUESTRA:.3f}", '-i', file_path,
+                '-vf', perfil.filtro_video()]
+               + perfil.argumentos_video(bucle, inicio=inicio)
+               + perfil.argumentos_audio()
+               + ['-y', salida])
+        primero = []
+
+        def on_progress(progreso):
+            # Hasta el primer fotograma codificado solo hay arranque y búsqueda (decodificar desde
+            # el fotograma clave anterior a `inicio`), que en el vídeo completo no se repiten
+            if not primero and progreso['frame'] and not progreso['done']:
+                primero.append((progreso['elapsed'], progreso['out_time'] or 0.0))
+
+        runner = FFmpegRunner(cmd, on_progress=on_progress, label=os.path.basename(file_path))
+        try:
+            if runner.run() != 0:
+                raise RuntimeError(runner.stderr_tail[-1] if runner.stderr_tail else 'ffmpeg falló')
+            final = runner.last_progress
+            segundos = final.get('out_time') or self.SEGUNDOS_MUESTRA
+            segundos_cpu = final['elapsed']
+            if primero and segundos > primero[0][1]:
+                segundos_cpu = (final['elapsed'] - primero[0][0]) / (segundos - primero[0][1]) * segundos
+            return os.path.getsize(salida), segundos, segundos_cpu
+        finally:
+            os.remove(salida)
+
+    def _extrapolar(self, muestras, duracion):
+        bytes_muestras = sum(m[0] for m in muestras)
+        segundos = sum(m[1] for m in muestras) or self.SEGUNDOS_MUESTRA
+        # Una muestra corta empieza con el búfer VBV lleno y puede pasar de maxrate; el vídeo
+        # completo no, así que la tasa prevista se limita a maxrate
+        bitrate = min(bytes_muestras * 8 / segundos, self._bits(self.perfil.comunes['maxrate']))
+        return {
+            'mbps': round(bitrate / 1_000_000, 1),
+            'mb': round(bitrate * duracion / 8 / (1024 * 1024), 1),
+            'segundos_cpu': round(sum(m[2] for m in muestras) / segundos * duracion, 1),
+        }
+
+    def _corregir_crf(self, crf, mbps):
+        objetivo = self._bits(self.perfil.comunes['bitrate']) / 1_000_000
+        correccion = round(6 * math.log2(max(mbps, 0.1) / objetivo))
+        return min(self.CRF_MAX, max(self.CRF_MIN, crf + correccion))
+
+    @staticmethod
+    def _en_rango(mbps):
+        return VideoCompliance.BITRATE_MINIMO <= mbps * 1_000_000 <= VideoCompliance.BITRATE_MAXIMO
+
+    def _siguiente(self, entrada, ronda):
+        '''Parámetros del siguiente muestreo del vídeo, o None si el plan de `entrada` es definitivo.'''
+        if entrada['modo'] != self.CRF or entrada['en_rango']:
+            return None
+        crf = self._corregir_crf(entrada['crf'], entrada['mbps'])
+        if ronda < self.AJUSTES and crf != entrada['crf']:
+            return self.CRF, crf
+        return self.TASA, None
+
+    def _sin_recodificar(self, file_path, info, decision, motivos):
+        tamano = os.path.getsize(file_path)
+        return {
+            'decision': decision, 'motivos': motivos, 'duracion': (info or {}).get('DURACION_SEG'),
+            'modo': None, 'crf': None, 'mbps': round(((info or {}).get('TASA_BITS') or 0) / 1_000_000, 1),
+            'mb': round(tamano / (1024 * 1024), 1), 'segundos_cpu': 0.0, 'en_rango': True,
+        }
+
+    def calcular(self, forzar=False, on_progress=None):
+        '''
+        Estima la recodificación de los vídeos de ficheros_salida y elige sus parámetros. Reutiliza
+        las estimaciones de los vídeos que no han cambiado salvo con `forzar`. Devuelve el plan.
+        on_progress(hechas, total, nombre) se llama al terminar las muestras de cada vídeo; cada
+        corrección del CRF añade las de su nueva ronda al total.
+        '''
+        carpeta = self.recodificador.carpeta_origen
+        nombres = sorted(f for f in os.listdir(carpeta) if f.lower().endswith('.mp4'))
+        ficheros, pendientes = {}, {}
+        for nombre in nombres:
+            file_path = os.path.join(carpeta, nombre)
+            huella = ColaRecodificacion.huella(file_path)
+            anterior = self.ficheros.get(nombre)
+            if not forzar and anterior and anterior.get('huella') == huella and 'error' not in anterior:
+                ficheros[nombre] = anterior
+                continue
+            info = self.recodificador.metadata_cache.get_info(file_path)
+            decision, motivos = VideoCompliance.decidir(file_path, info, self.perfil)
+            if decision != VideoCompliance.RECODIFICAR:
+                ficheros[nombre] = dict(self._sin_recodificar(file_path, info, decision, motivos), huella=huella)
+                continue
+            duracion = VideoInfo.get_duration(file_path) or (info or {}).get('DURACION_SEG') or 0
+            modo = self.CRF if self.perfil.crf is not None else self.PERFIL
+            ficheros[nombre] = {'huella': huella, 'decision': decision, 'motivos': motivos,
+                                'duracion': round(duracion, 2), 'modo': modo, 'crf': self.perfil.crf}
+            pendientes[nombre] = (file_path, duracion, self.recodificador.bucle(file_path))
+
+        planificador = PlanificadorCodificacion.global_()
+        if not pendientes:
+            # Nada que muestrear: la previsión, con lo que ahora queda libre del presupuesto
+            self.nucleos = max(1, planificador.libres())
+        # Las muestras ocupan núcleos como cualquier codificación: salen del presupuesto compartido
+        with Metricas.for_expo(self.recodificador.expo_id).etapa('planificar', ficheros=len(pendientes)), \
+                planificador.reserva(self.nucleos if pendientes else 0) as concedidas, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concedidas)) as executor:
+            if pendientes:
+                self.nucleos = concedidas
+            ronda = hechas = total = 0
+            while pendientes:
+                futuros = {nombre: [executor.submit(self._muestra, file_path, ficheros[nombre]['crf'], bucle, inicio)
+                                    for inicio in self.inicios(duracion)]
+                           for nombre, (file_path, duracion, bucle) in pendientes.items()}
+                total += sum(len(muestras) for muestras in futuros.values())
+                siguientes = {}
+                for nombre, muestras in futuros.items():
+                    entrada = ficheros[nombre]
+                    try:
+                        entrada.update(self._extrapolar([f.result() for f in muestras], pendientes[nombre][1]))
+                    except (OSError, RuntimeError) as e:
+                        log.warning("No se ha podido muestrear %s: %s", nombre, e)
+                        entrada['error'] = str(e)
+                        continue
+                    finally:
+                        hechas += len(muestras)
+                        if on_progress:
+                            on_progress(hechas, total, nombre)
+                    entrada['en_rango'] = self._en_rango(entrada['mbps'])
+                    siguiente = self._siguiente(entrada, ronda)
+                    if siguiente:
+                        log.debug("%s: %s Mbps con CRF %s, se prueba %s", nombre, entrada['mbps'], entrada['crf'], siguiente)
+                        entrada['modo'], entrada['crf'] = siguiente
+                        siguientes[nombre] = pendientes[nombre]
+                pendientes, ronda = siguientes, ronda + 1
+
+        plan = {
+            'version': self.VERSION,
+            'perfil': self.perfil.nombre,
+            'nucleos': self.nucleos,
+            'creado': time.time(),
+            'ficheros': ficheros,
+            'total_mb': round(sum(e.get('mb') or 0 for e in ficheros.values()), 1),
+            'segundos_cpu': round(sum(e.get('segundos_cpu') or 0 for e in ficheros.values()), 1),
+        }
+        # Los vídeos se reparten entre los núcleos concedidos: el tiempo total es el de CPU entre ellos
+        plan['eta'] = round(plan['segundos_cpu'] / self.nucleos, 1)
+        self.ficheros = ficheros
+        self.save(plan)
+        return plan
+
+    @staticmethod
+    def tabla(plan):
+        '''Plan en texto: una fila por vídeo y los totales de la exposición.'''
+        lineas = [f"{'Vídeo':<40}{'decisión':>13}{'parámetros':>12}{'Mbps':>8}{'MB':>10}{'CPU s':>9}"]
+        for nombre, e in plan['ficheros'].items():
+            if 'error' in e:
+                lineas.append(f"{nombre:<40}{'error':>13}  {e['error']}")
+                continue
+            parametros = {PlanRecodificacion.CRF: f"crf {e['crf']}", PlanRecodificacion.TASA: 'tasa media',
+                          PlanRecodificacion.PERFIL: 'perfil'}.get(e['modo'], '-')
+            aviso = '' if e.get('en_rango', True) else '  fuera de rango'
+            lineas.append(f"{nombre:<40}{e['decision']:>13}{parametros:>12}{e['mbps']:8.1f}{e['mb']:10.1f}"
+                          f"{e['segundos_cpu']:9.0f}{aviso}")
+        lineas.append(f"Total: {plan['total_mb']:.0f} MB, {plan['segundos_cpu']:.0f} s de CPU; "
+                      f"unos {plan['eta'] / 60:.1f} min con {plan['nucleos']} núcleos (perfil {plan['perfil']})")
+        return '\n'.join(lineas)
+
+def proceso_vivo(pid):
+    '''True si existe un proceso con ese PID (aunque sea de otro usuario).'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class PresupuestoCompartido:
+    '''
+    Unidades de CPU que ocupa cada proceso del servidor, en `expos/.presupuesto_cpu.json`, para
+    que los workers de gunicorn se repartan un solo presupuesto en lugar de tener uno cada uno.
+    El fichero se lee y se escribe bloqueado (flock); las entradas de procesos que ya no existen
+    no cuentan. Sin fcntl (Windows) cada proceso solo ve lo suyo.
+    '''
+    FICHERO = '.presupuesto_cpu.json'
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(os.getcwd(), 'expos', self.FICHERO)
+
+    def actualizar(self, calcular):
+        '''
+        Con el fichero bloqueado, llama a calcular(unidades en uso en los demás procesos) y anota
+        lo que devuelve como las unidades en uso de este proceso.
+        '''
+        try:
+            import fcntl
+        except ImportError:
+            calcular(0)
+            return
+        FileManager.ensure_directory(os.path.dirname(self.path))
+        # 'a+': abrirlo no debe vaciarlo antes de tener el lock
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                usos = {int(pid): unidades for pid, unidades in json.loads(f.read() or '{}').items()}
+            except (ValueError, AttributeError):
+                usos = {}
+            pid = os.getpid()
+            usos = {otro: unidades for otro, unidades in usos.items()
+                    if otro != pid and unidades and proceso_vivo(otro)}
+            propias = calcular(sum(usos.values()))
+            if propias:
+                usos[pid] = propias
+            f.seek(0)
+            f.truncate()
+            json.dump({str(otro): unidades for otro, unidades in usos.items()}, f)
+            f.flush()
+
+class PlanificadorCodificacion:
+    '''
+    Planificador de recodificación compartido por todo el proceso.
+
+    Todas las recodificaciones (de cualquier exposición) comparten un único pool de procesos y
+    un presupuesto de CPU (`presupuesto` núcleos, por defecto todos, o EXPO_CPU_PRESUPUESTO).
+    Con varios workers de gunicorn el presupuesto es de la máquina, no de cada worker: lo que
+    ocupan los demás procesos se lee de PresupuestoCompartido antes de lanzar nada, y si no
+    queda sitio se vuelve a mirar cada ESPERA_AJENA segundos.
+    Cada tarea consume unidades del presupuesto mientras se ejecuta: una imagen, 1; un vídeo
+    que hay que recodificar, tantos hilos como se le conceden (y se le pasan a ffmpeg como
+    -threads / pools de x265); copiar o remultiplexar, o un codificador por hardware, 1.
+
+    Imágenes y vídeos van en carriles separados para que un lote de JPEG no espere detrás de
+    una codificación HEVC 4K: mientras haya imágenes en cola los vídeos dejan libre
+    `reserva_imagenes`, y mientras haya vídeos en cola las imágenes dejan sitio para al menos
+    uno. Dentro de cada carril se atiende primero el trabajo más corto (duración sondeada en
+    vídeos, tamaño en imágenes).
+    '''
+    IMAGENES = 'imagenes'
+    VIDEOS = 'videos'
+    # Unidades reservadas para trabajo que no pasa por el pool (muestras del plan de recodificación)
+    RESERVAS = 'reservas'
+    HILOS_MIN_VIDEO = 2
+    ESPERA_AJENA = 2
+
+    _global = None
+    _global_lock = threading.Lock()
+
+    def __init__(self, presupuesto=None, reserva_imagenes=1):
+        self.presupuesto = max(1, presupuesto or int(os.environ.get('EXPO_CPU_PRESUPUESTO', 0)) or os.cpu_count() or 1)
+        self.reserva_imagenes = min(reserva_imagenes, self.presupuesto - 1)
+        self._lock = threading.Lock()
+        self._pool = None
+        self.compartido = PresupuestoCompartido()
+        # Unidades que ocupaban los demás procesos en el último reparto
+        self._ajenas = 0
+        self._reintento = None
+        self._secuencia = itertools.count()
+        self._colas = {self.IMAGENES: [], self.VIDEOS: []}
+        self._en_uso = {self.IMAGENES: 0, self.VIDEOS: 0, self.RESERVAS: 0}
+        self._en_curso = {self.IMAGENES: 0, self.VIDEOS: 0}
+        self._completadas = {self.IMAGENES: 0, self.VIDEOS: 0}
+        self._espera_total = {self.IMAGENES: 0.0, self.VIDEOS: 0.0}
+        self._ocupacion_acumulada = 0.0
+        self._ultimo_cambio = self._inicio = time.time()
+
+    @classmethod
+    def global_(cls):
+        '''Planificador del proceso (se crea la primera vez que se usa).'''
+        with cls._global_lock:
+            if cls._global is None:
+                cls._global = cls()
+            return cls._global
+
+    @staticmethod
+    def contexto():
+        '''
+        Contexto de multiprocessing para los pools de trabajo: forkserver (o spawn) y no fork,
+        porque los pools se crean desde hilos del servidor y los workers no deben heredar locks
+        que otro hilo tenga cogidos en ese momento (caché de metadatos...).
+        '''
+        metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return multiprocessing.get_context(metodo)
+
+    def _pool_(self):
+        # ProcessPoolExecutor y no multiprocessing.Pool: si el OOM killer o una señal matan un
+        # worker, sus futures fallan con BrokenProcessPool en lugar de no terminar nunca
+        with self._lock:
+            if self._pool is None:
+                # Un proceso por unidad del presupuesto: nunca hay más tareas que unidades a la vez
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.presupuesto, mp_context=self.contexto(),
+                                                                    initializer=configurar_logging)
+            return self._pool
+
+    def _descartar_pool(self, pool):
+        '''Retira un pool roto; la siguiente tarea crea otro.'''
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        log.error("Un proceso de codificación terminó de forma inesperada: se crea un pool nuevo")
+        pool.shutdown(wait=False)
+
+    def _clasificar(self, recodificador, file_path):
+        '''Carril, clave de orden (trabajo más corto primero) y si la tarea escala con hilos.'''
+        if not FileManager.is_video(file_path):
+            try:
+                tamano = os.path.getsize(file_path)
+            except OSError:
+                tamano = 0
+            return self.IMAGENES, tamano, False
+
+        info = recodificador.metadata_cache.get_info(file_path)
+        duracion = (info or {}).get('DURACION_SEG') or float('inf')
+        decision, _ = VideoCompliance.decidir(file_path, info, recodificador.perfil)
+        if decision != VideoCompliance.RECODIFICAR:
+            # Copiar o remultiplexar es E/S: va delante y con una sola unidad
+            return self.VIDEOS, -1, False
+        return self.VIDEOS, duracion, not recodificador.perfil.hardware
+
+    def enviar(self, recodificador, file_paths):
+        '''
+        Encola los ficheros de una recodificación. Devuelve {file_path: concurrent.futures.Future}
+        con el resultado de recodificador.process_file(file_path) de cada uno.
+
+        Se encolan todos antes de despachar, para que el orden por duración y el reparto entre
+        carriles tengan en cuenta el lote completo.
+        '''
+        futures = {}
+        tareas = []
+        for file_path in file_paths:
+            carril, orden, escalable = self._clasificar(recodificador, file_path)
+            future = concurrent.futures.Future()
+            tareas.append((carril, (orden, next(self._secuencia), recodificador, file_path, escalable, future, time.time())))
+            futures[file_path] = future
+        with self._lock:
+            for carril, tarea in tareas:
+                heapq.heappush(self._colas[carril], tarea)
+        self._despachar()
+        return futures
+
+    def _acumular_ocupacion(self):
+        ahora = time.time()
+        self._ocupacion_acumulada += sum(self._en_uso.values()) * (ahora - self._ultimo_cambio)
+        self._ultimo_cambio = ahora
+
+    def _hilos_video(self, disponibles):
+        # Reparto entre los vídeos en cola, sin bajar de HILOS_MIN_VIDEO
+        en_cola = len(self._colas[self.VIDEOS])
+        simultaneos = max(1, min(en_cola, disponibles // self.HILOS_MIN_VIDEO))
+        return max(1, disponibles // simultaneos)
+
+    def _despachar(self):
+        lanzar = []
+        # El reparto se decide con el presupuesto compartido bloqueado, para que dos procesos no
+        # cuenten a la vez con las mismas unidades libres
+        self.compartido.actualizar(lambda ajenas: self._repartir(ajenas, lanzar))
+        for carril, tarea, unidades in lanzar:
+            self._lanzar(carril, tarea, unidades)
+
+    def _repartir(self, ajenas, lanzar):
+        '''Reserva lo que cabe en el presupuesto menos las unidades `ajenas`. Devuelve las unidades en uso.'''
+        with self._lock:
+            self._ajenas = ajenas
+            presupuesto = self.presupuesto - ajenas
+            while True:
+                libres = presupuesto - sum(self._en_uso.values())
+                if libres <= 0:
+                    break
+                lanzada = False
+                imagenes, videos = self._colas[self.IMAGENES], self._colas[self.VIDEOS]
+
+                # Carril de imágenes: dejar sitio para un vídeo si hay alguno esperando
+                limite_imagenes = presupuesto - (self.HILOS_MIN_VIDEO if videos else 0)
+                if imagenes and self._en_uso[self.IMAGENES] < max(1, limite_imagenes):
+                    lanzar.append(self._reservar(self.IMAGENES, heapq.heappop(imagenes), 1))
+                    lanzada = True
+                    libres -= 1
+
+                # Carril de vídeos: dejar la reserva de imágenes si hay imágenes pendientes o en curso
+                if videos and libres > 0:
+                    reserva = self.reserva_imagenes if (imagenes or self._en_curso[self.IMAGENES]) else 0
+                    disponibles = min(libres, presupuesto - reserva - self._en_uso[self.VIDEOS])
+                    escalable = videos[0][4]
+                    nada_en_curso = not any(self._en_uso.values())
+                    if not escalable and disponibles >= 1:
+                        lanzar.append(self._reservar(self.VIDEOS, heapq.heappop(videos), 1))
+                        lanzada = True
+                    elif escalable and (disponibles >= self.HILOS_MIN_VIDEO or (nada_en_curso and disponibles >= 1)):
+                        hilos = self._hilos_video(disponibles)
+                        lanzar.append(self._reservar(self.VIDEOS, heapq.heappop(videos), hilos))
+                        lanzada = True
+
+                if not lanzada:
+                    break
+
+            # Otro proceso ocupa lo que falta: nadie avisará cuando lo suelte
+            if ajenas and any(self._colas.values()) and self._reintento is None:
+                self._reintento = threading.Timer(self.ESPERA_AJENA, self._reintentar)
+                self._reintento.daemon = True
+                self._reintento.start()
+            return sum(self._en_uso.values())
+
+    def _reintentar(self):
+        with self._lock:
+            self._reintento = None
+        self._despachar()
+
+    def libres(self):
+        '''Unidades del presupuesto que no ocupa ningún proceso.'''
+        resultado = []
+
+        def calcular(ajenas):
+            with self._lock:
+                en_uso = sum(self._en_uso.values())
+                resultado.append(max(0, self.presupuesto - ajenas - en_uso))
+                return en_uso
+
+        self.compartido.actualizar(calcular)
+        return resultado[0]
+
+    @contextlib.contextmanager
+    def reserva(self, maximo):
+        '''
+        Reserva hasta `maximo` unidades del presupuesto (compartido con los demás procesos) para
+        trabajo que se ejecuta fuera del pool, y las devuelve al salir. Espera hasta que quede al
+        menos una libre; da las unidades concedidas (0 si `maximo` es 0).
+        '''
+        concedidas = []
+
+        def calcular(ajenas):
+            with self._lock:
+                libres = self.presupuesto - ajenas - sum(self._en_uso.values())
+                if libres >= 1:
+                    self._acumular_ocupacion()
+                    concedidas.append(min(maximo, libres))
+                    self._en_uso[self.RESERVAS] += concedidas[0]
+                return sum(self._en_uso.values())
+
+        if maximo <= 0:
+            yield 0
+            return
+        self.compartido.actualizar(calcular)
+        while not concedidas:
+            time.sleep(self.ESPERA_AJENA)
+            self.compartido.actualizar(calcular)
+        try:
+            yield concedidas[0]
+        finally:
+            with self._lock:
+                self._acumular_ocupacion()
+                self._en_uso[self.RESERVAS] -= concedidas[0]
+            # Publica lo liberado y lanza lo que estuviera esperando por esas unidades
+            self._despachar()
+
+    def _reservar(self, carril, tarea, unidades):
+        self._acumular_ocupacion()
+        self._en_uso[carril] += unidades
+        self._en_curso[carril] += 1
+        self._espera_total[carril] += time.time() - tarea[6]
+        return carril, tarea, unidades
+
+    def _lanzar(self, carril, tarea, unidades):
+        _, _, recodificador, file_path, escalable, future, _ = tarea
+        if escalable:
+            # Copia con el número de hilos concedido: es lo que recibe ffmpeg
+            recodificador = copy.copy(recodificador)
+            recodificador.perfil = copy.copy(recodificador.perfil)
+            recodificador.perfil.threads = unidades
+            recodificador.perfil.pools = None
+
+        def terminar(resultado=None, error=None):
+            with self._lock:
+                self._acumular_ocupacion()
+                self._en_uso[carril] -= unidades
+                self._en_curso[carril] -= 1
+                self._completadas[carril] += 1
+            if error is not None:
+                future.set_exception(error)
+            else:
+                salida, medidas = resultado
+                info_salida = medidas.pop('info_salida', None)
+                if salida and info_salida:
+                    recodificador.guardar_info_salida(salida, info_salida)
+                Metricas.for_expo(recodificador.expo_id).registrar(
+                    'recodificar', medidas.pop('segundos'), fichero=os.path.basename(file_path),
+                    error=None if salida else 'Error al procesar el fichero', unidades=unidades, **medidas)
+                future.set_result(salida)
+            self._despachar()
+
+        def hecho(pool, resultado):
+            error = resultado.exception()
+            if error is None:
+                terminar(resultado.result())
+                return
+            if isinstance(error, BrokenProcessPool):
+                self._descartar_pool(pool)
+            terminar(error=error)
+
+        for intento in range(2):
+            pool = self._pool_()
+            try:
+                resultado = pool.submit(recodificador.process_file_medido, file_path)
+            except BrokenProcessPool as e:
+                # Se rompió entre dos tareas: una segunda oportunidad con un pool nuevo
+                self._descartar_pool(pool)
+                if intento:
+                    terminar(error=e)
+                continue
+            except Exception as e:
+                terminar(error=e)
+                return
+            resultado.add_done_callback(functools.partial(hecho, pool))
+            return
+
+    def estadisticas(self):
+        '''Profundidad de las colas, unidades en uso y utilización media desde el arranque.'''
+        with self._lock:
+            self._acumular_ocupacion()
+            en_uso = sum(self._en_uso.values())
+            transcurrido = max(time.time() - self._inicio, 1e-9)
+            carriles = {}
+            for carril in (self.IMAGENES, self.VIDEOS):
+                lanzadas = self._en_curso[carril] + self._completadas[carril]
+                carriles[carril] = {
+                    'en_cola': len(self._colas[carril]),
+                    'en_curso': self._en_curso[carril],
+                    'completadas': self._completadas[carril],
+                    'unidades_en_uso': self._en_uso[carril],
+                    'espera_media_seg': round(self._espera_total[carril] / lanzadas, 3) if lanzadas else None,
+                }
+            return {
+                'presupuesto': self.presupuesto,
+                'unidades_otros_procesos': self._ajenas,
+                'unidades_reservadas': self._en_uso[self.RESERVAS],
+                'reserva_imagenes': self.reserva_imagenes,
+                'unidades_en_uso': en_uso,
+                'utilizacion': round(en_uso / self.presupuesto, 3),
+                'utilizacion_media': round(self._ocupacion_acumulada / (transcurrido * self.presupuesto), 3),
+                'carriles': carriles,
+            }
+
+class TrabajoRecodificacion:
+    '''
+    Recodificación de una exposición ejecutada en un hilo propio, independiente de la petición
+    HTTP que la lanzó. Los clientes (SSE) solo se enganchan para observar su progreso; si el
+    navegador se desconecta, el trabajo continúa. Un fichero de lock evita que dos procesos
+    recodifiquen la misma exposición a la vez.
+    '''
+    INICIANDO = 'iniciando'
+    EN_CURSO = 'en_curso'
+    COMPLETADO = 'completado'
+    FALLIDO = 'error'
+
+    # Lo que hace quien tiene el lock de la exposición
+    RECODIFICACION = 'recodificacion'
+    PLAN = 'plan'
+
+    _activos = {}
+    _activos_lock = threading.Lock()
+
+    def __init__(self, expo_id, perfil=None):
+        self.expo_id = expo_id
+        self.recodificador = Recodificador(expo_id, perfil)
+        self.cola = ColaRecodificacion(self.recodificador)
+        self.estado = self.INICIANDO
+        self.error = None
+        self.progress_bus = ProgressBus(queue_module.Queue())
+        self.version = 0
+        self._cambio = threading.Condition()
+        self.hilo = threading.Thread(target=self._run, name=f"recodificar-{expo_id}", daemon=True)
+
+    @classmethod
+    def iniciar(cls, expo_id, perfil=None):
+        '''
+        Lanza la recodificación o devuelve la que ya está en marcha para esta exposición.
+        Si la está ejecutando otro proceso (otro worker de gunicorn), devuelve un
+        SeguimientoRecodificacion que la observa a través de la cola en disco.
+        '''
+        with cls._activos_lock:
+            trabajo = cls._activos.get(expo_id)
+            if trabajo is None or not trabajo.activo:
+                if cls.en_otro_proceso(expo_id):
+                    return SeguimientoRecodificacion(expo_id)
+                trabajo = cls(expo_id, perfil)
+                cls._activos[expo_id] = trabajo
+                trabajo.hilo.start()
+            return trabajo
+
+    @classmethod
+    def obtener(cls, expo_id):
+        trabajo = cls._activos.get(expo_id)
+        if trabajo is None and cls.en_otro_proceso(expo_id):
+            return SeguimientoRecodificacion(expo_id)
+        return trabajo
+
+    @staticmethod
+    def lock_path(expo_id):
+        return os.path.join(os.getcwd(), 'expos', expo_id, '.recodificacion.lock')
+
+    @classmethod
+    def _bloquear(cls, lock_path, tarea=RECODIFICACION):
+        '''
+        Intenta tomar el lock sin esperar. Devuelve el fichero abierto o None si lo tiene otro
+        proceso. Quien lo toma escribe su PID y su `tarea` en el fichero, para que los demás
+        sepan que está ocupado sin tener que intentar cogerlo (en_otro_proceso).
+        '''
+        if not os.path.isdir(os.path.dirname(lock_path)):
+            return None
+        # 'a+' y no 'w': abrirlo no debe borrar el PID de quien lo tiene
+        lock_file = open(lock_path, 'a+')
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            pass  # Sin fcntl (Windows) no hay protección entre procesos
+        except OSError:
+            lock_file.close()
+            return None
+        # Se sobrescribe y luego se recorta: el fichero nunca queda vacío mientras se escribe
+        lock_file.seek(0)
+        lock_file.write(f"{os.getpid()} {tarea}\n")
+        lock_file.truncate()
+        lock_file.flush()
+        return lock_file
+
+    @classmethod
+    def bloquear(cls, expo_id, tarea=RECODIFICACION):
+        '''
+        Lock de recodificación de la exposición para quien la procesa fuera de un
+        TrabajoRecodificacion (la recodificación distribuida, TrabajoPlan). None si lo tiene otro.
+        '''
+        return cls._bloquear(cls.lock_path(expo_id), tarea)
+
+    @staticmethod
+    def liberar(lock_file):
+        '''Borra el PID y suelta el lock.'''
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.close()
+
+    @classmethod
+    def _propietario(cls, lock_path):
+        '''
+        (PID, tarea) del proceso vivo que tiene el lock, o None (libre, o su dueño murió sin
+        soltarlo).
+        '''
+        try:
+            with open(lock_path, 'r') as f:
+                pid, _, tarea = f.read().strip().partition(' ')
+            pid = int(pid or 0)
+        except (OSError, ValueError):
+            return None
+        return (pid, tarea or cls.RECODIFICACION) if pid and proceso_vivo(pid) else None
+
+    @classmethod
+    def tarea_en_curso(cls, expo_id):
+        '''Tarea de quien tiene el lock de la exposición, en este o en otro proceso, o None.'''
+        propietario = cls._propietario(cls.lock_path(expo_id))
+        return propietario[1] if propietario else None
+
+    @classmethod
+    def en_otro_proceso(cls, expo_id):
+        '''
+        True si otro proceso está recodificando esta exposición. Solo lee el PID del fichero de
+        lock: coger el lock para comprobarlo haría fallar a quien lo pidiera a la vez.
+        '''
+        trabajo = cls._activos.get(expo_id)
+        if trabajo is not None and trabajo.activo:
+            return False
+        propietario = cls._propietario(cls.lock_path(expo_id))
+        return propietario is not None and propietario[0] != os.getpid() and propietario[1] == cls.RECODIFICACION
+
+    @property
+    def activo(self):
+        return self.hilo.is_alive() or self.estado == self.INICIANDO
+
+    def _notificar(self):
+        with self._cambio:
+            self.version += 1
+            self._cambio.notify_all()
+
+    def esperar_cambio(self, version, timeout=15):
+        '''Bloquea hasta que haya un estado más nuevo que `version` o venza el timeout.'''
+        with self._cambio:
+            self._cambio.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    def _run(self):
+        lock_file = self._bloquear(self.lock_path(self.expo_id))
+        if lock_file is None:
+            self.estado, self.error = self.FALLIDO, 'Ya hay una recodificación en curso para esta exposición en otro proceso'
+            self._notificar()
+            return
+
+        recodificador = self.recodificador
+        try:
+            recodificador.crear_carpeta_procesados()
+            pendientes = self.cola.sincronizar()
+            log.info("Recodificación de %s: %s pendientes, %s ya procesados",
+                     self.expo_id, len(pendientes), len(self.cola.ficheros) - len(pendientes))
+
+            bus = self.progress_bus
+            bus.mark_queued(self.cola.ficheros)
+            for nombre, entrada in self.cola.ficheros.items():
+                if entrada['estado'] == ColaRecodificacion.TERMINADO:
+                    bus.estados[nombre] = EstadoFichero(ProgressBus.TERMINADO, 100.0, None, None)
+            self.estado = self.EN_CURSO
+            self._notificar()
+
+            if pendientes:
+                planificador = PlanificadorCodificacion.global_()
+                with Metricas.for_expo(self.expo_id).etapa('recodificacion', ficheros=len(pendientes)), Manager() as manager:
+                    # Los workers publican en una cola del Manager; aquí se reenvía al bus del trabajo
+                    recodificador.progress_bus = ProgressBus(manager.Queue())
+                    # El pool y el presupuesto de CPU son del planificador, compartidos con otras expos
+                    pendientes_resultado = planificador.enviar(recodificador, pendientes)
+
+                    while pendientes_resultado:
+                        recodificador.progress_bus.drain(timeout=1.0)
+                        if self._actualizar(recodificador.progress_bus.estados, pendientes_resultado):
+                            self._notificar()
+                    recodificador.progress_bus.drain(timeout=0)
+                    self._actualizar(recodificador.progress_bus.estados, pendientes_resultado)
+
+            # Registrar en el resumen qué se recodificó, remultiplexó o copió
+            if os.path.exists(recodificador.excel_path):
+                recodificador.actualizar_excel()
+            self.estado = self.COMPLETADO
+        except Exception as e:
+            log.error("Error en la recodificación de %s: %s", self.expo_id, e)
+            self.estado, self.error = self.FALLIDO, str(e)
+        finally:
+            self.liberar(lock_file)
+            self._notificar()
+
+    def _actualizar(self, estados_workers, pendientes_resultado):
+        '''Vuelca el progreso de los workers al bus del trabajo y los resultados a la cola persistente.'''
+        cambios = False
+        for nombre, estado in list(estados_workers.items()):
+            anterior = self.progress_bus.estados.get(nombre)
+            if anterior != estado:
+                if estado.estado == ProgressBus.PROCESANDO and (anterior is None or anterior.estado != ProgressBus.PROCESANDO):
+                    self.cola.marcar(nombre, ColaRecodificacion.PROCESANDO)
+                self.progress_bus.estados[nombre] = estado
+                cambios = True
+
+        for file_path, result in list(pendientes_resultado.items()):
+            if not result.done():
+                continue
+            del pendientes_resultado[file_path]
+            nombre = os.path.basename(file_path)
+            try:
+                salida = result.result()
+            except Exception as e:
+                salida, error = False, str(e)
+            else:
+                error = None if salida else 'Error al procesar el fichero'
+            if salida:
+                self.cola.marcar(nombre, ColaRecodificacion.TERMINADO, salida=salida)
+                self.progress_bus.estados[nombre] = EstadoFichero(ProgressBus.TERMINADO, 100.0, None, None)
+            else:
+                self.cola.marcar(nombre, ColaRecodificacion.ERROR, error=error)
+                self.progress_bus.estados[nombre] = EstadoFichero(ProgressBus.ERROR, 0.0, None, None)
+            cambios = True
+        return cambios
+
+    def snapshot(self):
+        '''Estado actual del trabajo en el formato de los eventos SSE de /recodificar.'''
+        if self.estado == self.FALLIDO:
+            return {'status': 'error', 'error': self.error}
+        if self.estado == self.COMPLETADO:
+            return {'status': 'completed', 'counts': self.progress_bus.counts()}
+        en_curso = self.progress_bus.in_progress()
+        return {
+            'status': 'processing',
+            'progress': self.progress_bus.total_progress(),
+            'current_files': ', '.join(en_curso),
+            'files': {f: {'progress': e.progress, 'eta': e.eta, 'speed': e.speed} for f, e in en_curso.items()},
+            'counts': self.progress_bus.counts()
+        }
+
+    @classmethod
+    def estado_guardado(cls, expo_id):
+        '''Estado de la última recodificación según la cola en disco (cuando no hay trabajo en memoria).'''
+        cola = ColaRecodificacion(Recodificador(expo_id))
+        return {'activo': False, 'counts': cola.counts(), 'ficheros': cola.ficheros}
+
+class SeguimientoRecodificacion:
+    '''
+    Observa una recodificación que se ejecuta en otro proceso (p. ej. otro worker de gunicorn).
+
+    Tiene la misma interfaz que TrabajoRecodificacion para los clientes SSE (activo,
+    esperar_cambio, snapshot), pero lee el estado de la cola en disco: se sabe qué ficheros
+    están terminados o en proceso, no el porcentaje de cada uno.
+    '''
+    INTERVALO = 0.5
+
+    def __init__(self, expo_id):
+        self.expo_id = expo_id
+        self.cola_path = ColaRecodificacion.ruta(expo_id)
+
+    @property
+    def activo(self):
+        return TrabajoRecodificacion.en_otro_proceso(self.expo_id)
+
+    def _version(self):
+        try:
+            mtime = os.stat(self.cola_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = 0
+        return (mtime, self.activo)
+
+    def esperar_cambio(self, version, timeout=15):
+        limite = time.time() + timeout
+        actual = self._version()
+        while actual == version and time.time() < limite:
+            time.sleep(self.INTERVALO)
+            actual = self._version()
+        return actual
+
+    def snapshot(self):
+        ficheros = ColaRecodificacion.leer(self.expo_id)
+        counts = dict(collections.Counter(e['estado'] for e in ficheros.values()))
+        if not self.activo:
+            return {'status': 'completed', 'counts': counts}
+        hechos = counts.get(ColaRecodificacion.TERMINADO, 0) + counts.get(ColaRecodificacion.ERROR, 0)
+        en_curso = [n for n, e in ficheros.items() if e['estado'] == ColaRecodificacion.PROCESANDO]
+        return {
+            'status': 'processing',
+            'progress': hechos / len(ficheros) * 100 if ficheros else 0,
+            'current_files': ', '.join(en_curso),
+            'files': {},
+            'counts': counts
+        }
+
+class TrabajoPlan:
+    '''
+    Cálculo de un PlanRecodificacion en un hilo propio, como TrabajoRecodificacion: en una
+    exposición grande las muestras tardan minutos y no deben tener ocupada la petición HTTP.
+    Mientras muestrea tiene el lock de recodificación de la exposición (con la tarea PLAN), así
+    que no compite por los núcleos con un /recodificar de la misma exposición.
+    '''
+    INICIANDO = TrabajoRecodificacion.INICIANDO
+    EN_CURSO = TrabajoRecodificacion.EN_CURSO
+    COMPLETADO = TrabajoRecodificacion.COMPLETADO
+    FALLIDO = TrabajoRecodificacion.FALLIDO
+
+    _activos = {}
+    _activos_lock = threading.Lock()
+
+    def __init__(self, expo_id, perfil=None, forzar=False):
+        self.expo_id = expo_id
+        self.plan_recodificacion = PlanRecodificacion(Recodificador(expo_id, perfil))
+        self.forzar = forzar
+        self.estado = self.INICIANDO
+        self.error = None
+        self.plan = None
+        self.hechas = self.total = 0
+        self.ultimo = None
+        self.version = 0
+        self._cambio = threading.Condition()
+        self.hilo = threading.Thread(target=self._run, name=f"plan-{expo_id}", daemon=True)
+
+    @classmethod
+    def iniciar(cls, expo_id, perfil=None, forzar=False):
+        '''Lanza el cálculo del plan o devuelve el que ya está en marcha para esta exposición.'''
+        with cls._activos_lock:
+            trabajo = cls._activos.get(expo_id)
+            if trabajo is None or not trabajo.activo:
+                trabajo = cls(expo_id, perfil, forzar)
+                cls._activos[expo_id] = trabajo
+                trabajo.hilo.start()
+            return trabajo
+
+    @classmethod
+    def en_curso(cls, expo_id):
+        '''True si se está calculando el plan de la exposición, en este o en otro proceso.'''
+        trabajo = cls._activos.get(expo_id)
+        if trabajo is not None and trabajo.activo:
+            return True
+        return TrabajoRecodificacion.tarea_en_curso(expo_id) == TrabajoRecodificacion.PLAN
+
+    @property
+    def activo(self):
+        return self.hilo.is_alive() or self.estado == self.INICIANDO
+
+    def _notificar(self):
+        with self._cambio:
+            self.version += 1
+            self._cambio.notify_all()
+
+    def esperar_cambio(self, version, timeout=15):
+        '''Bloquea hasta que haya un estado más nuevo que `version` o venza el timeout.'''
+        with self._cambio:
+            self._cambio.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+    def _progreso(self, hechas, total, nombre):
+        self.hechas, self.total, self.ultimo = hechas, total, nombre
+        self._notificar()
+
+    def _run(self):
+        lock_file = TrabajoRecodificacion.bloquear(self.expo_id, TrabajoRecodificacion.PLAN)
+        if lock_file is None:
+            self.estado, self.error = self.FALLIDO, 'La exposición se está recodificando o ya se está calculando su plan'
+            self._notificar()
+            return
+        try:
+            self.estado = self.EN_CURSO
+            self._notificar()
+            self.plan = self.plan_recodificacion.calcular(forzar=self.forzar, on_progress=self._progreso)
+            self.estado = self.COMPLETADO
+        except Exception as e:
+            log.error("Error calculando el plan de %s: %s", self.expo_id, e)
+            self.estado, self.error = self.FALLIDO, str(e)
+        finally:
+            TrabajoRecodificacion.liberar(lock_file)
+            self._notificar()
+
+    def snapshot(self):
+        '''Estado actual en el formato de los eventos SSE de /recodificar/plan; al terminar trae el plan.'''
+        if self.estado == self.FALLIDO:
+            return {'status': 'error', 'error': self.error}
+        if self.estado == self.COMPLETADO:
+            return {'status': 'completed', 'plan': self.plan}
+        return {
+            'status': 'processing',
+            'progress': self.hechas / self.total * 100 if self.total else 0,
+            'current_files': self.ultimo or '',
+            'muestras': {'hechas': self.hechas, 'total': self.total},
+        }
 
 def main():
     expo_id = 'E995'
@@ -763,6 +4053,7 @@ def main():
 
 
     # Si no hay archivos procesados o el usuario quiere reprocesar, continuar con el flujo normal
+    Metricas.for_expo(expo_id).nueva_ejecucion()
     processor = ExpoProcessor(expo_id)
     processor.setup_directories()
     processor.unzip_files()
@@ -770,11 +4061,43 @@ def main():
     processor.generate_summary()
 
     # Proceso de recodificación
-    recodificador.crear_carpeta_procesados()
-    recodificador.procesar_archivos()
+    recodificador.crear_carpeta_procesados(limpiar=True)
+    with Metricas.for_expo(expo_id).etapa('recodificacion', ficheros=len(os.listdir(recodificador.carpeta_origen))):
+        recodificador.procesar_archivos()
     recodificador.actualizar_excel()
 
+def run_command(argv):
+    '''Comandos de mantenimiento: python main.py <comando> <expo_id>'''
+    import argparse
+    parser = argparse.ArgumentParser(description='Utilidades de Expo Manager')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    p_metadatos = subparsers.add_parser('reconstruir-metadatos', help='Regenera el índice de metadatos de una exposición')
+    p_metadatos.add_argument('expo_id')
+    p_metadatos.add_argument('--hash', action='store_true', help='Indexar también por hash de contenido')
+
+    p_plan = subparsers.add_parser('plan', help='Estima tamaño y tiempo de la recodificación a partir de muestras')
+    p_plan.add_argument('expo_id')
+    p_plan.add_argument('--perfil', help='Perfil de codificación (por defecto, el activo)')
+    p_plan.add_argument('--forzar', action='store_true', help='Volver a muestrear también los vídeos sin cambios')
+
+    args = parser.parse_args(argv)
+    if args.comando == 'reconstruir-metadatos':
+        MetadataCache.for_expo(args.expo_id, content_hash=args.hash).rebuild()
+    elif args.comando == 'plan':
+        # Con el lock de la exposición, igual que desde la web
+        trabajo = TrabajoPlan.iniciar(args.expo_id, args.perfil, args.forzar)
+        trabajo.hilo.join()
+        if trabajo.estado == TrabajoPlan.FALLIDO:
+            log.error(trabajo.error)
+            return 1
+        print(PlanRecodificacion.tabla(trabajo.plan))
+    return 0
+
 if __name__ == "__main__":
+    configurar_logging()
+    if len(sys.argv) > 1:
+        sys.exit(run_command(sys.argv[1:]))
 
     # El resto del código main() se ejecutará si se llama directamente
     main()
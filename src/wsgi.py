@@ -0,0 +1,13 @@
+'''
+Punto de entrada WSGI para producción.
+
+Desde la carpeta src:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Las rutas de la aplicación usan rutas relativas (expos/...), así que el servidor debe
+arrancarse desde src, igual que con `python app.py`.
+'''
+from app import app
+
+if __name__ == '__main__':
+    app.run(threaded=True)